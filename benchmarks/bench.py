@@ -0,0 +1,318 @@
+""" tport benchmarks: throughput and peak memory of the hot paths.
+
+    Runs each benchmark in its own process against the in-memory stand-ins
+    in :mod:`benchmarks.fakes`, on a synthetic file of Gnip tweet shaped
+    JSON lines, and reports docs/sec, MB/sec and peak RSS.  The startup
+    benchmark instead launches ``tport`` in fresh interpreters, counting
+    launches as its docs.  Results can be saved as a named baseline and
+    later runs compared against it.
+
+Usage:
+    bench.py [--docs=<docs>] [--workers=<workers>] [--codec=<codec>] [--save=<name>] [--compare=<name>] [BENCHMARK ...]
+    bench.py --list
+
+Options:
+    -h --help
+    --docs <docs>         docs in the synthetic input [default: 20000]
+    --workers <workers>   workers for the parallel parse [default: 4]
+    --codec <codec>       JSON codec [default: auto]
+    --save <name>         save the results as a baseline
+    --compare <name>      compare the results with a saved baseline
+    --list                list the benchmarks
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import shutil
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from docopt import docopt
+
+import mongomock
+import pymongo
+import happybase
+
+from benchmarks import fakes
+from transporter import tools
+from transporter.codec import get_codec
+from transporter.readers import LineReader
+from transporter.transform import Transform
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines')
+
+_started = [0.0]
+
+
+def _restart():
+    """ Start the clock over once a benchmark has set up its data. """
+    tools.METRICS.reset()
+    _started[0] = time.time()
+
+
+def _docs(path, codec, workers=1):
+    """ Parse the input file the way tport does. """
+    return tools.JsonPort(LineReader([path]), workers=workers,
+                          codec=codec).parse()
+
+
+def bench_startup(path, codec, options):
+    """ Launch tport --help in fresh interpreters. """
+    launches = 20
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(launches):
+            subprocess.check_call([sys.executable, '-m', 'transporter.tport',
+                                   '--help'], stdout=devnull)
+    return launches
+bench_startup.reads_input = False
+
+
+def bench_parse(path, codec, options):
+    """ Decode JSON lines in a single process. """
+    return sum(1 for _ in _docs(path, codec))
+
+
+def bench_parse_parallel(path, codec, options):
+    """ Decode JSON lines in a process pool. """
+    return sum(1 for _ in _docs(path, codec, options['workers']))
+
+
+def bench_parse_transform(path, codec, options):
+    """ Decode, filter and project tweets in a process pool. """
+    transform = Transform('verb == post', include=[
+        'id', 'postedTime', 'body', 'actor.id', 'actor.preferredUsername',
+        'd_hashtags'])
+    return sum(1 for _ in tools.JsonPort(LineReader([path]),
+                                         workers=options['workers'],
+                                         codec=codec,
+                                         transform=transform).parse())
+
+
+def bench_index(path, codec, options):
+    """ Bulk index into Elasticsearch with streaming_bulk. """
+    esi = tools.ElasticPort('localhost:9200', False, codec=codec)
+    esi.es = fakes.FakeElasticsearch()
+    esi.index(_docs(path, codec), 'bench', 'tweet')
+    return tools.METRICS.counters['docs_written']
+
+
+def bench_index_adaptive(path, codec, options):
+    """ Bulk index into Elasticsearch with byte sized bulk requests. """
+    esi = tools.ElasticPort('localhost:9200', False, codec=codec)
+    esi.es = fakes.FakeElasticsearch()
+    esi.index(_docs(path, codec), 'bench', 'tweet', adaptive=True)
+    return tools.METRICS.counters['docs_written']
+
+
+def bench_produce(path, codec, options):
+    """ Produce messages to Kafka with delivery reports. """
+    kai = tools.KafkaPort.__new__(tools.KafkaPort)
+    kai.logger = tools.logging.getLogger()
+    kai.codec = codec
+    kai.client = fakes.FakeKafkaClient()
+    kai.produce('bench', _docs(path, codec))
+    return kai.delivered
+
+
+def bench_produce_passthrough(path, codec, options):
+    """ Produce raw lines to Kafka without decoding them. """
+    kai = tools.KafkaPort.__new__(tools.KafkaPort)
+    kai.logger = tools.logging.getLogger()
+    kai.codec = codec
+    kai.client = fakes.FakeKafkaClient()
+    kai.produce('bench', tools.JsonPort(LineReader([path]),
+                                        codec=codec).raw(), raw=True)
+    return kai.delivered
+
+
+def bench_upload(path, codec, options):
+    """ Gzip a file into an S3 multipart upload. """
+    s3 = tools.S3Port.__new__(tools.S3Port)
+    s3.conn = fakes.FakeS3Connection()
+    bucket = fakes.FakeBucket('bench')
+    s3._bucket = lambda bucket_name: bucket
+    s3.upload('bench', [path], compress=True)
+    return options['docs']
+
+
+def bench_mongo_add(path, codec, options):
+    """ Insert docs into MongoDB in batches. """
+    mgi = tools.MongoPort.__new__(tools.MongoPort)
+    mgi.db = mongomock.MongoClient().bench
+    mgi.add('tweets', _docs(path, codec))
+    return mgi.db.tweets.count_documents({})
+
+
+def bench_mongo_export(path, codec, options):
+    """ Export a MongoDB collection to JSON lines. """
+    client = mongomock.MongoClient()
+    client.bench.tweets.insert_many(list(_docs(path, codec)))
+    pymongo.MongoClient = lambda host: client
+    mgi = tools.MongoPort('localhost', 'bench', codec=codec)
+    _restart()
+    mgi.export('tweets', os.path.join(options['tmp'], 'mongo.json'))
+    return options['docs']
+
+
+def bench_hbase_import(path, codec, options):
+    """ Write plain docs to HBase in batches of puts. """
+    table = fakes.FakeHbaseTable()
+    hbi = tools.HbasePort.__new__(tools.HbasePort)
+    hbi.connection = fakes.FakeHbaseConnection(table)
+    hbi.codec = codec
+    hbi.add('bench', _docs(path, codec), row_key='id', family='t')
+    return len(table.rows)
+
+
+def bench_hbase_export(path, codec, options):
+    """ Export an HBase table to JSON lines. """
+    table = fakes.FakeHbaseTable()
+    connection = fakes.FakeHbaseConnection(table)
+    hbi = tools.HbasePort.__new__(tools.HbasePort)
+    hbi.connection = connection
+    hbi.codec = codec
+    hbi.add('bench', _docs(path, codec), row_key='id', family='t')
+    happybase.Connection = lambda host: connection
+    hbi.hostname = 'localhost'
+    _restart()
+    hbi.export('bench', os.path.join(options['tmp'], 'hbase.json'))
+    return len(table.rows)
+
+
+BENCHMARKS = [
+    ('startup', bench_startup),
+    ('parse', bench_parse),
+    ('parse_parallel', bench_parse_parallel),
+    ('parse_transform', bench_parse_transform),
+    ('index', bench_index),
+    ('index_adaptive', bench_index_adaptive),
+    ('produce', bench_produce),
+    ('produce_passthrough', bench_produce_passthrough),
+    ('upload', bench_upload),
+    ('mongo_add', bench_mongo_add),
+    ('mongo_export', bench_mongo_export),
+    ('hbase_import', bench_hbase_import),
+    ('hbase_export', bench_hbase_export)
+]
+
+
+def _run(func, path, codec_name, options, results):
+    """ Run one benchmark in a fresh process and report its throughput and
+        peak RSS.
+    """
+    # keep the ports' summary prints and logs out of the results table
+    sys.stdout = open(os.devnull, 'w')
+    logging.getLogger().setLevel(logging.WARNING)
+    codec = get_codec(codec_name)
+    _restart()
+    try:
+        docs = int(func(path, codec, options))
+    except Exception as e:
+        results.put({'error': repr(e)})
+        raise
+    seconds = time.time() - _started[0]
+    size = os.path.getsize(path) if getattr(func, 'reads_input', True) \
+        else 0
+    results.put({
+        'docs': docs,
+        'seconds': seconds,
+        'docs_per_sec': docs / seconds,
+        'mb_per_sec': size / 1e6 / seconds,
+        # ru_maxrss is in kilobytes on Linux and bytes on OS X
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        (1e6 if sys.platform == 'darwin' else 1e3)
+    })
+
+
+def run(name, path, codec_name, options):
+    """ Returns the results of a benchmark, run in a child process so its
+        peak RSS is its own.
+
+        :param str name: benchmark name
+        :param str path: JSON lines input
+        :param str codec_name: JSON codec
+        :param dict options: benchmark options
+    """
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run, args=(
+        dict(BENCHMARKS)[name], path, codec_name, options, results))
+    proc.start()
+    result = results.get()
+    proc.join()
+    if 'error' in result:
+        raise RuntimeError('{0} failed: {1}'.format(name, result['error']))
+    return result
+
+
+def compare(results, baseline):
+    """ Print results side by side with a baseline.
+
+        :param dict results: results by benchmark
+        :param dict baseline: saved results by benchmark
+    """
+    print '\n{0:<20} {1:>12} {2:>12} {3:>8} {4:>10} {5:>10}'.format(
+        'benchmark', 'docs/s', 'baseline', 'change', 'rss MB', 'baseline')
+    for name, _ in BENCHMARKS:
+        result, base = results.get(name), baseline.get(name)
+        if result is None or base is None:
+            continue
+        change = result['docs_per_sec'] / base['docs_per_sec'] - 1
+        print '{0:<20} {1:>12.0f} {2:>12.0f} {3:>+7.1%} {4:>10.1f} ' \
+              '{5:>10.1f}'.format(name, result['docs_per_sec'],
+                                  base['docs_per_sec'], change,
+                                  result['peak_rss_mb'], base['peak_rss_mb'])
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--list']:
+        for name, func in BENCHMARKS:
+            print '{0:<20} {1}'.format(name, func.__doc__.strip())
+        return
+    names = args['BENCHMARK'] or [name for name, _ in BENCHMARKS]
+    unknown = set(names) - set(dict(BENCHMARKS))
+    if unknown:
+        sys.exit('unknown benchmarks: {0}'.format(', '.join(unknown)))
+    codec = get_codec(args['--codec'])
+    options = {'docs': int(args['--docs']),
+               'workers': int(args['--workers']),
+               'tmp': tempfile.mkdtemp(prefix='tport-bench-')}
+    path = os.path.join(options['tmp'], 'tweets.json')
+    with open(path, 'w') as f:
+        for doc in fakes.gnip_tweets(options['docs']):
+            f.write(codec.dumps(doc) + '\n')
+    print '{0} docs, {1:.1f} MB, codec {2}\n'.format(
+        options['docs'], os.path.getsize(path) / 1e6, codec.name)
+    print '{0:<20} {1:>10} {2:>8} {3:>12} {4:>8} {5:>8}'.format(
+        'benchmark', 'docs', 'seconds', 'docs/s', 'MB/s', 'rss MB')
+    results = {}
+    try:
+        for name in names:
+            result = results[name] = run(name, path, codec.name, options)
+            print '{0:<20} {1:>10} {2:>8.2f} {3:>12.0f} {4:>8.1f} ' \
+                  '{5:>8.1f}'.format(name, result['docs'], result['seconds'],
+                                     result['docs_per_sec'],
+                                     result['mb_per_sec'],
+                                     result['peak_rss_mb'])
+    finally:
+        shutil.rmtree(options['tmp'])
+    if args['--compare']:
+        with open(os.path.join(BASELINES, args['--compare'] + '.json')) as f:
+            compare(results, json.load(f)['results'])
+    if args['--save']:
+        if not os.path.isdir(BASELINES):
+            os.makedirs(BASELINES)
+        baseline = os.path.join(BASELINES, args['--save'] + '.json')
+        with open(baseline, 'w') as f:
+            json.dump({'docs': options['docs'], 'codec': codec.name,
+                       'results': results}, f, indent=2, sort_keys=True)
+        print '\nbaseline saved to {0}'.format(baseline)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
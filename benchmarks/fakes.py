@@ -0,0 +1,167 @@
+""" In-memory stand-ins for the services behind each port.
+
+    They accept what the ports send and do as little as possible with it, so
+    a benchmark measures transporter's own overhead rather than a cluster.
+"""
+
+import random
+from Queue import Queue
+
+from elasticsearch.serializer import JSONSerializer
+
+
+def gnip_tweets(count, seed=0):
+    """ Generate docs shaped like the Gnip tweets that
+        ``examples/mapping_gnip_tweet.json`` maps.
+
+        :param int count: number of docs
+        :param int seed: random seed, so runs are reproducible
+    """
+    rnd = random.Random(seed)
+    words = ['json', 'transport', 'elastic', 'kafka', 'mongo', 'hbase',
+             'bulk', 'index', 'stream', 'cluster', 'shard', 'replica']
+    for n in xrange(count):
+        text = ' '.join(rnd.choice(words) for _ in xrange(rnd.randint(5, 25)))
+        tags = rnd.sample(words, rnd.randint(0, 3))
+        yield {
+            'id': 'tag:search.twitter.com,2005:{0}'.format(10 ** 17 + n),
+            'objectType': 'activity',
+            'verb': 'post',
+            'postedTime': '2015-09-{0:02d}T12:{1:02d}:00.000Z'.format(
+                n % 28 + 1, n % 60),
+            'body': text,
+            'actor': {
+                'id': 'id:twitter.com:{0}'.format(rnd.randint(1, 10 ** 6)),
+                'preferredUsername': 'user{0}'.format(n % 5000),
+                'summary': text[:40],
+                'followersCount': rnd.randint(0, 10 ** 5),
+                'languages': ['en']
+            },
+            'object': {'summary': text, 'objectType': 'note'},
+            'd_coordinates': [round(rnd.uniform(-90, 90), 6),
+                              round(rnd.uniform(-180, 180), 6)],
+            'd_hashtags': tags,
+            'd_mentions': ['user{0}'.format(rnd.randint(0, 5000))
+                           for _ in xrange(rnd.randint(0, 2))]
+        }
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeElasticsearch(object):
+    """ Acknowledges every action of a bulk request. """
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def bulk(self, body, **kwargs):
+        lines = [line for line in body.split('\n') if line]
+        items = []
+        for line in lines:
+            if line.startswith('{"index"') or line.startswith('{"create"'):
+                items.append({'index': {'status': 201}})
+        return {'errors': False, 'items': items}
+
+
+class FakeProducer(object):
+    """ Delivers every message straight away. """
+
+    def __init__(self, **options):
+        self.reports = Queue()
+
+    def produce(self, message, partition_key=None):
+        msg = object()
+        self.reports.put((msg, None))
+        return msg
+
+    def get_delivery_report(self, block=True):
+        return self.reports.get(block)
+
+    def stop(self):
+        pass
+
+
+class FakeTopic(object):
+
+    def get_producer(self, **options):
+        return FakeProducer(**options)
+
+
+class FakeKafkaClient(object):
+
+    def __init__(self):
+        self.topics = {'bench': FakeTopic()}
+
+
+class FakeMultipartUpload(object):
+    """ Reads and drops every part. """
+
+    def __init__(self):
+        self.size = 0
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        self.size += len(fp.read())
+
+    def complete_upload(self):
+        pass
+
+    def cancel_upload(self):
+        pass
+
+
+class FakeBucket(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_key(self, key_name):
+        return None
+
+    def initiate_multipart_upload(self, key_name):
+        return FakeMultipartUpload()
+
+
+class FakeS3Connection(object):
+
+    def create_bucket(self, bucket_name):
+        return FakeBucket(bucket_name)
+
+
+class FakeHbaseTable(object):
+    """ Keeps rows in a dict, with batches applied on send. """
+
+    def __init__(self, rows=None):
+        self.rows = rows or {}
+
+    def scan(self, row_start=None, row_stop=None, columns=None,
+             batch_size=1000):
+        for key in sorted(self.rows):
+            if (row_start is None or key >= row_start) and \
+                    (row_stop is None or key < row_stop):
+                yield key, self.rows[key]
+
+    def batch(self):
+        table = self
+
+        class Batch(object):
+            def __init__(self):
+                self.puts = []
+
+            def put(self, row, data):
+                self.puts.append((row, data))
+
+            def send(self):
+                table.rows.update(self.puts)
+                self.puts = []
+        return Batch()
+
+
+class FakeHbaseConnection(object):
+
+    def __init__(self, table):
+        self.tables = {'bench': table}
+
+    def table(self, name):
+        return self.tables[name]
@@ -25,29 +25,38 @@ data_files = [
 #     shutil.copyfile('.tport', os.path.expanduser('~/.tport'))
 
 install_requires = [
-    # 'urllib3',
-    'elasticsearch>=1.6',
-    'boto',
-    'pymongo',
-    'happybase',
-    'pykafka',
     'docopt'
 ]
 
+# the client library of each port, see transporter.tools.CLIENTS
+port_requires = {
+    'es': ['elasticsearch>=1.6'],
+    'kafka': ['pykafka'],
+    's3': ['boto'],
+    'mongo': ['pymongo'],
+    'hbase': ['happybase']
+}
+ports_require = sum(port_requires.values(), [])
+
 lint_requires = [
     'pep8',
     'pyflakes'
 ]
 
-tests_require = ['nose']
+tests_require = ['nose', 'mongomock'] + ports_require
 dependency_links = []
 setup_requires = []
 extras_require = {
     'test': tests_require,
-    'all': install_requires + tests_require,
+    'ports': ports_require,
+    'all': tests_require,
     'docs': ['sphinx'] + tests_require,
-    'lint': lint_requires
+    'lint': lint_requires,
+    'xz': ['backports.lzma'],
+    'zstd': ['zstandard'],
+    'xxhash': ['xxhash']
 }
+extras_require.update(port_requires)
 
 if 'nosetests' in sys.argv[1:]:
     setup_requires.append('nose')
@@ -62,7 +71,7 @@ setup(
     license='MIT',
     url='https://github.com/istresearch/json-transporter',
     keywords=['json', 'elasticsearch', 's3', 'kafka', 'mongo'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     package_data={},
     # data_files=data_files,
     install_requires=install_requires,
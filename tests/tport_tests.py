@@ -1,4 +1,6 @@
 from nose.tools import *
+import json
+import logging
 import transporter
 
 def setup():
@@ -9,3 +11,1057 @@ def teardown():
 
 def test_basic():
     print "I RAN!"
+
+def test_parallel_parse_keeps_order():
+    from transporter.tools import JsonPort
+    lines = ['{"n": %d}' % i for i in range(250)]
+    lines[42] = 'not json'
+    serial = list(JsonPort(lines, ignore_errors=True).parse())
+    parallel = list(JsonPort(lines, ignore_errors=True, workers=3,
+                             chunksize=10).parse())
+    assert_equal(parallel, serial)
+    assert_equal(len(parallel), 249)
+
+def test_decode_chunk_reports_line_numbers():
+    from transporter.tools import _decode_chunk
+    decoded = _decode_chunk((10, ['{}', 'nope']))
+    assert_equal(decoded[0], (10, {}, None))
+    assert_equal(decoded[1][0], 11)
+    assert_equal(decoded[1][1], 'nope')
+
+def test_get_codec():
+    from transporter.codec import get_codec
+    codec = get_codec('json')
+    assert_equal(codec.name, 'json')
+    assert_equal(codec.loads(codec.dumps({'a': [1, 2]})), {'a': [1, 2]})
+    assert_true(get_codec('auto').name in ('orjson', 'ujson', 'simplejson',
+                                           'json'))
+    assert_raises(ValueError, get_codec, 'yaml')
+
+def test_raw_passthrough_validation():
+    from transporter.tools import JsonPort
+    lines = ['{"a": 1}\n', 'oops\n', '[1, 2]\n', '{"a": \n']
+    port = JsonPort(lines, ignore_errors=True)
+    assert_equal(list(port.raw()), ['{"a": 1}', '[1, 2]'])
+    assert_equal(list(port.raw(validate='none', sample=1)),
+                 ['{"a": 1}', '[1, 2]'])
+    assert_equal(len(list(port.raw(validate='none'))), 4)
+
+def test_bulk_sizer_adapts():
+    from transporter.tools import BulkSizer
+    sizer = BulkSizer(chunkbytes=1000, min_bytes=100, max_bytes=2000,
+                      target_latency=1.0)
+    sizer.feedback(0.1)
+    assert_equal(sizer.chunkbytes, 1250)
+    sizer.feedback(0.7)
+    assert_equal(sizer.chunkbytes, 1250)
+    sizer.feedback(2.0)
+    assert_equal(sizer.chunkbytes, 937)
+    sizer.feedback(0.1, rejected=True)
+    assert_equal(sizer.chunkbytes, 468)
+
+class FakeBulkClient(object):
+    """ Rejects the second doc of the first bulk request. """
+
+    def __init__(self):
+        self.bodies = []
+
+    def bulk(self, body):
+        self.bodies.append(body)
+        items = [{'index': {'status': 201}} for _ in body.splitlines()[::2]]
+        if len(self.bodies) == 1:
+            items[1] = {'index': {'status': 429}}
+        return {'items': items}
+
+def test_send_chunk_retries_rejected_docs():
+    from transporter.tools import ElasticPort, BulkSizer
+    esi = ElasticPort('localhost:9200', False)
+    esi.es = FakeBulkClient()
+    chunk = ['{"index":{}}\n{"n":%d}\n' % i for i in range(3)]
+    r = esi._send_chunk(chunk, BulkSizer(), max_retries=2, backoff=0)
+    assert_equal(r, (3, 0))
+    assert_equal(esi.es.bodies[1], chunk[1])
+
+class FakeRejectingClient(object):
+    """ Rejects every doc with an odd n for a mapping error. """
+
+    def bulk(self, body):
+        docs = [json.loads(line) for line in body.splitlines()[1::2]]
+        rejected = {'_index': 'idx', 'status': 400,
+                    'error': {'type': 'mapper_parsing'}}
+        return {'items': [{'index': rejected if doc['n'] % 2 else
+                           {'status': 201}} for doc in docs]}
+
+def test_error_policies_and_dead_letters():
+    import os
+    import tempfile
+    from elasticsearch.helpers import BulkIndexError
+    from transporter.tools import JsonPort, ElasticPort, BulkSizer
+    from transporter.deadletter import DeadLetter
+    lines = ['{"n": %d}\n' % i for i in range(20)]
+    lines[3] = lines[11] = '{"n": \n'
+    assert_raises(ValueError, list, JsonPort(lines).parse())
+    assert_equal(len(list(JsonPort(lines, errors='skip').parse())), 18)
+    assert_raises(ValueError, JsonPort, lines, errors='dead-letter')
+
+    path = os.path.join(tempfile.mkdtemp(), 'dead.json')
+    dead = DeadLetter(path, batch_size=1000)
+    for workers in (1, 2):
+        docs = list(JsonPort(lines, workers=workers, chunksize=5,
+                             errors='dead-letter', dead_letter=dead).parse())
+        assert_equal(len(docs), 18)
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert_equal([r['line_number'] for r in records], [3, 11, 3, 11])
+    assert_equal(records[0]['line'], '{"n": ')
+    list(JsonPort([u'{"caf\xe9": \n'], errors='dead-letter',
+                  dead_letter=dead).parse())
+    dead.flush()
+    with open(path) as f:
+        assert_equal(json.loads(f.readlines()[-1])['line'], u'{"caf\xe9": ')
+
+    esi = ElasticPort('localhost:9200', False)
+    esi.es = FakeRejectingClient()
+    chunk = ['{"index":{}}\n{"n":%d}\n' % i for i in range(4)]
+    assert_raises(BulkIndexError, esi._send_chunk, chunk, BulkSizer(), 0,
+                  errors='fail')
+    os.remove(path)
+    r = esi._send_chunk(chunk, BulkSizer(), 0, errors='dead-letter',
+                        dead_letter=dead)
+    assert_equal(r, (2, 2))
+    dead.flush()
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert_equal([r['doc'] for r in records], [{'n': 1}, {'n': 3}])
+    assert_equal(records[0]['error'], {'type': 'mapper_parsing'})
+
+def test_id_spec_ids_and_routing():
+    from transporter.docid import IdSpec, GNIP_ID
+    from transporter.metrics import METRICS
+    METRICS.reset()
+    doc = {'id': 'tag:search.twitter.com,2005:1234', 'n': 7,
+           'actor': {'id': 'id:twitter.com:55', 'lang': 'en'}}
+    cases = [
+        (IdSpec('id', GNIP_ID), {'_id': '1234'}),
+        (IdSpec('actor.id', r'\d+$', routing='actor.lang'),
+         {'_id': '55', '_routing': 'en'}),
+        (IdSpec('n'), {'_id': '7'}),
+        (IdSpec('actor.missing'), {}),
+        (IdSpec('n', 'x(y)'), {})
+    ]
+    for spec, expected in cases:
+        action = {}
+        spec.apply(doc, action)
+        assert_equal(action, expected)
+    assert_equal(METRICS.counters['missing_ids'], 2)
+
+    # content hashes ignore key order
+    first, second = {}, {}
+    IdSpec(hash='sha1').apply({'a': 1, 'b': [1, 2]}, first)
+    IdSpec(hash='sha1').apply(json.loads('{"b": [1, 2], "a": 1}'), second)
+    assert_equal(first, second)
+    assert_equal(len(first['_id']), 40)
+    assert_raises(ValueError, IdSpec, 'id', hash='sha1')
+    assert_raises(ValueError, IdSpec, hash='crc')
+
+class FakeIndices(object):
+    """ Index settings, with every call recorded. """
+
+    def __init__(self):
+        self.settings = {'index.number_of_replicas': '2'}
+        self.calls = []
+
+    def get_settings(self, index, flat_settings):
+        return {index: {'settings': dict(self.settings)}}
+
+    def put_settings(self, index, body):
+        self.calls.append('put')
+        for name, value in body.items():
+            if value is None:
+                self.settings.pop(name, None)
+            else:
+                self.settings[name] = value
+
+    def refresh(self, index):
+        self.calls.append('refresh')
+
+    def forcemerge(self, index, max_num_segments, request_timeout):
+        self.calls.append(('forcemerge', max_num_segments))
+
+def test_bulk_load_mode_restores_settings():
+    import os
+    import tempfile
+    from transporter.tools import ElasticPort
+    esi = ElasticPort('localhost:9200', False)
+    esi.es.indices = indices = FakeIndices()
+    state = os.path.join(tempfile.mkdtemp(), 'state.json')
+    original = dict(indices.settings)
+    with esi.bulk_load('idx', state, max_num_segments=1):
+        assert_equal(indices.settings, {'index.number_of_replicas': '0',
+                                        'index.refresh_interval': '-1'})
+        assert_true(os.path.exists(state))
+    assert_equal(indices.settings, original)
+    assert_equal(indices.calls, ['put', 'refresh', ('forcemerge', 1), 'put'])
+    assert_false(os.path.exists(state))
+
+    # a crashed load leaves the state file, and the next one reuses it
+    try:
+        with esi.bulk_load('idx', state, max_num_segments=1):
+            os.link(state, state + '.crash')
+            raise IOError('crash')
+    except IOError:
+        pass
+    assert_equal(indices.settings, original)
+    assert_equal(indices.calls[-1], 'put')
+    os.rename(state + '.crash', state)
+    indices.settings = {'index.number_of_replicas': '0',
+                        'index.refresh_interval': '-1'}
+    with esi.bulk_load('idx', state):
+        pass
+    assert_equal(indices.settings, original)
+    assert_raises(IOError, esi.restore, 'idx', state)
+
+    # another index's state file is refused before any settings change
+    with open(state, 'w') as f:
+        json.dump({'index': 'other', 'settings': {}}, f)
+    calls = len(indices.calls)
+    assert_raises(ValueError, esi.bulk_load('idx', state).__enter__)
+    assert_equal(len(indices.calls), calls)
+    assert_true(os.path.exists(state))
+
+class FakeMultipartUpload(object):
+
+    def __init__(self):
+        self.parts = []
+        self.completed = False
+
+    def upload_part_from_file(self, fp, part_num):
+        self.parts.append((part_num, fp.read()))
+
+    def complete_upload(self):
+        self.completed = True
+
+def test_multipart_writer_uploads_parts():
+    import gzip
+    import zlib
+    from transporter.tools import MultipartWriter
+    mp = FakeMultipartUpload()
+    writer = MultipartWriter(mp, part_size=1024)
+    f_out = gzip.GzipFile('data', 'wb', fileobj=writer)
+    data = ''.join('{"n": %d}\n' % (i * 7919 % 100003) for i in range(5000))
+    f_out.write(data)
+    f_out.close()
+    writer.close()
+    assert_true(mp.completed)
+    assert_true(len(mp.parts) > 1)
+    assert_equal([n for n, _ in mp.parts], range(1, len(mp.parts) + 1))
+    body = ''.join(part for _, part in mp.parts)
+    assert_equal(zlib.decompress(body, 16 + zlib.MAX_WBITS), data)
+
+class FakeS3Key(object):
+    """ An object in a FakeS3Bucket, taking parts and serving ranges. """
+
+    def __init__(self, bucket, name=None):
+        self.bucket = bucket
+        self.key = name
+
+    @property
+    def name(self):
+        return self.key
+
+    @property
+    def size(self):
+        return len(self.bucket.data[self.key])
+
+    def set_contents_from_filename(self, fname, replace=True):
+        with open(fname, 'rb') as f:
+            self.bucket.data[self.key] = f.read()
+        return True
+
+    def set_contents_from_file(self, fp, query_args=None, size=None, **kw):
+        args = dict(arg.split('=') for arg in query_args.split('&'))
+        part_num = int(args['partNumber'])
+        if (self.key, part_num) == self.bucket.fail_part:
+            raise IOError('part {0} failed'.format(part_num))
+        self.bucket.uploads[args['uploadId']].parts[part_num] = fp.read(size)
+
+    def get_contents_to_file(self, fp, headers=None):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        self.bucket.ranges.append((int(start), int(end)))
+        fp.write(self.bucket.data[self.key][int(start):int(end) + 1])
+
+    def get_contents_to_filename(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.bucket.data[self.key])
+
+class FakeS3Upload(object):
+
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = str(len(bucket.uploads))
+        self.parts = {}
+        self.state = 'started'
+
+    def complete_upload(self):
+        self.state = 'completed'
+        self.bucket.data[self.key_name] = ''.join(
+            self.parts[n] for n in sorted(self.parts))
+
+    def cancel_upload(self):
+        self.state = 'cancelled'
+
+    def upload_part_from_file(self, fp, part_num):
+        self.parts[part_num] = fp.read()
+
+class FakeS3Bucket(object):
+    """ Stands in for a boto bucket, and its connection, for S3Port. """
+
+    def __init__(self, name='b'):
+        self.name = name
+        self.data = {}
+        self.uploads = {}
+        self.ranges = []
+        self.fail_part = None
+
+    def create_bucket(self, bucket_name):
+        return self
+
+    def new_key(self, key_name=None):
+        return FakeS3Key(self, key_name)
+
+    def get_key(self, key_name):
+        return self.new_key(key_name) if key_name in self.data else None
+
+    def list(self, prefix=''):
+        return [self.new_key(name) for name in sorted(self.data)
+                if name.startswith(prefix)]
+
+    def initiate_multipart_upload(self, key_name):
+        upload = FakeS3Upload(self, key_name)
+        self.uploads[upload.id] = upload
+        return upload
+
+def _fake_s3(bucket):
+    from transporter.tools import S3Port
+    s3 = S3Port.__new__(S3Port)
+    s3.conn = bucket
+    s3._bucket = lambda bucket_name: bucket
+    s3._key = lambda bucket_name, key_name=None: bucket.new_key(key_name)
+    return s3
+
+def test_s3_multipart_upload_and_ranged_download():
+    import os
+    import tempfile
+    tmp = tempfile.mkdtemp()
+    big = os.path.join(tmp, 'big.json')
+    data = ''.join('{"n": %d}\n' % i for i in range(1000))
+    with open(big, 'wb') as f:
+        f.write(data)
+    with open(os.path.join(tmp, 'small.json'), 'wb') as f:
+        f.write('{"n": 0}\n')
+    bucket = FakeS3Bucket()
+    s3 = _fake_s3(bucket)
+    s3.upload('b', [big, os.path.join(tmp, 'small.json')], part_size=1000,
+              concurrency=3)
+    upload = bucket.uploads['0']
+    assert_equal(upload.state, 'completed')
+    assert_equal(sorted(upload.parts), range(1, len(data) // 1000 + 2))
+    assert_equal([len(upload.parts[n]) for n in sorted(upload.parts)][:-1],
+                 [1000] * (len(data) // 1000))
+    assert_equal(bucket.data['big.json'], data)
+    assert_equal(bucket.data['small.json'], '{"n": 0}\n')
+
+    # a failed part cancels its upload and those of the files after it,
+    # which are never completed
+    bigger = os.path.join(tmp, 'bigger.json')
+    with open(bigger, 'wb') as f:
+        f.write(data * 2)
+    bucket.fail_part = ('big.json', 2)
+    assert_raises(IOError, s3.upload, 'b', [big, bigger], replace_key=True,
+                  part_size=1000, concurrency=3)
+    assert_equal([bucket.uploads[n].state for n in ('1', '2')],
+                 ['cancelled', 'cancelled'])
+    assert_equal(bucket.data['big.json'], data)
+    assert_false('bigger.json' in bucket.data)
+
+    out = tempfile.mkdtemp()
+    s3.download('b', out, part_size=1000, concurrency=3)
+    with open(os.path.join(out, 'big.json'), 'rb') as f:
+        assert_equal(f.read(), data)
+    with open(os.path.join(out, 'small.json'), 'rb') as f:
+        assert_equal(f.read(), '{"n": 0}\n')
+    assert_equal(sorted(bucket.ranges), [
+        (start, min(start + 1000, len(data)) - 1)
+        for start in range(0, len(data), 1000)])
+
+def test_s3_port_uses_its_codec():
+
+    class SortedCodec(object):
+        name = 'sorted'
+        loads = staticmethod(json.loads)
+
+        def dumps(self, doc):
+            return json.dumps(doc, sort_keys=True, separators=(',', ':'))
+
+    bucket = FakeS3Bucket()
+    s3 = _fake_s3(bucket)
+    s3.codec = SortedCodec()
+    s3.write(iter([{'b': 1, 'a': 2}]), 'b/docs.json')
+    assert_equal(bucket.data['docs.json'], '{"a":2,"b":1}\n')
+
+def test_checkpoint_resume():
+    import os
+    import tempfile
+    from transporter.tools import JsonPort
+    from transporter.readers import LineReader
+    from transporter.checkpoint import Checkpoint
+    tmp = tempfile.mkdtemp()
+    files = []
+    for name in ('a.json', 'b.json'):
+        files.append(os.path.join(tmp, name))
+        with open(files[-1], 'w') as f:
+            f.writelines('{"f": "%s", "n": %d}\n' % (name, i)
+                         for i in range(5))
+    checkpoint = Checkpoint(os.path.join(tmp, 'ckpt'), interval=0)
+    docs = JsonPort(LineReader(files), workers=2, chunksize=3,
+                    checkpoint=checkpoint).parse()
+    for _ in range(7):
+        next(docs)
+    checkpoint.ack(6)
+    assert_equal(checkpoint.load(), {'file': files[1], 'offset': 24,
+                                     'line': 5})
+    resumed = list(JsonPort(LineReader(files, checkpoint.load())).parse())
+    assert_equal([(d['f'], d['n']) for d in resumed],
+                 [('b.json', n) for n in range(1, 5)])
+
+def test_checkpoint_ack_out_of_order():
+    import os
+    import tempfile
+    from transporter.checkpoint import Checkpoint
+    checkpoint = Checkpoint(os.path.join(tempfile.mkdtemp(), 'ckpt'),
+                            interval=3600)
+    for i in range(4):
+        checkpoint.track(('f', i * 10, i))
+    checkpoint.ack_seq(1)
+    assert_equal(checkpoint.position, None)
+    checkpoint.ack_seq(0)
+    checkpoint.ack_seq(3)
+    assert_equal(checkpoint.position, ('f', 10, 1))
+
+def test_mongo_add_batches_and_upserts():
+    import mongomock
+    from transporter.tools import MongoPort
+    mgi = MongoPort.__new__(MongoPort)
+    mgi.db = mongomock.MongoClient().db
+    docs = [{'key': i % 10, 'n': i} for i in range(25)]
+    mgi.add('tweets', iter(docs), batch_size=4, upsert_key='key')
+    assert_equal(mgi.db.tweets.count_documents({}), 10)
+    assert_equal(mgi.db.tweets.find_one({'key': 3})['n'], 23)
+    mgi.add('copies', iter(docs), batch_size=4, threads=3)
+    assert_equal(mgi.db.copies.count_documents({}), 25)
+
+def test_mongo_export_and_id_ranges():
+    import os
+    import datetime
+    import tempfile
+    import mongomock
+    import pymongo
+    from transporter import tools
+    client = mongomock.MongoClient()
+    original = pymongo.MongoClient
+    pymongo.MongoClient = lambda host: client
+    try:
+        mgi = tools.MongoPort('localhost', 'db')
+        mgi.db.tweets.insert_many([{'_id': i, 'lang': 'en' if i % 2 else 'fr',
+                                    'text': 't'} for i in range(100)])
+        mgi.collection = mgi.db.tweets
+        ranges = mgi._id_ranges({}, 4)
+        assert_equal(ranges, [{'$lt': 25}, {'$gte': 25, '$lt': 50},
+                              {'$gte': 50, '$lt': 75}, {'$gte': 75}])
+        path = os.path.join(tempfile.mkdtemp(), 'out.json')
+        mgi.export('tweets', path, {'lang': 'en'}, {'text': 0},
+                   batch_size=7)
+        with open(path) as f:
+            lines = f.readlines()
+        assert_equal(len(lines), 50)
+        assert_equal(json.loads(lines[0]), {'lang': 'en', '_id': 1})
+
+        # read gives plain JSON, for copies to file, Kafka or S3 sinks
+        from bson import ObjectId
+        oid = ObjectId()
+        mgi.db.dated.insert_one({'_id': oid, 'ref': {'id': oid},
+                                 'at': datetime.datetime(2020, 1, 2)})
+        doc, = mgi.read('dated')
+        assert_equal(doc, {'_id': str(oid), 'ref': {'id': {'$oid': str(oid)}},
+                           'at': {'$date': 1577923200000}})
+        json.dumps(doc)
+    finally:
+        pymongo.MongoClient = original
+
+class FakeHbaseTable(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scan(self, row_start=None, row_stop=None, columns=None,
+             batch_size=1000):
+        for key in sorted(self.rows):
+            if (row_start is None or key >= row_start) and \
+                    (row_stop is None or key < row_stop):
+                yield key, self.rows[key]
+
+    def regions(self):
+        return [{'start_key': '', 'end_key': 'm'},
+                {'start_key': 'm', 'end_key': 't'},
+                {'start_key': 't', 'end_key': ''}]
+
+    def batch(self):
+        table = self
+
+        class Batch(object):
+            def put(self, row, data):
+                table.rows[row] = data
+
+            def send(self):
+                pass
+        return Batch()
+
+def test_hbase_export_and_import():
+    import os
+    import tempfile
+    import happybase
+    from transporter import tools
+    from transporter.deadletter import DeadLetter
+    table = FakeHbaseTable({'apple': {'cf:n': '1'}, 'melon': {'cf:n': '2'},
+                            'zebra': {'cf:n': '3'}})
+
+    class FakeConnection(object):
+        def __init__(self, host):
+            pass
+
+        def table(self, name):
+            return table
+
+    original = happybase.Connection
+    happybase.Connection = FakeConnection
+    try:
+        hbi = tools.HbasePort('localhost')
+        assert_equal(hbi._key_ranges('t', 'b', 'u'),
+                     [('b', 'm'), ('m', 't'), ('t', 'u')])
+        path = os.path.join(tempfile.mkdtemp(), 'rows.json')
+        hbi.export('t', path, row_prefix='me')
+        with open(path) as f:
+            assert_equal([json.loads(l) for l in f],
+                         [{'row': 'melon', 'columns': {'cf:n': '2'}}])
+        hbi.add('t', [{'row': 'kiwi', 'columns': {'cf:n': '4'}}])
+        hbi.add('t', [{'id': 7, 'tags': ['a']}], row_key='id', family='d')
+        assert_equal(table.rows['kiwi'], {'cf:n': '4'})
+        assert_equal(table.rows['7'], {'d:tags': '["a"]'})
+
+        # rows that aren't UTF-8 are base64 encoded, and decoded on import
+        table.rows['\x00\xff'] = {'cf:\xfe': '\x01\xff'}
+        hbi.export('t', path, row_stop='0')
+        with open(path) as f:
+            rows = [json.loads(l) for l in f]
+        assert_equal(rows, [{'row': 'AP8=', 'encoding': 'base64',
+                             'columns': {'Y2Y6/g==': 'Af8='}}])
+        del table.rows['\x00\xff']
+        hbi.add('t', rows)
+        assert_equal(table.rows['\x00\xff'], {'cf:\xfe': '\x01\xff'})
+        hbi.export('t', path, row_prefix='me', encoding='base64')
+        with open(path) as f:
+            assert_equal(json.loads(f.read())['row'], 'bWVsb24=')
+        assert_raises(ValueError, hbi.export, 't', path, encoding='latin-1')
+
+        # non-ASCII field names, and docs that can't be made into rows
+        docs = [{'id': 'r1', u'caf\xe9': 'x'}, {'n': 1}, {'row': 'r2'}]
+        hbi.add('t', iter(docs), row_key='id', family='d')
+        assert_equal(table.rows['r1'], {'d:caf\xc3\xa9': 'x'})
+        assert_raises(ValueError, hbi.add, 't', iter(docs), errors='fail')
+        dead = DeadLetter(os.path.join(tempfile.mkdtemp(), 'dead.json'))
+        hbi.add('t', iter(docs[1:]), errors='dead-letter', dead_letter=dead)
+        assert_equal(dead.count, 2)
+    finally:
+        happybase.Connection = original
+
+def test_rotating_writer():
+    import os
+    import tempfile
+    from transporter.tools import RotatingWriter
+    tmp = tempfile.mkdtemp()
+    out = RotatingWriter(os.path.join(tmp, 'msgs.json'), rotate=3)
+    out.writelines(['%d\n' % i for i in range(5)])
+    out.writelines(['5\n'])
+    out.close()
+    assert_equal(sorted(os.listdir(tmp)), ['msgs-000.json', 'msgs-001.json'])
+    with open(os.path.join(tmp, 'msgs-001.json')) as f:
+        assert_equal(f.read(), '3\n4\n5\n')
+    assert_equal(out.written, 6)
+
+def test_kafka_consume_commits_offsets():
+    import os
+    import tempfile
+    from transporter.tools import KafkaPort
+
+    class Message(object):
+        def __init__(self, value):
+            self.value = value
+
+    class FakeConsumer(object):
+        def __init__(self):
+            self.commits = []
+            self.consumed = 0
+
+        def __iter__(self):
+            for i in range(10):
+                self.consumed = i + 1
+                yield Message('{"n": %d}' % i) if i != 4 else None
+
+        def commit_offsets(self):
+            self.commits.append(self.consumed)
+
+        def stop(self):
+            pass
+
+    class FakeTopic(object):
+        def get_balanced_consumer(self, **kwargs):
+            return consumer
+
+    consumer = FakeConsumer()
+    kai = KafkaPort.__new__(KafkaPort)
+    kai.logger = logging.getLogger()
+    kai.client = type('FakeClient', (object,), {'topics': {'t': FakeTopic()}})
+    path = os.path.join(tempfile.mkdtemp(), 'out.json')
+    kai.consume('t', path, group='g', count=7, batch_size=3)
+    with open(path) as f:
+        assert_equal(len(f.readlines()), 7)
+    assert_equal(consumer.commits, [3, 7, 8])
+
+def test_kafka_offsets_committed_once_indexed():
+    from transporter.tools import KafkaPort, ElasticPort, JsonPort
+    from transporter.checkpoint import OffsetCheckpoint
+    from elasticsearch.serializer import JSONSerializer
+
+    class Message(object):
+        def __init__(self, partition, offset):
+            self.partition = partition
+            self.offset = offset
+            self.value = '{"id": "a:b:%s-%d"}' % (partition, offset)
+
+    class FakeConsumer(object):
+        def __init__(self):
+            self.committed = {}
+            self.checks = []
+
+        def __iter__(self):
+            for i in range(2300):
+                yield Message('p%d' % (i % 2), i // 2)
+
+        def commit_offsets(self, partition_offsets=None):
+            self.committed.update(partition_offsets or {'p0': 1150,
+                                                        'p1': 1150})
+            self.checks.append((sum(self.committed.values()), es.indexed))
+
+        def stop(self):
+            pass
+
+    class FakeTopic(object):
+        def get_balanced_consumer(self, **kwargs):
+            return consumer
+
+    class CountingClient(object):
+        indexed = 0
+        transport = type('FakeTransport', (object,),
+                         {'serializer': JSONSerializer()})
+
+        def bulk(self, body, *args, **kwargs):
+            items = [{'index': {'status': 201}}
+                     for _ in body.splitlines()[::2]]
+            self.indexed += len(items)
+            return {'items': items}
+
+    consumer = FakeConsumer()
+    es = CountingClient()
+    kai = KafkaPort.__new__(KafkaPort)
+    kai.client = type('FakeClient', (object,), {'topics': {'t': FakeTopic()}})
+    esi = ElasticPort('localhost:9200', False)
+    esi.es = es
+    checkpoint = OffsetCheckpoint(kai.commit)
+    docs = JsonPort(kai.reader('t', 'g'), checkpoint=checkpoint).parse()
+    esi.index(docs, 'idx', 'tweet', chunksize=500, checkpoint=checkpoint)
+    kai.close()
+    assert_equal(consumer.checks, [(1000, 1000), (2000, 2000),
+                                   (2300, 2300), (2300, 2300)])
+
+def test_kafka_produce_counts_delivery_reports():
+    from Queue import Queue
+    from transporter.tools import KafkaPort
+    from transporter.codec import get_codec
+    from transporter.metrics import METRICS
+
+    class FakeProducer(object):
+        def __init__(self, **options):
+            self.options = options
+            self.reports = Queue()
+            self.keys = []
+
+        def produce(self, message, partition_key=None):
+            msg = object()
+            self.keys.append(partition_key)
+            self.reports.put((msg, None if len(self.keys) % 3 else 'lost'))
+            return msg
+
+        def get_delivery_report(self, block=True):
+            return self.reports.get(block)
+
+        def stop(self):
+            pass
+
+    class FakeTopic(object):
+        def get_producer(self, **options):
+            return FakeProducer(**options)
+
+    kai = KafkaPort.__new__(KafkaPort)
+    kai.logger = logging.getLogger()
+    kai.codec = get_codec('json')
+    kai.client = type('FakeClient', (object,), {'topics': {'t': FakeTopic()}})
+    METRICS.reset()
+    kai.produce('t', [{'user': u} for u in ('a', 'b', None, 'c')], key='user',
+                compression='snappy', linger_ms=50)
+    assert_equal((kai.delivered, kai.failed), (3, 1))
+    assert_equal((METRICS.counters['docs_written'],
+                  METRICS.counters['write_errors']), (3, 1))
+    assert_equal(kai.producer.keys, ['a', 'b', None, 'c'])
+    assert_equal(kai.producer.options['compression'], 2)
+    assert_equal(kai.producer.options['linger_ms'], 50)
+    kai.produce('t', [{'user': {'id': 5}}, {'user': 'x'}], key='user.id')
+    assert_equal(kai.producer.keys, ['5', None])
+    assert_raises(ValueError, kai.produce, 't', [], compression='brotli')
+
+def test_copy_streams_file_to_file():
+    import os
+    import tempfile
+    from transporter.pipeline import copy, parse_uri
+    from transporter.tools import JsonPort
+    assert_equal(parse_uri('in.json'), ('file', None, 'in.json'))
+    assert_equal(parse_uri('es://es1:9200/idx/doc'),
+                 ('es', 'es1:9200', 'idx/doc'))
+    assert_equal(parse_uri('mongo:///db/coll'), ('mongo', None, 'db/coll'))
+    assert_raises(ValueError, parse_uri, 'ftp://host/file')
+
+    tmp = tempfile.mkdtemp()
+    src, dst = os.path.join(tmp, 'in.json'), os.path.join(tmp, 'out.json')
+    with open(src, 'w') as f:
+        f.writelines('{"n": %d}\n' % i for i in range(1234))
+    port = JsonPort(None)
+    copy(port.read(src), lambda docs: port.write(docs, dst), queue_size=2,
+         batch_size=100)
+    assert_equal(list(JsonPort(None).read(dst)),
+                 [{'n': i} for i in range(1234)])
+
+    # bad lines fail a copy unless the error policy says otherwise
+    with open(src, 'a') as f:
+        f.write('{"n": \n{"n": 1234}\n')
+    assert_raises(ValueError, list, JsonPort(None).read(src))
+    assert_equal(len(list(JsonPort(None).read(src, errors='skip'))), 1235)
+    assert_raises(ValueError, JsonPort(None).read, src, errors='dead-letter')
+
+    def broken():
+        yield {'n': 0}
+        raise IOError('source went away')
+    written = []
+    assert_raises(IOError, copy, broken(), written.extend)
+    assert_equal(written, [{'n': 0}])
+
+class FakeScrollClient(object):
+    """ Pages through 25 docs, honouring a sliced scroll. """
+
+    def __init__(self, *args, **kwargs):
+        self.pages = {}
+
+    def search(self, body=None, index=None, doc_type=None, scroll=None,
+               size=10, **kwargs):
+        docs = range(25)
+        if body and 'slice' in body:
+            docs = [n for n in docs
+                    if n % body['slice']['max'] == body['slice']['id']]
+        hits = [{'_id': str(n), '_index': index, '_source': {'n': n}}
+                for n in docs]
+        pages = [hits[i:i + size] for i in range(0, len(hits), size)]
+        self.pages[str(id(pages))] = pages
+        return self.scroll(scroll_id=str(id(pages)))
+
+    def scroll(self, body=None, scroll_id=None, **kwargs):
+        scroll_id = scroll_id or body['scroll_id']
+        pages = self.pages[scroll_id]
+        hits = pages.pop(0) if pages else []
+        return {'_scroll_id': scroll_id, '_shards': {'successful': 1,
+                'total': 1, 'skipped': 0}, 'hits': {'hits': hits}}
+
+    def clear_scroll(self, *args, **kwargs):
+        pass
+
+def test_es_sliced_export():
+    import os
+    import tempfile
+    import elasticsearch
+    from transporter import tools
+    original = elasticsearch.Elasticsearch
+    elasticsearch.Elasticsearch = FakeScrollClient
+    try:
+        esi = tools.ElasticPort('localhost:9200', False)
+        assert_equal([hit['_source']['n'] for hit in
+                      esi.query('idx', size=4)], range(25))
+        path = os.path.join(tempfile.mkdtemp(), 'out.json')
+        esi.export('idx', path, size=4, workers=3)
+        docs = []
+        for idx in range(3):
+            with open(tools._shard_path(path, idx, False)) as f:
+                docs.extend(json.loads(line)['n'] for line in f)
+        assert_equal(sorted(docs), range(25))
+        esi.export('idx', path, size=4, meta=True)
+        with open(path) as f:
+            assert_equal(json.loads(f.readline())['_id'], '0')
+    finally:
+        elasticsearch.Elasticsearch = original
+
+def test_prefetcher_reads_ahead_in_order():
+    import threading
+    from transporter.pipeline import Prefetcher
+    read = []
+
+    def docs():
+        for n in range(100):
+            read.append(n)
+            yield {'n': n}
+    prefetched = Prefetcher(docs(), queue_size=2, batch_size=10)
+    it = iter(prefetched)
+    assert_equal(next(it), {'n': 0})
+    # the reader runs ahead of the consumer, up to the queue bound
+    prefetched.reader.join(0.5)
+    assert_true(20 <= len(read) <= 40)
+    assert_equal([doc['n'] for doc in it if doc['n'] < 3], [1, 2])
+
+def test_prefetcher_reraises_reader_errors():
+    from transporter.pipeline import Prefetcher
+
+    def docs():
+        yield 1
+        raise IOError('truncated input')
+    assert_raises(IOError, list, Prefetcher(docs()))
+
+def test_metrics_summary_and_prometheus():
+    from transporter.metrics import Metrics, METRICS
+    from transporter.tools import JsonPort
+    metrics = Metrics(total_bytes=1000)
+    for seconds in (0.002, 0.02, 0.02, 0.2, 3.0):
+        metrics.observe('es_request_seconds', seconds)
+    metrics.incr('docs_written', 5)
+    summary = metrics.summary()
+    hist = summary['histograms']['es_request_seconds']
+    assert_equal((hist['count'], hist['p50'], hist['max']), (5, 0.025, 3.0))
+    assert_almost_equal(summary['network_seconds'], 3.242)
+    prom = metrics.prometheus()
+    assert_true('tport_docs_written_total 5.0' in prom)
+    assert_true('tport_es_request_seconds_bucket{le="0.025"} 3' in prom)
+    assert_true('tport_es_request_seconds_count 5' in prom)
+
+    METRICS.reset()
+    lines = ['{"n": %d}\n' % i for i in range(2500)] + ['oops\n']
+    list(JsonPort(lines, ignore_errors=True).parse())
+    counters = METRICS.summary()['counters']
+    assert_equal(counters['docs_read'], 2500)
+    assert_equal(counters['parse_errors'], 1)
+    assert_equal(counters['bytes_read'], sum(len(line) for line in lines))
+    assert_true('2500 read' in METRICS.progress())
+
+def test_mapped_blocks_decode_like_serial_parse():
+    import os
+    import tempfile
+    from transporter.tools import JsonPort
+    from transporter.readers import LineReader
+    from transporter.checkpoint import Checkpoint
+    tmp = tempfile.mkdtemp()
+    paths = [os.path.join(tmp, 'a.json'), os.path.join(tmp, 'b.json')]
+    with open(paths[0], 'w') as f:
+        f.writelines('{"n": %d}\n' % i for i in range(300))
+        f.write('not json\n')
+    with open(paths[1], 'w') as f:
+        f.write('{"n": 300}\n{"n": 301}')
+    blocks = list(LineReader(paths).blocks(block_size=512))
+    assert_equal(blocks[0], (paths[0], 0, 520))
+    assert_equal(blocks[-1], (paths[1], 0, 21))
+    assert_true(LineReader(paths).mappable())
+    assert_false(LineReader(['-']).mappable())
+
+    positions = []
+    for workers in (1, 3):
+        cp = Checkpoint(os.path.join(tmp, 'cp'))
+        port = JsonPort(LineReader(paths), ignore_errors=True,
+                        workers=workers, checkpoint=cp)
+        assert_equal([doc['n'] for doc in port.parse()], range(302))
+        positions.append(list(cp.positions))
+    assert_equal(positions[0], positions[1])
+    assert_equal(positions[1][-1], (paths[1], 21, 302))
+
+    start = {'file': paths[0], 'offset': positions[0][149][1], 'line': 149}
+    resumed = JsonPort(LineReader(paths, start), ignore_errors=True,
+                       workers=2).parse()
+    assert_equal([doc['n'] for doc in resumed], range(150, 302))
+
+def test_compressed_inputs_across_members():
+    import os
+    import bz2
+    import gzip
+    import tempfile
+    from io import BytesIO
+    from transporter.readers import LineReader, compression, inflate
+    from transporter.tools import JsonPort
+    lines = ['{"n": %d}\n' % i for i in range(2000)]
+    halves = ''.join(lines[:1000]), ''.join(lines[1000:])
+
+    def gz(data):
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as g:
+            g.write(data)
+        return buf.getvalue()
+    tmp = tempfile.mkdtemp()
+    members = {'gz': ''.join(gz(half) for half in halves),
+               'bz2': ''.join(bz2.compress(half) for half in halves)}
+    for kind, data in members.items():
+        # no extension, so the compression is sniffed from magic bytes
+        path = os.path.join(tmp, kind)
+        with open(path, 'wb') as f:
+            f.write(data)
+        assert_equal(compression(path), kind)
+        assert_false(LineReader([path]).mappable())
+        docs = JsonPort(LineReader([path]), workers=2).parse()
+        assert_equal([doc['n'] for doc in docs], range(2000))
+        chunks = (data[i:i + 7] for i in range(0, len(data), 7))
+        assert_equal(''.join(inflate(chunks, kind)), ''.join(halves))
+
+    start = {'file': path, 'offset': len(halves[0]), 'line': 999}
+    assert_equal(list(LineReader([path], start)), lines[1000:])
+
+def test_fifo_inputs_are_read_once():
+    import os
+    import bz2
+    import tempfile
+    import threading
+    from transporter.readers import LineReader
+    from transporter.tools import JsonPort
+    fifo = os.path.join(tempfile.mkdtemp(), 'docs')
+    os.mkfifo(fifo)
+    lines = '{"a": 1}\n{"a": 2}\n'
+    for data in (lines, bz2.compress(lines)):
+        def feed():
+            with open(fifo, 'wb') as f:
+                f.write(data)
+        writer = threading.Thread(target=feed)
+        writer.start()
+        assert_equal(list(JsonPort(LineReader([fifo])).parse()),
+                     [{'a': 1}, {'a': 2}])
+        writer.join()
+
+def test_zstd_reads_every_frame():
+    import struct
+    try:
+        import zstandard
+    except ImportError:
+        from nose import SkipTest
+        raise SkipTest('zstandard is not installed')
+    from transporter.readers import inflate
+    data = 'x' * 300000 + '\n'
+    frames = zstandard.ZstdCompressor(write_checksum=True).compress(data) + \
+        struct.pack('<II', 0x184D2A50, 3) + 'abc' + \
+        zstandard.ZstdCompressor().compress('{"n": 1}\n')
+    chunks = (frames[i:i + 5] for i in range(0, len(frames), 5))
+    assert_equal(''.join(inflate(chunks, 'zst')), data + '{"n": 1}\n')
+
+class FakeS3Objects(object):
+    """ Serves objects for LineReader s3:// inputs, in small ranges. """
+
+    def __init__(self, objects):
+        self.data = objects
+        self.requests = []
+
+    def objects(self, uri):
+        return [(name, len(self.data[name])) for name in sorted(self.data)
+                if name.startswith(uri)]
+
+    def stream(self, uri, size, start=0):
+        self.requests.append((uri, start))
+        for pos in range(start, size, 1000):
+            yield self.data[uri][pos:pos + 1000]
+
+def test_s3_inputs_stream_and_resume():
+    import bz2
+    from transporter.readers import LineReader
+    lines = ['{"n": %d}\n' % i for i in range(3000)]
+    thirds = [''.join(lines[i:i + 1000]) for i in (0, 1000, 2000)]
+    s3 = FakeS3Objects({'s3://b/p/a': thirds[0],
+                        's3://b/p/b': bz2.compress(thirds[1]),
+                        's3://b/p/c.json': thirds[2]})
+    assert_equal(list(LineReader(['s3://b/p/'], s3=s3)), lines)
+    assert_raises(ValueError, list, LineReader(['s3://b/p/']))
+
+    # plain objects are entered at the offset, compressed ones skip to it
+    for name, third in (('s3://b/p/c.json', 2), ('s3://b/p/b', 1)):
+        offset = len(''.join(lines[third * 1000:third * 1000 + 500]))
+        start = {'file': name, 'offset': offset, 'line': third * 1000 + 499}
+        reader = LineReader(['s3://b/p/'], start, s3=s3)
+        assert_equal(list(reader), lines[third * 1000 + 500:])
+        assert_equal(reader.position, ('s3://b/p/c.json', len(thirds[2]),
+                                       2999))
+    assert_true(any(uri == 's3://b/p/c.json' and start
+                    for uri, start in s3.requests))
+
+def test_ports_import_their_client_lazily():
+    import sys
+    import subprocess
+    code = ('import sys, transporter.tport; '
+            'print [m for m in ("elasticsearch", "boto", "pymongo", '
+            '"happybase", "pykafka") if m in sys.modules]')
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert_equal(out.strip(), '[]')
+
+def test_transform_filters_and_reshapes():
+    from transporter.transform import Transform, get_transform
+    doc = {'id': 1, 'lang': 'en', 'count': '12',
+           'actor': {'id': 'a', 'bio': 'x' * 100, 'langs': ['en']},
+           'urls': [{'url': 'u', 'expanded': 'e'}]}
+    t = Transform('lang == en and count exists', {'count': 'int'},
+                  ['id', 'count', 'actor', 'urls.url'], ['actor.bio'],
+                  {'actor.id': 'user'})
+    assert_equal(t(dict(doc)), {'id': 1, 'count': 12, 'user': 'a',
+                                'actor': {'langs': ['en']},
+                                'urls': [{'url': 'u'}]})
+    assert_equal(t(dict(doc, lang='fr')), None)
+    assert_raises(ValueError, t, dict(doc, count='many'))
+    assert_equal(Transform(flatten='.')({'a': {'b': 1, 'c': {}}}),
+                 {'a.b': 1, 'a.c': {}})
+    assert_equal(Transform('n in [1, 2]')({'n': 3}), None)
+    song = {'t': 'rock and roll', 'n': 2}
+    assert_equal(Transform('t == "rock and roll" and n > 1')(song), song)
+    assert_equal(Transform(rename={'a.b': 'c', 'x': 'y'})({'a': {'b': None}}),
+                 {'a': {}, 'c': None})
+    assert_raises(ValueError, Transform, 'lang is en')
+    assert_false(Transform())
+    assert_equal(get_transform(t.spec).spec, t.spec)
+
+def test_transform_runs_in_decode_workers():
+    from transporter.tools import JsonPort
+    from transporter.transform import Transform
+    from transporter.metrics import METRICS
+    lines = ['{"n": %d, "big": "%s"}\n' % (i, 'x' * 50) for i in range(100)]
+    lines[7] = '{"n": "seven"}\n'
+    t = Transform('n < 50', {'n': 'int'}, exclude=['big'])
+    for workers in (1, 3):
+        METRICS.reset()
+        docs = list(JsonPort(lines, errors='skip', workers=workers,
+                             chunksize=10, transform=t).parse())
+        assert_equal(docs, [{'n': i} for i in range(50) if i != 7])
+        assert_equal(METRICS.counters['docs_filtered'], 50)
+        assert_equal(METRICS.counters['parse_errors'], 1)
+    assert_raises(ValueError, list, JsonPort(lines, transform=t).raw())
@@ -0,0 +1,122 @@
+""" Checkpoints for resumable ingestion. """
+
+import os
+import json
+import time
+import collections
+
+
+class Checkpoint(object):
+    """ Records the input position of the last document a sink has
+        acknowledged, so an interrupted job can resume from there instead of
+        starting over.
+
+        The reader calls :meth:`track` for every document it hands out, in
+        order.  The sink calls :meth:`ack` once documents are safely written
+        in order, or :meth:`ack_seq` with a document's sequence number when
+        acknowledgements arrive out of order; only the position before the
+        first unacknowledged document is ever saved.
+
+        :param str path: checkpoint file
+        :param float interval: least number of seconds between saves
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.positions = collections.deque()
+        self.acked = 0
+        self.done = set()
+        self.position = None
+        self.saved = 0
+
+    def load(self):
+        """ Returns the saved position as a dict with ``file``, ``offset``
+            and ``line``, or None if there is no checkpoint.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def track(self, position):
+        """ Record the position of the next document handed to the sink.
+
+            :param tuple position: ``(file, byte offset, line number)``
+        """
+        self.positions.append(position)
+
+    def ack(self, count=1):
+        """ Acknowledge the next ``count`` documents, in order.
+
+            :param int count: number of documents written
+        """
+        for _ in xrange(count):
+            self.position = self.positions.popleft()
+        self.acked += count
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def ack_seq(self, seq):
+        """ Acknowledge a single document by sequence number, counting from
+            0 in the order the documents were tracked.
+
+            :param int seq: sequence number of the document written
+        """
+        self.done.add(seq)
+        count = 0
+        while self.acked + count in self.done:
+            self.done.remove(self.acked + count)
+            count += 1
+        if count:
+            self.ack(count)
+
+    def save(self):
+        """ Write the last acknowledged position to the checkpoint file. """
+        if self.position is None:
+            return
+        fname, offset, line = self.position
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'file': fname, 'offset': offset, 'line': line}, f)
+        os.rename(tmp, self.path)
+        self.saved = time.time()
+
+
+class OffsetCheckpoint(Checkpoint):
+    """ A checkpoint for docs read from a Kafka consumer group, which
+        commits offsets instead of writing a file.  Positions are the
+        ``(partition, offset)`` of each message, and only the offsets of
+        messages the sink has acknowledged are committed, every ``every``
+        docs and on :meth:`save`, so nothing that is still in flight is
+        ever committed.
+
+        :param commit: called with a list of ``(partition, next offset)``
+                       pairs to commit, see :meth:`KafkaPort.commit`
+        :param int every: acknowledged docs between commits
+    """
+
+    def __init__(self, commit, every=1000):
+        Checkpoint.__init__(self, None, interval=0)
+        self.commit = commit
+        self.every = every
+        self.offsets = {}
+        self.committed = 0
+
+    def load(self):
+        return None
+
+    def ack(self, count=1):
+        for _ in xrange(count):
+            partition, offset = self.position = self.positions.popleft()
+            self.offsets[partition] = offset + 1
+        self.acked += count
+        if self.acked - self.committed >= self.every:
+            self.save()
+
+    def save(self):
+        """ Commit the offsets after the last acknowledged messages. """
+        if self.offsets:
+            self.commit(self.offsets.items())
+            self.offsets = {}
+        self.committed = self.acked
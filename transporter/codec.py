@@ -0,0 +1,126 @@
+""" JSON codec backends.
+
+    Every port encodes and decodes JSON through a codec returned by
+    :func:`get_codec`, so a faster library can be swapped in for the stdlib
+    ``json`` module without touching the ports themselves.
+"""
+
+import json
+import logging
+
+# fastest first; ``auto`` picks the first one that is installed
+CODEC_NAMES = ('orjson', 'ujson', 'simplejson', 'json')
+
+_codecs = {}
+
+
+class JsonCodec(object):
+    """ Codec backed by the stdlib ``json`` module. """
+
+    name = 'json'
+
+    def loads(self, s):
+        """ Decode a JSON document.
+
+            :param str s: serialized JSON
+        """
+        return json.loads(s)
+
+    def dumps(self, obj, default=None):
+        """ Encode a JSON document.
+
+            :param obj: object to serialize
+            :param default: called for objects that can't otherwise be
+                            serialized
+        """
+        return json.dumps(obj, default=default)
+
+
+class SimpleJsonCodec(JsonCodec):
+    """ Codec backed by ``simplejson``. """
+
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.lib = simplejson
+
+    def loads(self, s):
+        return self.lib.loads(s)
+
+    def dumps(self, obj, default=None):
+        return self.lib.dumps(obj, default=default)
+
+
+class UJsonCodec(JsonCodec):
+    """ Codec backed by ``ujson``.  Older releases have no ``default`` hook,
+        so it is only passed along when given.
+    """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.lib = ujson
+
+    def loads(self, s):
+        return self.lib.loads(s)
+
+    def dumps(self, obj, default=None):
+        if default is None:
+            return self.lib.dumps(obj)
+        return self.lib.dumps(obj, default=default)
+
+
+class OrJsonCodec(JsonCodec):
+    """ Codec backed by ``orjson``, which encodes to bytes. """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.lib = orjson
+
+    def loads(self, s):
+        return self.lib.loads(s)
+
+    def dumps(self, obj, default=None):
+        return self.lib.dumps(obj, default=default).decode('utf-8')
+
+
+CODECS = {
+    'orjson': OrJsonCodec,
+    'ujson': UJsonCodec,
+    'simplejson': SimpleJsonCodec,
+    'json': JsonCodec
+}
+
+
+def get_codec(name='auto'):
+    """ Return a codec by name.  ``auto`` picks the fastest installed
+        library.  A named library that isn't installed falls back to the
+        stdlib ``json`` module with a warning.
+
+        :param str name: one of ``auto``, ``orjson``, ``ujson``,
+                         ``simplejson`` or ``json``
+    """
+    name = name or 'auto'
+    if name in _codecs:
+        return _codecs[name]
+    if name == 'auto':
+        candidates = CODEC_NAMES
+    elif name in CODECS:
+        candidates = (name, 'json')
+    else:
+        raise ValueError('unknown JSON codec {0}, use one of: auto, {1}'
+                         .format(name, ', '.join(CODEC_NAMES)))
+    for candidate in candidates:
+        try:
+            codec = CODECS[candidate]()
+        except ImportError:
+            if name != 'auto':
+                logging.warning('{0} is not installed, falling back to '
+                                'json'.format(name))
+            continue
+        _codecs[name] = codec
+        return codec
@@ -0,0 +1,89 @@
+""" Error policies and dead-letter files for input that can't be loaded. """
+
+import threading
+
+from codec import get_codec
+from metrics import METRICS
+
+# what to do with a bad input line or a doc the sink rejects
+POLICIES = ('skip', 'fail', 'dead-letter')
+
+
+def check_policy(errors, dead_letter=None):
+    """ Raise a ValueError for an unknown error policy, or a dead-letter
+        policy without a file to write to.
+
+        :param str errors: ``skip``, ``fail`` or ``dead-letter``
+        :param DeadLetter dead_letter: dead-letter file
+    """
+    if errors not in POLICIES:
+        raise ValueError('errors must be one of {0}, not {1}'.format(
+                         ', '.join(POLICIES), errors))
+    if errors == 'dead-letter' and dead_letter is None:
+        raise ValueError('the dead-letter policy needs a dead-letter file')
+
+
+class DeadLetter(object):
+    """ Appends what could not be loaded to a JSON lines file, one record
+        per line, so it can be fixed and loaded again later instead of
+        rerunning the whole job.  Every record has an ``error``, and either
+        the bad input ``line`` with its ``line_number`` and, if known, the
+        ``file`` and byte ``offset`` it starts at, or the rejected ``doc``
+        with the ``index``, ``id`` and ``status`` it was rejected with.
+
+        Records are buffered and written in batches, from any thread; call
+        :meth:`flush` once done.
+
+        :param str path: file to append to
+        :param int batch_size: records to buffer between writes
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
+    """
+
+    def __init__(self, path, batch_size=500, codec=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.codec = codec or get_codec()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.count = 0
+
+    def add(self, record):
+        """ Add a record.
+
+            :param dict record: what failed and why
+        """
+        data = self.codec.dumps(record) + '\n'
+        with self.lock:
+            self.pending.append(data)
+            self.count += 1
+            if len(self.pending) >= self.batch_size:
+                self._write()
+        METRICS.incr('dead_letters')
+
+    def line(self, idx, line, error, position=None):
+        """ Add a bad input line.
+
+            :param int idx: line number
+            :param line: the offending line, bytes or unicode
+            :param error: decoding error or its message
+            :param tuple position: input position after the line
+        """
+        text = line.rstrip('\r\n')
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        record = {'error': str(error), 'line_number': idx, 'line': text}
+        if position:
+            record['file'] = position[0]
+            record['offset'] = position[1] - len(line)
+        self.add(record)
+
+    def flush(self):
+        """ Write the buffered records. """
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        if self.pending:
+            with open(self.path, 'a') as f:
+                f.writelines(self.pending)
+            self.pending = []
@@ -0,0 +1,129 @@
+""" Document ids and routing for bulk indexing. """
+
+import re
+import json
+import hashlib
+import functools
+
+from metrics import METRICS
+
+# what ``bulkgen`` always did: the part after the second colon of a Gnip
+# tweet id, eg ``tag:search.twitter.com,2005:1234`` -> ``1234``
+GNIP_ID = r'^[^:]*:[^:]*:([^:]*)'
+
+HASHES = ('sha1', 'md5', 'xxhash')
+
+
+def getter(path):
+    """ Returns a function that looks up a dotted field path in a doc, eg
+        ``actor.id``, and returns None where the path doesn't exist.
+
+        :param str path: field path
+    """
+    keys = path.split('.')
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda doc: doc.get(key)
+
+    def get(doc):
+        for key in keys:
+            if not isinstance(doc, dict):
+                return None
+            doc = doc.get(key)
+        return doc
+    return get
+
+
+def _text(value):
+    """ Returns a field value as an id string. """
+    return value if isinstance(value, basestring) else str(value)
+
+
+def _field_id(get, regex=None):
+    """ Returns a function taking the id from a field, cut out of its value
+        by the first group of a regex, or the whole match if it has none.
+    """
+    if regex is None:
+        def field_id(doc):
+            value = get(doc)
+            return None if value is None else _text(value)
+        return field_id
+    group = 1 if regex.groups else 0
+
+    def regex_id(doc):
+        value = get(doc)
+        if value is None:
+            return None
+        match = regex.search(_text(value))
+        return match.group(group) if match else None
+    return regex_id
+
+
+def _hash_id(name):
+    """ Returns a function hashing the canonical JSON of a doc, with sorted
+        keys and no whitespace, so the same doc always gets the same id
+        whatever codec or key order it was read with.
+    """
+    if name == 'xxhash':
+        try:
+            import xxhash
+        except ImportError:
+            raise ImportError('xxhash ids need the xxhash package')
+        new = xxhash.xxh64
+    elif name in HASHES:
+        new = getattr(hashlib, name)
+    else:
+        raise ValueError('id hash must be one of {0}, not {1}'.format(
+                         ', '.join(HASHES), name))
+    dumps = functools.partial(json.dumps, sort_keys=True,
+                              separators=(',', ':'))
+
+    def hash_id(doc):
+        return new(dumps(doc)).hexdigest()
+    return hash_id
+
+
+class IdSpec(object):
+    """ How bulk actions get their ``_id`` and ``_routing``.  The spec is
+        compiled into plain functions once, and :meth:`apply` runs them for
+        every doc.  Docs the id can't be found for are indexed with an id
+        Elasticsearch makes up, and counted in the ``missing_ids`` metric.
+
+        :param str field: dotted path of the field holding the id
+        :param str regex: pattern cutting the id out of the field value; the
+                          first group, or the whole match if it has none
+        :param str hash: hash the doc instead, ``sha1``, ``md5`` or
+                         ``xxhash``, so re-runs overwrite rather than
+                         duplicate
+        :param str routing: dotted path of the field to route docs by
+    """
+
+    def __init__(self, field=None, regex=None, hash=None, routing=None):
+        if field and hash:
+            raise ValueError('ids come from a field or a hash, not both')
+        if regex and not field:
+            raise ValueError('an id regex needs a field to apply to')
+        self.make_id = None
+        if field:
+            self.make_id = _field_id(getter(field),
+                                     re.compile(regex) if regex else None)
+        elif hash:
+            self.make_id = _hash_id(hash)
+        self.routing = getter(routing) if routing else None
+
+    def apply(self, doc, action):
+        """ Set the ``_id`` and ``_routing`` of a bulk action.
+
+            :param dict doc: the doc
+            :param dict action: its bulk action
+        """
+        if self.make_id is not None:
+            _id = self.make_id(doc)
+            if _id is None:
+                METRICS.incr('missing_ids')
+            else:
+                action['_id'] = _id
+        if self.routing is not None:
+            routing = self.routing(doc)
+            if routing is not None:
+                action['_routing'] = _text(routing)
@@ -0,0 +1,46 @@
+""" Elasticsearch client plumbing for :class:`transporter.tools.ElasticPort`.
+    Kept apart from the ports so the client is only imported when an
+    Elasticsearch command runs.
+"""
+
+from elasticsearch import Urllib3HttpConnection
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+from metrics import METRICS
+
+
+class CodecSerializer(JSONSerializer):
+    """ Elasticsearch client serializer that encodes and decodes request
+        bodies, including bulk actions, with a transporter JSON codec.
+
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def loads(self, s):
+        return self.codec.loads(s)
+
+    def dumps(self, data):
+        if isinstance(data, basestring):
+            return data
+        try:
+            return self.codec.dumps(data, default=self.default)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+class TimedConnection(Urllib3HttpConnection):
+    """ Elasticsearch connection that times every request into the
+        ``es_request_seconds`` histogram and counts the bytes sent.
+    """
+
+    def perform_request(self, method, url, params=None, body=None,
+                        *args, **kwargs):
+        if body:
+            METRICS.incr('bytes_sent', len(body))
+        with METRICS.timer('es_request_seconds'):
+            return super(TimedConnection, self).perform_request(
+                method, url, params, body, *args, **kwargs)
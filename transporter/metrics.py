@@ -0,0 +1,290 @@
+""" Throughput and latency metrics.
+
+    Ports count what they read and write in :data:`METRICS`, and time their
+    network requests into histograms, so a run can report docs/sec,
+    bytes/sec, request latency percentiles, and how its time splits between
+    decoding JSON and waiting on the cluster.  Counters used by the ports:
+
+    ``docs_read``, ``bytes_read``, ``parse_errors``, ``parse_seconds``
+        input lines decoded by :class:`transporter.tools.JsonPort`
+    ``docs_written``, ``write_errors``, ``retries``, ``bytes_sent``
+        docs and requests handled by a sink
+
+    Histograms hold the latency of each network request, eg
+    ``es_request_seconds`` or ``mongo_batch_seconds``.
+"""
+
+import sys
+import json
+import time
+import bisect
+import threading
+import collections
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """ Counts observations into fixed buckets, like a Prometheus histogram.
+        Percentiles are estimated as the upper bound of the bucket they fall
+        in.
+
+        :param tuple buckets: bucket upper bounds, ascending
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Record one observation.
+
+            :param float value: observed value
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """ Estimate a percentile, None without observations.
+
+            :param float q: percentile, between 0 and 100
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics(object):
+    """ Thread safe counters and histograms for one run.
+
+        :param float total_bytes: input size, to estimate the time left
+    """
+
+    def __init__(self, total_bytes=None):
+        self.lock = threading.Lock()
+        self.reset(total_bytes)
+
+    def reset(self, total_bytes=None):
+        """ Clear every metric and restart the clock.
+
+            :param float total_bytes: input size, to estimate the time left
+        """
+        with self.lock:
+            self.counters = collections.defaultdict(float)
+            self.histograms = {}
+            self.started = time.time()
+            self.total_bytes = total_bytes
+
+    def incr(self, name, value=1):
+        """ Add to a counter.
+
+            :param str name: counter name
+            :param value: amount to add
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        """ Record the latency of a request in a histogram.
+
+            :param str name: histogram name
+            :param float seconds: latency
+        """
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def tally(self, every=1000):
+        """ Returns a :class:`Tally` adding to these metrics.
+
+            :param int every: calls to :meth:`Tally.add` between flushes
+        """
+        return Tally(self, every)
+
+    @contextmanager
+    def timer(self, name):
+        """ Time the body of a ``with`` block into a histogram, failed or
+            not.
+
+            :param str name: histogram name
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def summary(self):
+        """ Returns every metric as a dict, along with rates per second and
+            histogram percentiles.
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            counters = dict(self.counters)
+            histograms = dict((name, {
+                'count': h.count,
+                'sum': h.sum,
+                'p50': h.percentile(50),
+                'p90': h.percentile(90),
+                'p99': h.percentile(99),
+                'max': h.max
+            }) for name, h in self.histograms.iteritems())
+        network = sum(h['sum'] for h in histograms.itervalues())
+        return {
+            'elapsed': elapsed,
+            'counters': counters,
+            'rates': dict((name, value / elapsed)
+                          for name, value in counters.iteritems()
+                          if not name.endswith('_seconds')),
+            'histograms': histograms,
+            'parse_seconds': counters.get('parse_seconds', 0.0),
+            'network_seconds': network
+        }
+
+    def progress(self):
+        """ Returns a one line progress report. """
+        s = self.summary()
+        counters, rates = s['counters'], s['rates']
+        line = '{0:.0f} read, {1:.0f} written, {2:.0f} errors | ' \
+               '{3:.0f} docs/s, {4:.2f} MB/s | parse {5:.1f}s, ' \
+               'network {6:.1f}s'.format(
+                   counters.get('docs_read', 0),
+                   counters.get('docs_written', 0),
+                   counters.get('parse_errors', 0) +
+                   counters.get('write_errors', 0),
+                   rates.get('docs_written', rates.get('docs_read', 0)),
+                   rates.get('bytes_read', 0) / 1e6,
+                   s['parse_seconds'], s['network_seconds'])
+        read = counters.get('bytes_read', 0)
+        if self.total_bytes and read:
+            left = (self.total_bytes - read) / rates['bytes_read']
+            line += ' | {0:.0f}% ETA {1:.0f}s'.format(
+                100.0 * read / self.total_bytes, max(left, 0))
+        return line
+
+    def prometheus(self, prefix='tport'):
+        """ Returns the metrics in the Prometheus text exposition format.
+
+            :param str prefix: metric name prefix
+        """
+        with self.lock:
+            counters = sorted(self.counters.iteritems())
+            histograms = sorted(self.histograms.iteritems())
+            elapsed = time.time() - self.started
+        lines = ['# TYPE {0}_elapsed_seconds gauge'.format(prefix),
+                 '{0}_elapsed_seconds {1}'.format(prefix, elapsed)]
+        for name, value in counters:
+            lines.append('# TYPE {0}_{1}_total counter'.format(prefix, name))
+            lines.append('{0}_{1}_total {2}'.format(prefix, name, value))
+        for name, h in histograms:
+            metric = '{0}_{1}'.format(prefix, name)
+            lines.append('# TYPE {0} histogram'.format(metric))
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(
+                             metric, bound, cumulative))
+            lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(metric,
+                                                              h.count))
+            lines.append('{0}_sum {1}'.format(metric, h.sum))
+            lines.append('{0}_count {1}'.format(metric, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """ Write the metrics to a file, in the Prometheus text format if
+            the name ends in ``.prom``, else as a JSON summary.
+
+            :param str path: file to write to
+        """
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+class Tally(object):
+    """ Adds up counter increments locally and passes them on to the metrics
+        every ``every`` calls, so hot loops don't take the lock per item.
+        Call :meth:`flush` once the loop is done.
+
+        :param Metrics metrics: metrics to add to
+        :param int every: calls to :meth:`add` between flushes
+    """
+
+    def __init__(self, metrics, every=1000):
+        self.metrics = metrics
+        self.every = every
+        self.pending = collections.defaultdict(float)
+        self.calls = 0
+
+    def add(self, name, value=1):
+        """ Add to a counter.
+
+            :param str name: counter name
+            :param value: amount to add
+        """
+        self.pending[name] += value
+        self.calls += 1
+        if self.calls >= self.every:
+            self.flush()
+
+    def flush(self):
+        """ Pass the pending increments on to the metrics. """
+        with self.metrics.lock:
+            for name, value in self.pending.iteritems():
+                self.metrics.counters[name] += value
+        self.pending.clear()
+        self.calls = 0
+
+
+class Progress(object):
+    """ Rewrites a live progress line on a terminal while a run goes on.
+
+        :param Metrics metrics: metrics to report
+        :param float interval: seconds between updates
+        :param stream: where to write, stderr by default
+    """
+
+    def __init__(self, metrics, interval=1.0, stream=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name='tport-progress')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.stream.write('\r' + self.metrics.progress())
+            self.stream.flush()
+
+    def stop(self):
+        """ Stop updating and write the final line. """
+        self.stopped.set()
+        self.thread.join()
+        self.stream.write('\r' + self.metrics.progress() + '\n')
+        self.stream.flush()
+
+
+METRICS = Metrics()
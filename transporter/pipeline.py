@@ -0,0 +1,127 @@
+""" Generic source to sink copying between ports. """
+
+import sys
+import threading
+import urlparse
+from Queue import Queue, Full
+
+SCHEMES = ('file', 'es', 'kafka', 's3', 'mongo', 'hbase')
+
+_DONE = object()
+
+
+def parse_uri(uri):
+    """ Split a ``tport copy`` endpoint into its scheme, host and location.
+        Plain paths and ``-`` are files.
+
+        ``es://host:port/index/doctype``, ``kafka://broker/topic``,
+        ``s3://bucket/prefix``, ``mongo://host/db/collection`` and
+        ``hbase://host/table``.  The host may be left empty, eg
+        ``es:///index/doctype``, to use the one in the ``.tport`` settings.
+
+        :param str uri: endpoint to parse
+    """
+    if '://' not in uri:
+        return 'file', None, uri
+    scheme, rest = uri.split('://', 1)
+    if scheme not in SCHEMES:
+        raise ValueError('unknown scheme {0}, use one of: {1}'
+                         .format(scheme, ', '.join(SCHEMES)))
+    if scheme in ('file', 's3'):
+        return scheme, None, rest
+    parts = urlparse.urlsplit(uri)
+    location = parts.path.lstrip('/')
+    if not location:
+        raise ValueError('{0} has no location to read or write'.format(uri))
+    return scheme, parts.netloc or None, location
+
+
+class Prefetcher(object):
+    """ Reads an iterator in a background thread into a bounded queue of
+        batches, so reading and decoding the input overlaps with whatever
+        the consumer does with it, like waiting on bulk requests.  A slow
+        consumer holds the reader back instead of letting it buffer without
+        limit.
+
+        Iterating yields the items in order.  An error in the reader stops
+        the iteration once the items read before it are used up, and is
+        raised there if ``reraise`` is set; otherwise it is kept in
+        :attr:`error` for :meth:`check`.
+
+        :param iterable: items to read, eg ``JsonPort.parse()``
+        :param int queue_size: batches to buffer
+        :param int batch_size: items per batch
+        :param bool reraise: raise reader errors while iterating
+    """
+
+    def __init__(self, iterable, queue_size=8, batch_size=500, reraise=True):
+        self.iterable = iterable
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size
+        self.reraise = reraise
+        self.error = None
+        self.stopped = threading.Event()
+        self.reader = threading.Thread(target=self._read,
+                                       name='tport-prefetch')
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read(self):
+        batch = []
+        try:
+            for item in self.iterable:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    if not self._put(batch):
+                        return
+                    batch = []
+        except Exception:
+            self.error = sys.exc_info()
+        if batch:
+            self._put(batch)
+        self._put(_DONE)
+
+    def __iter__(self):
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is _DONE:
+                    break
+                for item in batch:
+                    yield item
+        finally:
+            # let the reader go if the consumer gave up early
+            self.stopped.set()
+        self.reader.join()
+        if self.reraise:
+            self.check()
+
+    def check(self):
+        """ Raise the error that stopped the reader, if any. """
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+def copy(docs, write, queue_size=8, batch_size=500):
+    """ Stream docs from a source to a sink.  The source is read ahead by a
+        :class:`Prefetcher`, so reading and writing overlap.  An error in
+        the source is raised again here once the sink has written what was
+        read before it.
+
+        :param docs: iterator of JSON documents, eg from ``Source.read``
+        :param write: called with an iterator of the docs, eg ``Sink.write``
+        :param int queue_size: batches to buffer between source and sink
+        :param int batch_size: docs per batch
+    """
+    docs = Prefetcher(docs, queue_size, batch_size, reraise=False)
+    write(iter(docs))
+    docs.check()
@@ -0,0 +1,397 @@
+""" Line readers for JSON input files. """
+
+import os
+import sys
+import bz2
+import mmap
+import zlib
+import struct
+import itertools
+from io import BytesIO
+
+from pipeline import Prefetcher
+
+# compressions by file extension, and by the magic bytes files start with
+EXTENSIONS = {'.gz': 'gz', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zst'}
+MAGIC = (('gz', '\x1f\x8b'), ('bz2', 'BZh'), ('xz', '\xfd7zXZ\x00'),
+         ('zst', '\x28\xb5\x2f\xfd'))
+
+
+def compression(fname):
+    """ Returns how a file is compressed, going by its extension or else the
+        magic bytes it starts with: ``gz``, ``bz2``, ``xz``, ``zst``, or None
+        for plain text.  Stdin is always read as plain text.  Only regular
+        files are sniffed, since reading a pipe would use up its data; for
+        them None means the compression isn't known yet.
+
+        :param str fname: file name
+    """
+    if fname == '-':
+        return None
+    ext = os.path.splitext(fname)[1]
+    if ext in EXTENSIONS:
+        return EXTENSIONS[ext]
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'rb') as f:
+        return sniff(f.read(6))
+
+
+def sniff(head):
+    """ Returns the compression that data starting with ``head`` is in, by
+        its magic bytes, or None.
+
+        :param str head: the first bytes of the data
+    """
+    for kind, magic in MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+class ZstdStream(object):
+    """ Decompresses concatenated zstd frames, as written by ``pzstd`` or by
+        appending to a file.  The ``zstandard`` releases for Python 2 stop
+        after the first frame, so frame boundaries are found here by walking
+        the frame and block headers, and each frame goes to a decompressor
+        of its own.  Skippable frames are skipped.
+    """
+
+    def __init__(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading zstd files needs the zstandard '
+                              'package')
+        self.zstd = zstandard
+        self.d = None
+        self.state = 'frame'
+        self.checksum = 0
+        self.left = 0
+        self.pending = ''
+
+    def decompress(self, data):
+        data = self.pending + data
+        self.pending = ''
+        out = []
+        pos = 0
+        while pos < len(data):
+            if self.left:
+                n = min(self.left, len(data) - pos)
+                if self.d is not None:
+                    out.append(self.d.decompress(data[pos:pos + n]))
+                pos += n
+                self.left -= n
+                continue
+            end = self._header(data, pos, out)
+            if end is None:
+                self.pending = data[pos:]
+                break
+            pos = end
+        return ''.join(out)
+
+    def _header(self, data, pos, out):
+        """ Parse the frame or block header at ``pos``.  Returns where it
+            ends, or None if more data is needed.
+        """
+        avail = len(data) - pos
+        if self.state == 'frame':
+            if avail < 8:
+                return None
+            magic = struct.unpack('<I', data[pos:pos + 4])[0]
+            if magic & 0xFFFFFFF0 == 0x184D2A50:
+                self.d = None
+                self.left = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+                return pos + 8
+            if magic != 0xFD2FB528:
+                raise IOError('not a zstd frame')
+            descriptor = ord(data[pos + 4])
+            single = descriptor >> 5 & 1
+            size = 5 + (not single) + (0, 1, 2, 4)[descriptor & 3] + \
+                (single, 2, 4, 8)[descriptor >> 6]
+            if avail < size:
+                return None
+            self.checksum = descriptor >> 2 & 1
+            self.d = self.zstd.ZstdDecompressor().decompressobj()
+            out.append(self.d.decompress(data[pos:pos + size]))
+            self.state = 'block'
+            return pos + size
+        if avail < 3:
+            return None
+        header = data[pos:pos + 3]
+        value = struct.unpack('<I', header + '\x00')[0]
+        out.append(self.d.decompress(header))
+        # RLE blocks hold a single byte to repeat
+        self.left = 1 if value >> 1 & 3 == 1 else value >> 3
+        if value & 1:
+            self.left += 4 * self.checksum
+            self.state = 'frame'
+        return pos + 3
+
+
+def _decompressor(kind):
+    """ Returns a new decompressor for one member or stream.
+
+        :param str kind: ``gz``, ``bz2``, ``xz`` or ``zst``
+    """
+    if kind == 'gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if kind == 'bz2':
+        return bz2.BZ2Decompressor()
+    if kind == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise ImportError('reading xz files needs the '
+                                  'backports.lzma package')
+        return lzma.LZMADecompressor()
+    return ZstdStream()
+
+
+def inflate(chunks, kind):
+    """ Decompress an iterator of compressed chunks, carrying on across
+        concatenated gzip members and bz2 or xz streams.
+
+        :param chunks: iterator of compressed data
+        :param str kind: ``gz``, ``bz2``, ``xz`` or ``zst``
+    """
+    d = _decompressor(kind)
+    for data in chunks:
+        while data:
+            try:
+                out = d.decompress(data)
+            except EOFError:
+                # the last stream ended exactly at the end of a chunk
+                d = _decompressor(kind)
+                continue
+            if out:
+                yield out
+            data = getattr(d, 'unused_data', '')
+            if data:
+                d = _decompressor(kind)
+
+
+def split_lines(chunks):
+    """ Split an iterator of data chunks into lines, keeping line ends.
+
+        :param chunks: iterator of data
+    """
+    tail = ''
+    for chunk in chunks:
+        lines = BytesIO(tail + chunk if tail else chunk).readlines()
+        tail = lines.pop() if lines and lines[-1][-1:] != '\n' else ''
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+def _skip(lines, offset):
+    """ Skip lines up to a byte offset, for resuming inside a stream that
+        can't be seeked.
+
+        :param lines: iterator of lines
+        :param int offset: bytes to skip, at a line boundary
+    """
+    lines = iter(lines)
+    if offset > 0:
+        for line in lines:
+            offset -= len(line)
+            if offset <= 0:
+                break
+    return lines
+
+
+def decompressed_lines(f, kind, chunk_size=1024 * 1024, prefetch=8):
+    """ Returns an iterator of the lines of a compressed file.  Reading and
+        decompressing run in a background thread, up to ``prefetch`` chunks
+        ahead, so they overlap with decoding and writing the docs.
+
+        :param f: compressed file object
+        :param str kind: ``gz``, ``bz2``, ``xz`` or ``zst``
+        :param int chunk_size: compressed bytes to read at one time
+        :param int prefetch: decompressed chunks to buffer
+    """
+    chunks = iter(lambda: f.read(chunk_size), '')
+    return split_lines(Prefetcher(inflate(chunks, kind), prefetch, 1))
+
+
+class LineReader(object):
+    """ Iterates over the lines of a list of files, like ``fileinput``, but
+        keeps track of where each line ends so a job can be checkpointed and
+        resumed.  After a line is yielded, :attr:`position` holds its
+        ``(file, byte offset after the line, line number)``.  Line numbers
+        count from 0 across all files.
+
+        Files compressed with gzip, bzip2, xz or zstd are decompressed on
+        the fly, see :func:`compression`; their byte offsets count
+        decompressed bytes.  Plain regular files can also be split into
+        :meth:`blocks` of whole lines for worker processes to map and decode
+        themselves.
+
+        ``s3://bucket/prefix`` inputs stand for every object under the
+        prefix, in key order, and are streamed with ranged GETs by an
+        :class:`transporter.tools.S3Port`.  A background thread fetches and
+        decompresses ahead, carrying on into the next object while the
+        current one is parsed, so nothing touches the local disk.
+
+        :param list files: files to read, ``-`` for stdin
+        :param dict start: checkpointed position to resume after, see
+                           :class:`transporter.checkpoint.Checkpoint`
+        :param s3: :class:`transporter.tools.S3Port` to read ``s3://``
+                   inputs with
+        :param int prefetch: data chunks to fetch and decompress ahead
+    """
+
+    def __init__(self, files, start=None, s3=None, prefetch=8):
+        self.files = files
+        self.start = start
+        self.s3 = s3
+        self.prefetch = prefetch
+        self.position = None
+        self.first_line = start['line'] + 1 if start else 0
+
+    def _files(self):
+        """ Returns ``(file, byte offset to start at, size)`` tuples, with
+            S3 prefixes expanded into their objects and what was read before
+            a resumed checkpoint skipped.  The size is only known for S3
+            objects.
+        """
+        files = []
+        for fname in self.files:
+            if fname.startswith('s3://'):
+                if self.s3 is None:
+                    raise ValueError('reading {0} needs S3 credentials'
+                                     .format(fname))
+                files.extend(self.s3.objects(fname))
+            else:
+                files.append((fname, None))
+        names = [fname for fname, _ in files]
+        skip, offset = 0, 0
+        if self.start:
+            if self.start['file'] not in names:
+                raise ValueError('cannot resume, {0} is not one of the input '
+                                 'files'.format(self.start['file']))
+            skip = names.index(self.start['file'])
+            offset = self.start['offset']
+        return [(fname, offset if n == skip else 0, size)
+                for n, (fname, size) in enumerate(files) if n >= skip]
+
+    def __iter__(self):
+        lineno = self.first_line - 1
+        for fname, offset, lines in self._sources():
+            for line in lines:
+                offset += len(line)
+                lineno += 1
+                self.position = (fname, offset, lineno)
+                yield line
+
+    def _sources(self):
+        """ Returns ``(file, byte offset, iterator of lines)`` for each
+            input, with runs of S3 objects read ahead together.
+        """
+        files = self._files()
+        for is_s3, run in itertools.groupby(
+                files, lambda f: f[0].startswith('s3://')):
+            if is_s3:
+                for source in self._s3_sources(list(run)):
+                    yield source
+            else:
+                for fname, offset, _ in run:
+                    yield fname, offset, self._local_lines(fname, offset)
+
+    def _local_lines(self, fname, offset):
+        kind = compression(fname)
+        f = sys.stdin if fname == '-' else open(fname, 'rb')
+        try:
+            lines = f
+            if kind:
+                lines = _skip(decompressed_lines(
+                    f, kind, prefetch=self.prefetch), offset)
+            elif fname != '-' and not os.path.isfile(fname):
+                lines = _skip(self._pipe_lines(f), offset)
+            elif offset:
+                f.seek(offset)
+            for line in lines:
+                yield line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def _pipe_lines(self, f, chunk_size=64 * 1024):
+        """ Returns the lines of a named pipe, eg from ``<(zcat x)``,
+            sniffed for compression from the bytes it starts with, which are
+            kept rather than read again.
+        """
+        head = f.read(6)
+        kind = sniff(head)
+        chunks = itertools.chain([head], iter(lambda: f.read(chunk_size), ''))
+        if kind:
+            chunks = Prefetcher(inflate(chunks, kind), self.prefetch, 1)
+        return split_lines(chunks)
+
+    def _s3_chunks(self, objects):
+        """ Fetch and decompress a run of S3 objects, one after the other.
+            Yields ``(object, compressed, data)``.
+        """
+        for uri, offset, size in objects:
+            kind = EXTENSIONS.get(os.path.splitext(uri)[1])
+            if kind is None and offset:
+                head = self.s3.stream(uri, min(size, 6))
+                kind = sniff(next(head, ''))
+                head.close()
+            # compressed objects can't be entered part way
+            chunks = self.s3.stream(uri, size, 0 if kind else offset)
+            if kind is None and not offset:
+                first = next(chunks, '')
+                kind = sniff(first)
+                chunks = itertools.chain([first], chunks)
+            if kind:
+                chunks = inflate(chunks, kind)
+            for data in chunks:
+                yield uri, kind is not None, data
+
+    def _s3_sources(self, objects):
+        offsets = dict((uri, offset) for uri, offset, _ in objects)
+        chunks = Prefetcher(self._s3_chunks(objects), self.prefetch, 1)
+        for uri, group in itertools.groupby(chunks, lambda c: c[0]):
+            group = iter(group)
+            first = next(group)
+            lines = split_lines(itertools.chain(
+                [first[2]], (data for _, _, data in group)))
+            if first[1]:
+                lines = _skip(lines, offsets[uri])
+            yield uri, offsets[uri], lines
+
+    def mappable(self):
+        """ Whether every input is an uncompressed regular file that can be
+            memory mapped, rather than stdin or a pipe.
+        """
+        return all(fname != '-' and os.path.isfile(fname) and
+                   compression(fname) is None for fname in self.files)
+
+    def blocks(self, block_size=128 * 1024):
+        """ Split the input into blocks of whole lines, yielded as
+            ``(file, start, end)`` byte ranges.  Each file is memory mapped
+            and only searched for the first newline past every block
+            boundary, so the lines themselves are never read here.
+
+            :param int block_size: least bytes per block, except the last
+                                   block of a file
+        """
+        for fname, start, _ in self._files():
+            size = os.path.getsize(fname)
+            if start >= size:
+                continue
+            with open(fname, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                while start < size:
+                    end = m.find('\n', start + block_size - 1) + 1 or size
+                    yield fname, start, end
+                    start = end
+            finally:
+                m.close()
@@ -1,3 +1,7 @@
+JSON_SETTINGS = {
+    'codec': 'auto'
+}
+
 ES_SETTINGS = {
     'host': 'localhost:9200',
     'ssl': False
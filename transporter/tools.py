@@ -1,53 +1,514 @@
 #!/usr/bin/env python
 
 import sys
+import os
 import json
+import base64
 import logging
 import gzip
 import shutil
-
-import urllib3
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
-import boto
-from boto.s3.key import Key
-from pymongo import MongoClient
-import happybase
-from pykafka import KafkaClient
+import mmap
+import collections
+import itertools
+import functools
+from io import BytesIO
+from contextlib import contextmanager
+import multiprocessing
+import threading
+import time
+import importlib
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
 # from addict import Dict
 
-# disable annoying SSL certificate warnings
-urllib3.disable_warnings()
+from codec import get_codec
+from deadletter import check_policy
+from docid import IdSpec, GNIP_ID, getter
+from metrics import METRICS
+from readers import LineReader
+from transform import get_transform
 
 # set up a logger
 logging.basicConfig(level=logging.INFO)
 
+# the client library each port needs, installed by the setup.py extra of the
+# same name, eg ``pip install json-transporter[es]``
+CLIENTS = {
+    'es': 'elasticsearch',
+    'kafka': 'pykafka',
+    's3': 'boto',
+    'mongo': 'pymongo',
+    'hbase': 'happybase'
+}
+
+
+def _client(port):
+    """ Import the client library of a port.  Ports import their client
+        only once they are built, so a command doesn't pay for, or need, the
+        libraries of the ports it doesn't use.
+
+        :param str port: ``es``, ``kafka``, ``s3``, ``mongo`` or ``hbase``
+    """
+    try:
+        return importlib.import_module(CLIENTS[port])
+    except ImportError:
+        raise ImportError('the {0} port needs the {1} package, install it '
+                          'with: pip install json-transporter[{0}]'
+                          .format(port, CLIENTS[port]))
+
+
+def _imap_bounded(pool, func, iterable, inflight, ordered=True):
+    """ Like ``pool.imap``, but only keeps ``inflight`` tasks queued, where
+        ``imap`` would read the whole input into memory up front.  When not
+        ordered, any task that has already finished jumps the queue.
+
+        :param pool: process or thread pool
+        :param func: function to apply to every item
+        :param iterable: items to process
+        :param int inflight: most tasks queued at once
+        :param bool ordered: yield results in input order
+    """
+    items = iter(iterable)
+    pending = collections.deque(pool.apply_async(func, (item,))
+                                for item in itertools.islice(items, inflight))
+    while pending:
+        result = pending[0]
+        if not ordered:
+            result = next((r for r in pending if r.ready()), result)
+        pending.remove(result)
+        value = result.get()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield value
+
+
+def _batches(iterable, size):
+    """ Group an iterator into lists of ``size`` items.
+
+        :param iterable: items to group
+        :param int size: items per list
+    """
+    items = iter(iterable)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _decoder(codec_name, transform=None):
+    """ Returns a function decoding a line and applying a transform to it,
+        for the worker processes.
+
+        :param str codec_name: JSON codec to decode with
+        :param str transform: :attr:`transporter.transform.Transform.spec`
+    """
+    loads = get_codec(codec_name).loads
+    if not transform:
+        return loads
+    transform = get_transform(transform)
+    return lambda line: transform(loads(line))
+
+
+def _decode_chunk(chunk, codec_name='json', transform=None):
+    """ Decode a chunk of JSON lines.  Runs inside a worker process, so
+        errors are returned alongside the line instead of being handled.
+        Docs a transform filters out come back with False as their error.
+
+        :param tuple chunk: index of the first line and a list of lines
+        :param str codec_name: JSON codec to decode with
+        :param str transform: :attr:`transporter.transform.Transform.spec`
+    """
+    decode = _decoder(codec_name, transform)
+    start, lines = chunk
+    decoded = []
+    for idx, line in enumerate(lines, start):
+        try:
+            obj = decode(line)
+        except ValueError as ve:
+            decoded.append((idx, line, str(ve)))
+            continue
+        if obj is None and transform:
+            decoded.append((idx, None, False))
+        else:
+            decoded.append((idx, obj, None))
+    return decoded
+
+
+def _decode_block(block, codec_name='json', transform=None):
+    """ Decode the JSON lines in a byte range of a file, mapping the file
+        instead of having the lines sent over from the reading process.
+        Returns the file, the bytes decoded and a list of ``(byte offset
+        after the line, obj or line, error or None)`` tuples, with False as
+        the error of docs a transform filters out.
+
+        :param tuple block: ``(file, start, end)`` as yielded by
+                            :meth:`transporter.readers.LineReader.blocks`
+        :param str codec_name: JSON codec to decode with
+        :param str transform: :attr:`transporter.transform.Transform.spec`
+    """
+    decode = _decoder(codec_name, transform)
+    fname, start, end = block
+    with open(fname, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        data = m[start:end]
+    finally:
+        m.close()
+    lines = data.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    decoded = []
+    offset = start
+    for line in lines:
+        offset = min(offset + len(line) + 1, end)
+        try:
+            obj = decode(line)
+        except ValueError as ve:
+            decoded.append((offset, line + '\n', str(ve)))
+            continue
+        if obj is None and transform:
+            decoded.append((offset, None, False))
+        else:
+            decoded.append((offset, obj, None))
+    return fname, end - start, decoded
+
+
+def _timed(func, arg):
+    """ Returns how long ``func(arg)`` took along with its result, to time
+        the work done in worker processes.
+
+        :param func: function to call
+        :param arg: its argument
+    """
+    start = time.time()
+    result = func(arg)
+    return time.time() - start, result
+
+
+class Source(object):
+    """ A port that documents can be read from, eg by ``tport copy``.  The
+        location names what to read in the port's own terms, like an index
+        or a topic.  Ports take the options that apply to them, such as
+        ``query``, ``group``, ``count`` or ``timeout``, and ignore the rest.
+    """
+
+    def read(self, location, **options):
+        """ Returns an iterator of JSON documents.
+
+            :param str location: what to read, eg ``index/doctype``
+        """
+        raise NotImplementedError
+
+
+class Sink(object):
+    """ A port that documents can be written to, eg by ``tport copy``. """
+
+    def write(self, docs, location, **options):
+        """ Write JSON documents.
 
-class JsonPort(object):
+            :param docs: iterator of JSON documents
+            :param str location: where to write, eg ``index/doctype``
+        """
+        raise NotImplementedError
+
+
+class JsonPort(Source, Sink):
     """ Parses out a JSON iterator object.
 
         :param list jsonlist: a list or iterator of JSON objects.
+        :param bool ignore_errors: skip invalid lines, same as
+                                   ``errors='skip'``
+        :param int workers: number of decoding processes, 1 decodes in-process
+        :param bool ordered: emit documents in input order when using workers
+        :param int chunksize: number of lines handed to a worker at one time
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
+        :param checkpoint: :class:`transporter.checkpoint.Checkpoint` to
+                           track the position of every document in; needs a
+                           :class:`transporter.readers.LineReader` input and
+                           implies ordered output
+        :param str errors: what to do with invalid lines: ``skip`` them,
+                           ``fail`` with a ValueError, or write them to the
+                           ``dead-letter`` file; ``fail`` unless
+                           ``ignore_errors`` is set
+        :param dead_letter: :class:`transporter.deadletter.DeadLetter` file
+                            for the ``dead-letter`` policy
+        :param transform: :class:`transporter.transform.Transform` to apply
+                          to every doc as it is decoded
     """
 
-    def __init__(self, jsonlist, ignore_errors=False):
+    def __init__(self, jsonlist, ignore_errors=False, workers=1, ordered=True,
+                 chunksize=1000, codec=None, checkpoint=None, errors=None,
+                 dead_letter=None, transform=None):
+        if errors is None:
+            errors = 'skip' if ignore_errors else 'fail'
+        check_policy(errors, dead_letter)
         self.jsonlist = jsonlist
-        self.ignore_errors = ignore_errors
+        self.errors = errors
+        self.dead_letter = dead_letter
+        self.workers = workers
+        self.ordered = ordered or checkpoint is not None
+        self.chunksize = chunksize
+        self.codec = codec or get_codec()
+        self.checkpoint = checkpoint
+        self.transform = transform or None
+        self._positions = {}
 
     def parse(self):
         """ Returns an JSON iterator object if input is valid JSON, else
             it returns an empty dictionary.
         """
-        for idx, i in enumerate(self.jsonlist):
+        if self.workers > 1:
+            if self.ordered and isinstance(self.jsonlist, LineReader) and \
+                    self.jsonlist.mappable():
+                parallel = self._parse_blocks()
+            else:
+                parallel = self._parse_parallel()
             try:
-                yield json.loads(i)
-            except ValueError as ve:
-                logging.warning('line {0}:  {1}'.format(idx, ve))
-                logging.debug('line {0}:  {1}'.format(idx, i))
-                if not self.ignore_errors:
-                    ans = raw_input('\nThis line is not JSON.'
-                                    '  Continue to next line?  (Y/n)  ')
-                    if ans.lower() == 'n':
-                        sys.exit(0)
+                for i in parallel:
+                    yield i
+            finally:
+                self._flush_errors()
+            return
+        loads = self.codec.loads
+        transform = self.transform
+        tally = METRICS.tally()
+        try:
+            for idx, i in self._lines():
+                start = time.time()
+                try:
+                    doc = loads(i)
+                    if transform:
+                        doc = transform(doc)
+                except ValueError as ve:
+                    self._bad_line(idx, i, ve, self._position())
+                    continue
+                tally.add('parse_seconds', time.time() - start)
+                tally.add('docs_read')
+                if doc is None and transform:
+                    tally.add('docs_filtered')
+                    continue
+                if self.checkpoint:
+                    self.checkpoint.track(self.jsonlist.position)
+                yield doc
+        finally:
+            tally.flush()
+            self._flush_errors()
+
+    def raw(self, validate='light', sample=0):
+        """ Returns an iterator of the raw lines, without decoding them, for
+            sinks that only need serialized JSON.  Lines that fail validation
+            are reported like in :meth:`parse`.
+
+            :param str validate: ``light`` checks that each line looks like
+                                 a JSON object or array, ``none`` forwards
+                                 every line untouched
+            :param int sample: also fully decode every n-th line, 0 to never
+        """
+        if validate not in ('light', 'none'):
+            raise ValueError('validate must be light or none, '
+                             'not {0}'.format(validate))
+        if self.transform:
+            raise ValueError('raw lines are not decoded, so they cannot be '
+                             'transformed')
+        light = validate == 'light'
+        loads = self.codec.loads
+        tally = METRICS.tally()
+        try:
+            for idx, i in self._lines():
+                line = i.rstrip('\r\n')
+                if light:
+                    stripped = line.strip()
+                    if stripped[:1] + stripped[-1:] not in ('{}', '[]'):
+                        self._bad_line(idx, i, 'not a JSON object or array',
+                                       self._position())
+                        continue
+                if sample and idx % sample == 0:
+                    try:
+                        loads(line)
+                    except ValueError as ve:
+                        self._bad_line(idx, i, ve, self._position())
+                        continue
+                tally.add('docs_read')
+                if self.checkpoint:
+                    self.checkpoint.track(self.jsonlist.position)
+                yield line
+        finally:
+            tally.flush()
+            self._flush_errors()
+
+    def _lines(self):
+        """ Enumerate the input lines, numbered from where a resumed
+            :class:`transporter.readers.LineReader` starts.
+        """
+        first_line = getattr(self.jsonlist, 'first_line', 0)
+        nbytes = 0
+        try:
+            for idx, line in enumerate(self.jsonlist, first_line):
+                nbytes += len(line)
+                if not idx % 1000:
+                    METRICS.incr('bytes_read', nbytes)
+                    nbytes = 0
+                yield idx, line
+        finally:
+            METRICS.incr('bytes_read', nbytes)
+
+    def _position(self):
+        """ Returns the input position of the last line read, if known. """
+        return getattr(self.jsonlist, 'position', None)
+
+    def _bad_line(self, idx, line, error, position=None):
+        """ Report a line that could not be decoded, and skip it, fail, or
+            write it to the dead-letter file, as the error policy says.
+
+            :param int idx: line number
+            :param str line: the offending line
+            :param error: decoding error or its message
+            :param tuple position: input position after the line, to report
+                                   the file and byte offset it starts at
+        """
+        METRICS.incr('parse_errors')
+        where = ''
+        if position:
+            where = ' ({0} byte {1})'.format(position[0],
+                                             position[1] - len(line))
+        logging.warning('line {0}{1}:  {2}'.format(idx, where, error))
+        logging.debug('line %s:  %s', idx, line)
+        if self.errors == 'fail':
+            raise ValueError('line {0}{1} is not valid JSON:  {2}'.format(
+                             idx, where, error))
+        if self.errors == 'dead-letter':
+            self.dead_letter.line(idx, line, error, position)
+
+    def _flush_errors(self):
+        """ Write out the dead-letter records buffered so far. """
+        if self.dead_letter:
+            self.dead_letter.flush()
+
+    def _chunks(self):
+        """ Group input lines into ``(first line index, lines)`` chunks.  The
+            input position of each line is kept aside when checkpointing.
+        """
+        chunk, positions = [], []
+        start = 0
+        for idx, line in self._lines():
+            if not chunk:
+                start = idx
+            chunk.append(line)
+            if self.checkpoint:
+                positions.append(self.jsonlist.position)
+            if len(chunk) >= self.chunksize:
+                self._positions[start] = positions
+                yield start, chunk
+                chunk, positions = [], []
+        if chunk:
+            self._positions[start] = positions
+            yield start, chunk
+
+    def _transform_spec(self):
+        """ Returns the transform as the spec sent to the workers. """
+        return self.transform.spec if self.transform else None
+
+    def _count(self, decoded):
+        """ Count the docs a worker decoded and filtered out. """
+        filtered = sum(1 for d in decoded if d[2] is False)
+        METRICS.incr('docs_read', sum(1 for d in decoded if d[2] is None) +
+                     filtered)
+        if filtered:
+            METRICS.incr('docs_filtered', filtered)
+
+    def _parse_parallel(self):
+        """ Decode chunks of lines in a process pool.  Only a couple of chunks
+            per worker are in flight at once, so memory stays bounded no
+            matter how large the input is.
+        """
+        pool = multiprocessing.Pool(self.workers)
+        decode = functools.partial(_timed, functools.partial(
+            _decode_chunk, codec_name=self.codec.name,
+            transform=self._transform_spec()))
+        try:
+            for seconds, decoded in _imap_bounded(pool, decode,
+                                                  self._chunks(),
+                                                  self.workers * 2,
+                                                  self.ordered):
+                METRICS.incr('parse_seconds', seconds)
+                self._count(decoded)
+                positions = self._positions.pop(decoded[0][0])
+                for n, (idx, obj, error) in enumerate(decoded):
+                    if error is None:
+                        if self.checkpoint:
+                            self.checkpoint.track(positions[n])
+                        yield obj
+                    elif error is not False:
+                        self._bad_line(idx, obj, error,
+                                       positions[n] if positions else None)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _parse_blocks(self):
+        """ Decode byte ranges of memory mapped input files in a process
+            pool, in order.  The workers map the files themselves, so this
+            process neither reads the lines nor sends them over.
+        """
+        pool = multiprocessing.Pool(self.workers)
+        decode = functools.partial(_timed, functools.partial(
+            _decode_block, codec_name=self.codec.name,
+            transform=self._transform_spec()))
+        idx = self.jsonlist.first_line
+        try:
+            for seconds, (fname, nbytes, decoded) in _imap_bounded(
+                    pool, decode, self.jsonlist.blocks(), self.workers * 2):
+                METRICS.incr('parse_seconds', seconds)
+                METRICS.incr('bytes_read', nbytes)
+                self._count(decoded)
+                for offset, obj, error in decoded:
+                    position = (fname, offset, idx)
+                    if error is None:
+                        if self.checkpoint:
+                            self.checkpoint.track(position)
+                        yield obj
+                    elif error is not False:
+                        self._bad_line(idx, obj, error, position)
+                    idx += 1
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def read(self, location, **options):
+        """ Parse the JSON lines of a file, ``-`` for stdin.
+
+            :param str location: file to read
+            :param str errors: error policy for invalid lines, see
+                               :class:`JsonPort`
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        if options.get('errors'):
+            check_policy(options['errors'], options.get('dead_letter'))
+            self.errors = options['errors']
+            self.dead_letter = options.get('dead_letter')
+        self.jsonlist = LineReader([location])
+        return self.parse()
+
+    def write(self, docs, location, **options):
+        """ Write docs as JSON lines to a file, ``-`` for stdout.  Files
+            ending in ``.gz`` are gzipped.
+
+            :param docs: iterator of JSON documents
+            :param str location: file to write to
+        """
+        dumps = self.codec.dumps
+        path = None if location == '-' else location
+        out = RotatingWriter(path, compress=location.endswith('.gz'))
+        try:
+            for batch in _batches(docs, self.chunksize):
+                out.writelines([dumps(doc) + '\n' for doc in batch])
+        finally:
+            out.close()
+        logging.info('{0} docs written to {1}'.format(out.written, location))
 
     def inspect(self):
         """ Output the serialized JSON object one line at a time.  To
@@ -60,30 +521,208 @@ class JsonPort(object):
                 sys.exit(0)
 
 
-class ElasticPort(object):
+class BulkSizer(object):
+    """ Sizes bulk requests by payload bytes instead of document count, and
+        adapts the target size to how the cluster copes.  Rejections halve
+        the size, slow requests shrink it and fast ones grow it.  Shared by
+        all indexing threads.
+
+        :param int chunkbytes: initial bulk request size in bytes
+        :param int min_bytes: smallest bulk request size
+        :param int max_bytes: largest bulk request size
+        :param float target_latency: bulk request latency to aim for, seconds
+    """
+
+    def __init__(self, chunkbytes=5 * 1024 * 1024, min_bytes=256 * 1024,
+                 max_bytes=50 * 1024 * 1024, target_latency=1.0):
+        self.chunkbytes = chunkbytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def feedback(self, latency, rejected=False):
+        """ Adjust the target size after a bulk request.
+
+            :param float latency: seconds the request took
+            :param bool rejected: the cluster rejected some or all of it
+        """
+        with self.lock:
+            if rejected:
+                size = self.chunkbytes // 2
+            elif latency > self.target_latency:
+                size = self.chunkbytes * 3 // 4
+            elif latency < self.target_latency / 2:
+                size = self.chunkbytes * 5 // 4
+            else:
+                return
+            self.chunkbytes = max(self.min_bytes, min(self.max_bytes, size))
+
+
+def _export_es(host, ssl, iname, dtype, body, size, scroll, path,
+               compress=False, meta=False, codec_name='json'):
+    """ Export the hits of a scrolled search to a JSON lines file, or stdout
+        if no path is given.  Runs inside a worker process for sliced
+        exports.  Returns the number of docs written.
+
+        :param str host: elasticsearch host
+        :param bool ssl: ssl enable
+        :param str iname: index name
+        :param str dtype: document type, None for every type
+        :param dict body: search body, including any ``slice``
+        :param int size: hits per scroll page
+        :param str scroll: how long to keep the scroll context alive
+        :param str path: file to write to
+        :param bool compress: gzip the output
+        :param bool meta: write whole hits, not just their ``_source``
+        :param str codec_name: JSON codec to encode with
+    """
+    codec = get_codec(codec_name)
+    esi = ElasticPort(host, ssl, codec=codec)
+    dumps = codec.dumps
+    out = _open_output(path, compress)
+    count = 0
+    try:
+        hits = esi.query(iname, body, dtype, size, scroll)
+        if not meta:
+            hits = (hit['_source'] for hit in hits)
+        for batch in _batches(hits, size):
+            out.writelines([dumps(hit) + '\n' for hit in batch])
+            count += len(batch)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+
+def _export_es_args(args):
+    """ Unpack :func:`_export_es` arguments for ``Pool.map``. """
+    return _export_es(*args)
+
+
+# index settings to change during a bulk load, and their bulk load values
+BULK_LOAD_SETTINGS = (
+    ('index.refresh_interval', '-1'),
+    ('index.number_of_replicas', '0')
+)
+
+
+class ElasticPort(Source, Sink):
     """ Class to handle Elastic Search actions.
 
         :param str host: elasticsearch host
         :param bool ssl: ssl enable
         :param str logger: name of logger
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
     """
 
     def __str__(self):
         return 'ElasticPort'
 
-    def __init__(self, host, ssl, logger=None):
-        self.es = Elasticsearch(host, set_ssl=ssl)
+    def __init__(self, host, ssl, logger=None, codec=None):
+        self.host = host
+        self.ssl = ssl
+        self.codec = codec or get_codec()
+        es = _client('es')
+        from elastic import CodecSerializer, TimedConnection
+        import urllib3
+        # disable annoying SSL certificate warnings
+        urllib3.disable_warnings()
+        self.es = es.Elasticsearch(host, set_ssl=ssl,
+                                   serializer=CodecSerializer(self.codec),
+                                   connection_class=TimedConnection)
         self.logger = logging.getLogger(__name__)
         # ch = logging.StreamHandler()
         # ch.setLevel(logging.INFO)
         # self.logger.addHandler(ch)
         # self.logger.setLevel(logging.INFO)
 
-    def query(self):
-        """ Query Elastic Search """
-        pass
+    def query(self, iname, body=None, dtype=None, size=1000, scroll='5m'):
+        """ Scroll through the hits of a search.  Pass a ``slice`` in the
+            body to read one slice of a sliced scroll.
+
+            :param str iname: index name
+            :param dict body: search body, every doc if not given
+            :param str dtype: document type, None for every type
+            :param int size: hits per scroll page
+            :param str scroll: how long to keep the scroll context alive
+        """
+        from elasticsearch.helpers import scan
+        return scan(self.es, query=body, index=iname, doc_type=dtype,
+                    size=size, scroll=scroll)
+
+    def export(self, iname, f=None, body=None, dtype=None, size=1000,
+               scroll='5m', compress=False, meta=False, workers=1):
+        """ Export the ``_source`` of the docs matching a search, one doc per
+            line.  With several workers the search is split into a sliced
+            scroll, each slice exported by its own process to its own shard
+            file.
+
+            :param str iname: index name
+            :param str f: File to write to, stdout if not given
+            :param dict body: search body, every doc if not given
+            :param str dtype: document type, None for every type
+            :param int size: hits per scroll page
+            :param str scroll: how long to keep the scroll context alive
+            :param bool compress: gzip the output
+            :param bool meta: write whole hits, not just their ``_source``
+            :param int workers: number of slices and export processes
+        """
+        body = dict(body or {})
+        if compress and f and not f.endswith('.gz'):
+            f += '.gz'
+        if workers <= 1:
+            count = _export_es(self.host, self.ssl, iname, dtype, body, size,
+                               scroll, f, compress, meta, self.codec.name)
+            logging.info('{0} docs exported from {1}'.format(count, iname))
+            return
+        if not f:
+            raise ValueError('a parallel export needs a file to write to')
+        tasks = []
+        for idx in xrange(workers):
+            slice_body = dict(body, slice={'id': idx, 'max': workers})
+            tasks.append((self.host, self.ssl, iname, dtype, slice_body, size,
+                          scroll, _shard_path(f, idx, compress), compress,
+                          meta, self.codec.name))
+        pool = multiprocessing.Pool(workers)
+        try:
+            counts = pool.map(_export_es_args, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for task, count in zip(tasks, counts):
+            logging.info('{0} docs exported to {1}'.format(count, task[7]))
+
+    def read(self, location, **options):
+        """ Scroll through the ``_source`` of every doc in an index.
+
+            :param str location: ``index`` or ``index/doctype``
+            :param dict query: Elastic Search query body
+        """
+        iname, _, dtype = location.partition('/')
+        for hit in self.query(iname, options.get('query'), dtype or None):
+            yield hit['_source']
+
+    def write(self, docs, location, **options):
+        """ Index docs, creating the index if needed.
+
+            :param docs: iterator of JSON documents
+            :param str location: ``index/doctype``
+            :param str errors: what to do with rejected docs, see
+                               :meth:`index`
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        iname, _, dtype = location.partition('/')
+        self.create(iname)
+        self.index(docs, iname, dtype, errors=options.get('errors') or 'skip',
+                   dead_letter=options.get('dead_letter'))
 
-    def index(self, jsonit, iname, dtype, chunksize=500):
+    def index(self, jsonit, iname, dtype, chunksize=500, threads=1,
+              adaptive=False, chunkbytes=5 * 1024 * 1024, max_retries=5,
+              checkpoint=None, errors='skip', dead_letter=None, ids=None,
+              op_type='index'):
         """ Data input is a JSON generator.  If using the command-line tool,
             this is handled via the JsonPort method which creates a
             JSON generator from lines read in from files.
@@ -92,7 +731,36 @@ class ElasticPort(object):
             :param str iname: elasticsearch index name
             :param str dtype: document type
             :param int chunksize: number of docs to send at one time
+            :param int threads: number of bulk requests in flight
+            :param bool adaptive: size bulk requests by bytes and adapt the
+                                  size to bulk latency and rejections
+            :param int chunkbytes: initial bulk request size in adaptive mode
+            :param int max_retries: times to retry rejected docs in adaptive
+                                    mode, with exponential backoff
+            :param checkpoint: :class:`transporter.checkpoint.Checkpoint` to
+                               acknowledge indexed docs in
+            :param str errors: what to do with docs the cluster rejects:
+                               ``skip`` them, ``fail`` with a
+                               ``BulkIndexError``, or write them and the
+                               reason to the ``dead-letter`` file
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file for the ``dead-letter`` policy
+            :param ids: :class:`transporter.docid.IdSpec` giving docs their
+                        ``_id`` and ``_routing``; by default the numeric
+                        part of a Gnip tweet ``id``
+            :param str op_type: ``index`` replaces docs with the same id,
+                                ``create`` rejects them
         """
+        check_policy(errors, dead_letter)
+        if op_type not in ('index', 'create'):
+            raise ValueError('op_type must be index or create, '
+                             'not {0}'.format(op_type))
+        if ids is None:
+            ids = IdSpec('id', GNIP_ID)
+        apply_ids = ids.apply
+        # bulk results come back in order, so the source of a rejected doc
+        # is the oldest one still pending
+        pending = collections.deque()
 
         def bulkgen(jsongen):
             """ Create a generator of JSON objects for bulk indexing.
@@ -104,15 +772,177 @@ class ElasticPort(object):
                 bulkr['_index'] = iname
                 bulkr['_type'] = dtype
                 bulkr['_source'] = jobj
-                if 'id' in jobj:
-                    bulkr['_id'] = jobj['id'].split(':')[2]
+                if op_type != 'index':
+                    bulkr['_op_type'] = op_type
+                apply_ids(jobj, bulkr)
                 self.logger.debug('done with index %s' % idx)
+                if errors != 'skip' and not adaptive:
+                    pending.append(jobj)
                 yield bulkr
 
-        r = bulk(client=self.es, actions=bulkgen(jsonit),
-                 chunk_size=chunksize, stats_only=True)
+        from elasticsearch.helpers import streaming_bulk, parallel_bulk
+        if adaptive:
+            r = self._adaptive_bulk(bulkgen(jsonit), threads,
+                                    BulkSizer(chunkbytes), max_retries,
+                                    checkpoint, errors, dead_letter)
+        else:
+            if threads > 1:
+                results = parallel_bulk(self.es, bulkgen(jsonit),
+                                        thread_count=threads,
+                                        chunk_size=chunksize,
+                                        raise_on_error=False)
+            else:
+                results = streaming_bulk(self.es, bulkgen(jsonit),
+                                         chunk_size=chunksize,
+                                         raise_on_error=False)
+            r = [0, 0]
+            tally = METRICS.tally()
+            for ok, item in results:
+                r[0 if ok else 1] += 1
+                tally.add('docs_written' if ok else 'write_errors')
+                doc = pending.popleft() if pending else None
+                if not ok:
+                    self._rejected(item.values()[0], doc, errors,
+                                   dead_letter)
+                if checkpoint:
+                    checkpoint.ack()
+            tally.flush()
+        if dead_letter:
+            dead_letter.flush()
+        if checkpoint:
+            checkpoint.save()
         print 'INDEX: successful: %s; failed: %s' % (r[0], r[1])
 
+    def _rejected(self, result, doc, errors, dead_letter=None):
+        """ Skip, fail on, or dead-letter a doc the cluster rejected.
+
+            :param dict result: bulk response item of the doc
+            :param dict doc: the doc
+            :param str errors: ``skip``, ``fail`` or ``dead-letter``
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        self.logger.debug('bulk item failed: %s' % result.get('error'))
+        if errors == 'fail':
+            from elasticsearch.helpers import BulkIndexError
+            raise BulkIndexError('1 document(s) failed to index.',
+                                 [dict(result, data=doc)])
+        if errors == 'dead-letter':
+            dead_letter.add({'error': result.get('error'),
+                             'status': result.get('status'),
+                             'index': result.get('_index'),
+                             'id': result.get('_id'), 'doc': doc})
+
+    def _adaptive_bulk(self, actions, threads, sizer, max_retries,
+                       checkpoint=None, errors='skip', dead_letter=None):
+        """ Send bulk requests sized by :class:`BulkSizer`, with up to
+            ``threads`` requests in flight.  Returns the number of successful
+            and failed docs.
+
+            :param actions: iterator of bulk actions
+            :param int threads: number of bulk requests in flight
+            :param BulkSizer sizer: bulk request sizer
+            :param int max_retries: times to retry rejected docs
+            :param checkpoint: :class:`transporter.checkpoint.Checkpoint` to
+                               acknowledge indexed docs in
+            :param str errors: ``skip``, ``fail`` or ``dead-letter``
+                               rejected docs
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        from elasticsearch.helpers import expand_action
+        serializer = self.es.transport.serializer
+
+        def chunks():
+            chunk, size = [], 0
+            for action in actions:
+                meta, source = expand_action(action)
+                data = serializer.dumps(meta) + '\n'
+                if source is not None:
+                    data += serializer.dumps(source) + '\n'
+                chunk.append(data)
+                size += len(data)
+                if size >= sizer.chunkbytes:
+                    yield chunk
+                    chunk, size = [], 0
+            if chunk:
+                yield chunk
+
+        def send(chunk):
+            return self._send_chunk(chunk, sizer, max_retries,
+                                    errors=errors, dead_letter=dead_letter)
+
+        r = [0, 0]
+        pool = ThreadPool(threads)
+        try:
+            for success, failed in _imap_bounded(pool, send, chunks(),
+                                                 threads * 2):
+                r[0] += success
+                r[1] += failed
+                METRICS.incr('docs_written', success)
+                METRICS.incr('write_errors', failed)
+                if checkpoint:
+                    checkpoint.ack(success + failed)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return r
+
+    def _send_chunk(self, chunk, sizer, max_retries, backoff=0.5,
+                    max_backoff=60, errors='skip', dead_letter=None):
+        """ Send one bulk request, retrying rejected docs with exponential
+            backoff.  Returns the number of successful and failed docs.
+
+            :param list chunk: serialized bulk actions, one per doc
+            :param BulkSizer sizer: bulk request sizer to report latency to
+            :param int max_retries: times to retry rejected docs
+            :param float backoff: seconds to wait before the first retry
+            :param float max_backoff: longest wait between retries
+            :param str errors: ``skip``, ``fail`` or ``dead-letter``
+                               rejected docs
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        from elasticsearch.exceptions import TransportError
+        success = failed = 0
+        for attempt in range(max_retries + 1):
+            wait = min(backoff * 2 ** attempt, max_backoff)
+            start = time.time()
+            try:
+                resp = self.es.bulk(body=''.join(chunk))
+            except TransportError as te:
+                if te.status_code != 429 or attempt == max_retries:
+                    raise
+                sizer.feedback(time.time() - start, rejected=True)
+                METRICS.incr('retries')
+                self.logger.warning('bulk request rejected, retrying in '
+                                    '%.1fs' % wait)
+                time.sleep(wait)
+                continue
+            retry = []
+            for data, item in zip(chunk, resp['items']):
+                result = item.values()[0]
+                status = result.get('status', 500)
+                if 200 <= status < 300:
+                    success += 1
+                elif status == 429 and attempt < max_retries:
+                    retry.append(data)
+                else:
+                    failed += 1
+                    source = data.split('\n')[1]
+                    self._rejected(result, self.codec.loads(source)
+                                   if source else None, errors, dead_letter)
+            sizer.feedback(time.time() - start, rejected=bool(retry))
+            if not retry:
+                break
+            METRICS.incr('retries', len(retry))
+            self.logger.warning('%s docs rejected, retrying in %.1fs' %
+                                (len(retry), wait))
+            chunk = retry
+            time.sleep(wait)
+        return success, failed
+
     def map(self, iname, dtype, mapping):
         """ After creating a new index, specify a mapping.
 
@@ -133,40 +963,365 @@ class ElasticPort(object):
         """
         self.es.indices.create(iname, ignore=400)
 
+    @contextmanager
+    def bulk_load(self, iname, state_path=None, max_num_segments=None):
+        """ Tune an index for a bulk load for the body of a ``with`` block:
+            turn refreshes off and drop the replicas, then put the settings
+            back afterwards, failed or not.  A load that ends cleanly can
+            also force merge the index before the replicas are rebuilt.
+
+            The settings are saved to a state file first.  If a run dies
+            without restoring them, the next bulk load picks them up from
+            there instead of saving the tuned ones, and :meth:`restore` can
+            put them back by hand.
+
+            :param str iname: index name
+            :param str state_path: state file, ``<index>.bulkload.json`` in
+                                   the working directory by default
+            :param int max_num_segments: force merge down to this many
+                                         segments per shard
+        """
+        state_path = state_path or '{0}.bulkload.json'.format(iname)
+        if os.path.exists(state_path):
+            # check the state is this index's before touching any settings
+            self._bulk_state(iname, state_path)
+            self.logger.warning('bulk load state %s left by an earlier run, '
+                                'keeping its settings' % state_path)
+        else:
+            response = self.es.indices.get_settings(index=iname,
+                                                    flat_settings=True)
+            settings = response.values()[0]['settings']
+            saved = dict((name, settings.get(name))
+                         for name, _ in BULK_LOAD_SETTINGS)
+            tmp = state_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'index': iname, 'settings': saved}, f)
+            os.rename(tmp, state_path)
+        self.logger.info('bulk load mode on for %s' % iname)
+        self.es.indices.put_settings(index=iname,
+                                     body=dict(BULK_LOAD_SETTINGS))
+        try:
+            yield
+            if max_num_segments:
+                self.logger.info('force merging %s to %s segments' %
+                                 (iname, max_num_segments))
+                self.es.indices.refresh(index=iname)
+                self.es.indices.forcemerge(index=iname,
+                                           max_num_segments=max_num_segments,
+                                           request_timeout=24 * 3600)
+        finally:
+            self.restore(iname, state_path)
+
+    def restore(self, iname, state_path=None):
+        """ Put back the settings an index had before :meth:`bulk_load`
+            changed them, and remove the state file.
+
+            :param str iname: index name
+            :param str state_path: state file, ``<index>.bulkload.json`` in
+                                   the working directory by default
+        """
+        state_path = state_path or '{0}.bulkload.json'.format(iname)
+        state = self._bulk_state(iname, state_path)
+        # settings that were never set go back to their defaults as null
+        self.es.indices.put_settings(index=iname, body=state['settings'])
+        os.remove(state_path)
+        self.logger.info('settings of %s restored: %s' %
+                         (iname, state['settings']))
 
-class KafkaPort(object):
+    def _bulk_state(self, iname, state_path):
+        """ Returns the bulk load state saved for an index, or raises a
+            ValueError if the file holds another index's settings.
+
+            :param str iname: index name
+            :param str state_path: state file
+        """
+        with open(state_path) as f:
+            state = json.load(f)
+        if state['index'] != iname:
+            raise ValueError('{0} holds the settings of {1}, not {2}'.format(
+                             state_path, state['index'], iname))
+        return state
+
+
+# producer compression codecs
+KAFKA_COMPRESSIONS = ('none', 'gzip', 'snappy', 'lz4')
+
+
+class KafkaPort(Source, Sink):
     """ Class to interface with Kafka.
 
         :param str kafkabroker: Kafka broker and port, eg ``localhost:9092``
         :param str logger: Logger to use for Kafka.
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
     """
 
-    def __init__(self, kafkabroker, logger=None):
-        self.client = KafkaClient(hosts=kafkabroker)
+    def __init__(self, kafkabroker, logger=None, codec=None):
+        self.client = _client('kafka').KafkaClient(hosts=kafkabroker)
         self.logger = logger or logging.getLogger(__name__)
+        self.codec = codec or get_codec()
 
-    def produce(self, topic_name, jsonit):
-        """ Send data to a Kafka topic.
+    def produce(self, topic_name, jsonit, raw=False, checkpoint=None,
+                key=None, batch_size=None, linger_ms=None, compression=None,
+                max_queued=None, sync=False):
+        """ Send data to a Kafka topic.  Every message's delivery report is
+            checked, and the number of delivered and failed messages is
+            printed at the end.
 
             :param str topic_name: Kafka topic name
             :param list jsonlist: List or iterator of JSON objects
+            :param bool raw: items are already serialized, eg from
+                             :meth:`JsonPort.raw`, and are sent as they are
+            :param checkpoint: :class:`transporter.checkpoint.Checkpoint` to
+                               acknowledge delivered messages in
+            :param str key: dotted path of the field holding the message
+                            key; messages with the same key go to the same
+                            partition
+            :param int batch_size: messages to queue before sending a batch
+            :param int linger_ms: longest wait for a batch to fill up
+            :param str compression: ``gzip``, ``snappy``, ``lz4`` or
+                                    ``none``
+            :param int max_queued: most messages queued before produce blocks
+            :param bool sync: wait for every message to be delivered before
+                              sending the next
         """
+        if raw and key:
+            raise ValueError('message keys need decoded docs, not raw lines')
+        if compression and compression not in KAFKA_COMPRESSIONS:
+            raise ValueError('compression must be one of {0}, not {1}'.format(
+                             ', '.join(KAFKA_COMPRESSIONS), compression))
+        from pykafka.common import CompressionType
+        from pykafka.exceptions import KafkaException
+        from pykafka.partitioners import hashing_partitioner
         topic = self.client.topics[topic_name]
-        self.producer = topic.get_producer()
+        options = {'sync': sync, 'delivery_reports': not sync}
+        if batch_size:
+            options['min_queued_messages'] = batch_size
+        if linger_ms is not None:
+            options['linger_ms'] = linger_ms
+        if compression:
+            options['compression'] = getattr(CompressionType,
+                                             compression.upper())
+        if max_queued:
+            options['max_queued_messages'] = max_queued
+        if key:
+            options['partitioner'] = hashing_partitioner
+        self.producer = topic.get_producer(**options)
         self.logger.info('producing messages to %s' % topic_name)
-        self.producer.produce((json.dumps(s) for s in jsonit))
-        self.logger.info('all messages sent to %s' % topic_name)
+        if raw:
+            messages = ((s, None) for s in jsonit)
+        else:
+            dumps = self.codec.dumps
+            get_key = getter(key) if key else None
+            messages = ((dumps(s), self._key(s, get_key)) for s in jsonit)
+        self.delivered = self.failed = 0
+        seqs = {}
+        tally = METRICS.tally()
+        try:
+            for seq, (message, partition_key) in enumerate(messages):
+                tally.add('bytes_sent', len(message))
+                if sync:
+                    try:
+                        self.producer.produce(message, partition_key)
+                        self.delivered += 1
+                        tally.add('docs_written')
+                    except KafkaException as ke:
+                        self.failed += 1
+                        tally.add('write_errors')
+                        self.logger.warning('message not delivered: %s' % ke)
+                    if checkpoint:
+                        checkpoint.ack()
+                else:
+                    msg = self.producer.produce(message, partition_key)
+                    seqs[id(msg)] = seq
+                    self._delivery_reports(seqs, tally, checkpoint)
+            self.producer.stop()
+            self._delivery_reports(seqs, tally, checkpoint)
+        finally:
+            tally.flush()
+        if checkpoint:
+            checkpoint.save()
+        print 'PRODUCE: delivered: %s; failed: %s' % (self.delivered,
+                                                      self.failed)
+
+    def _key(self, doc, get_key):
+        """ Returns a doc's message key, or None.
 
-    def consume(self, topic_name):
-        """ Receive data from a Kafka topic.
+            :param dict doc: JSON doc
+            :param get_key: looks up the message key field, see
+                            :func:`transporter.docid.getter`
+        """
+        value = get_key(doc) if get_key else None
+        if value is None:
+            return None
+        return unicode(value).encode('utf-8')
+
+    def _delivery_reports(self, seqs, tally, checkpoint=None):
+        """ Count the delivery reports that have come back so far, and
+            acknowledge their messages in the checkpoint.
+
+            :param dict seqs: sequence numbers of messages awaiting a report,
+                              by message id
+            :param tally: :class:`transporter.metrics.Tally` to count in
+            :param checkpoint: :class:`transporter.checkpoint.Checkpoint`
+        """
+        while True:
+            try:
+                msg, exc = self.producer.get_delivery_report(block=False)
+            except Empty:
+                return
+            if exc is None:
+                self.delivered += 1
+                tally.add('docs_written')
+            else:
+                self.failed += 1
+                tally.add('write_errors')
+                self.logger.warning('message not delivered: %s' % exc)
+            seq = seqs.pop(id(msg))
+            if checkpoint:
+                checkpoint.ack_seq(seq)
+
+    def messages(self, topic_name, group=None, count=None, timeout=None,
+                 commit_every=1000):
+        """ Returns an iterator of message values from a Kafka topic.  With
+            a consumer group, partitions are balanced across consumers and
+            offsets are committed every ``commit_every`` messages, once the
+            caller asks for the next one, so only use it where each value is
+            handled before the next is asked for.  Call :meth:`close` when
+            done to commit the rest.
 
             :param str topic_name: Kafka topic name
+            :param str group: consumer group to join
+            :param int count: stop after this many messages
+            :param float timeout: stop after this many seconds without a
+                                  message
+            :param int commit_every: messages between offset commits, 0 to
+                                     only commit on :meth:`close`
         """
+        consumed = 0
+        for message in self._consume(topic_name, group, count, timeout):
+            yield message.value
+            consumed += 1
+            if group and commit_every and consumed % commit_every == 0:
+                self.consumer.commit_offsets()
+
+    def reader(self, topic_name, group=None, count=None, timeout=None):
+        """ Returns a :class:`MessageReader` of a topic, for sinks that
+            acknowledge docs through an
+            :class:`transporter.checkpoint.OffsetCheckpoint`.  It commits
+            nothing itself.
+
+            :param str topic_name: Kafka topic name
+            :param str group: consumer group to join
+            :param int count: stop after this many messages
+            :param float timeout: stop after this many seconds without a
+                                  message
+        """
+        return MessageReader(self._consume(topic_name, group, count, timeout))
+
+    def _consume(self, topic_name, group=None, count=None, timeout=None):
+        """ Returns an iterator of the messages of a topic. """
         topic = self.client.topics[topic_name]
-        self.consumer = topic.get_simple_consumer()
+        timeout_ms = int(timeout * 1000) if timeout else -1
+        self.group = group
+        if group:
+            self.consumer = topic.get_balanced_consumer(
+                consumer_group=group, managed=True, auto_commit_enable=False,
+                consumer_timeout_ms=timeout_ms)
+        else:
+            self.consumer = topic.get_simple_consumer(
+                consumer_timeout_ms=timeout_ms)
+        consumed = 0
         for message in self.consumer:
-            if message is not None:
-                print message.offset, message.value
+            if message is None:
+                continue
+            yield message
+            consumed += 1
+            if count and consumed >= count:
+                break
+
+    def commit(self, partition_offsets):
+        """ Commit the offsets of a consumer group.
+
+            :param list partition_offsets: ``(partition, next offset)``
+                                           pairs
+        """
+        if self.group:
+            self.consumer.commit_offsets(partition_offsets)
+
+    def read(self, location, **options):
+        """ Decode the messages of a topic.  In a consumer group, offsets
+            are only committed by :meth:`close`, to be called once the sink
+            has written the docs.
+
+            :param str location: Kafka topic name
+            :param str group: consumer group to join
+            :param int count: stop after this many messages
+            :param float timeout: stop after this many seconds without a
+                                  message
+            :param str errors: error policy for invalid messages, see
+                               :class:`JsonPort`
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        messages = self.messages(location, options.get('group'),
+                                 options.get('count'), options.get('timeout'),
+                                 commit_every=0)
+        for doc in JsonPort(messages, codec=self.codec,
+                            errors=options.get('errors'),
+                            dead_letter=options.get('dead_letter')).parse():
+            yield doc
+
+    def write(self, docs, location, **options):
+        """ Produce docs to a topic.
+
+            :param docs: iterator of JSON documents
+            :param str location: Kafka topic name
+        """
+        self.produce(location, docs)
+
+    def close(self, commit=True):
+        """ Stop consuming, committing the offsets of the messages consumed
+            when in a consumer group.
+
+            :param bool commit: commit offsets before stopping
+        """
+        if commit and self.group:
+            self.consumer.commit_offsets()
+        self.consumer.stop()
+
+    def consume(self, topic_name, f=None, group=None, count=None,
+                timeout=None, batch_size=1000, compress=False, rotate=None):
+        """ Receive data from a Kafka topic, writing message values one per
+            line to stdout or a file.
+
+            :param str topic_name: Kafka topic name
+            :param str f: File to write to, stdout if not given
+            :param str group: consumer group to join
+            :param int count: stop after this many messages
+            :param float timeout: stop after this many seconds without a
+                                  message
+            :param int batch_size: number of messages to write at one time
+            :param bool compress: gzip the output
+            :param int rotate: start a new file every this many messages,
+                               eg ``out-000.json``, ``out-001.json``
+        """
+        if compress and f and not f.endswith('.gz'):
+            f += '.gz'
+        out = RotatingWriter(f, compress, rotate)
+        batch = []
+        try:
+            for value in self.messages(topic_name, group, count, timeout,
+                                       batch_size):
+                batch.append(value + '\n')
+                if len(batch) >= batch_size:
+                    out.writelines(batch)
+                    batch = []
+            out.writelines(batch)
+        finally:
+            out.close()
+        self.close()
+        self.logger.info('%s messages consumed from %s' % (out.written,
+                                                            topic_name))
 
     def topics(self):
         """ List Kafka topics. """
@@ -175,55 +1330,408 @@ class KafkaPort(object):
             print s
 
 
-class S3Port(object):
+class MessageReader(object):
+    """ Iterates over the values of Kafka messages, like a
+        :class:`transporter.readers.LineReader` does over lines.  After a
+        value is yielded, :attr:`position` holds the ``(partition, offset)``
+        of its message.
+
+        :param messages: iterator of pykafka messages
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.position = None
+
+    def __iter__(self):
+        for message in self.messages:
+            self.position = (message.partition, message.offset)
+            yield message.value
+
+
+class MultipartWriter(object):
+    """ File-like object that uploads whatever is written to it as the parts
+        of an S3 multipart upload.  At most about one part is held in memory.
+
+        :param mp: boto ``MultiPartUpload``
+        :param int part_size: bytes per part; S3 wants at least 5 MB for all
+                              but the last part
+    """
+
+    def __init__(self, mp, part_size=8 * 1024 * 1024):
+        self.mp = mp
+        self.part_size = part_size
+        self.part_num = 0
+        self.buffer = BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        self.part_num += 1
+        METRICS.incr('bytes_sent', self.buffer.tell())
+        self.buffer.seek(0)
+        with METRICS.timer('s3_request_seconds'):
+            self.mp.upload_part_from_file(self.buffer, self.part_num)
+        self.buffer = BytesIO()
+
+    def close(self):
+        """ Upload the last part and complete the multipart upload. """
+        if self.buffer.tell() or not self.part_num:
+            self._upload_part()
+        self.mp.complete_upload()
+
+
+class S3Port(Source, Sink):
     """ Class to handle uploading and donwloading data to and from S3.  There
         is also an option to compress the files with gzip before uploading.
 
         :param str access_key: S3 access key
         :param str secret_key: S3 secret key
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
     """
 
-    def __init__(self, access_key, secret_key):
-        self.conn = boto.connect_s3(access_key, secret_key)
+    def __init__(self, access_key, secret_key, codec=None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.conn = _client('s3').connect_s3(access_key, secret_key)
+        self.local = threading.local()
+        self.codec = codec or get_codec()
+
+    def _bucket(self, bucket_name):
+        """ Returns a bucket on a connection owned by the calling thread,
+            since boto connections can't be shared between threads.
+
+            :param str bucket_name: S3 bucket name
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = _client('s3').connect_s3(
+                self.access_key, self.secret_key)
+        return conn.get_bucket(bucket_name, validate=False)
+
+    def _key(self, bucket_name, key_name=None):
+        """ Returns a boto key in a bucket, see :meth:`_bucket`.
+
+            :param str bucket_name: S3 bucket name
+            :param str key_name: S3 key
+        """
+        from boto.s3.key import Key
+        return Key(self._bucket(bucket_name), key_name)
 
-    def upload(self, bucket_name, filelist, compress=False, replace_key=False):
+    def upload(self, bucket_name, filelist, compress=False, replace_key=False,
+               part_size=8 * 1024 * 1024, concurrency=1):
         """ Given a S3 bucket and a fileglob, upload data to S3. Using the
-            --compress option is recommended to save on S3 costs.
+            --compress option is recommended to save on S3 costs.  Files
+            larger than ``part_size`` are sent as multipart uploads whose
+            parts are uploaded in parallel.
 
             :param str bucket_name: S3 bucket name
             :param list filelist: List of files to upload to S3
             :param bool compress: Compress the data before uploading
             :param bool replace_key: Replace existing data
+            :param int part_size: multipart part size
+            :param int concurrency: number of files or parts in flight
         """
         # Create new bucket if it doesn't exist.  Otherwise, use existing.
         new_bucket = self.conn.create_bucket(bucket_name)
-        for fname in filelist:
-            if compress:
-                cfname = ''.join(['/tmp/', fname.split('/')[-1], '.gz'])
-                with open(fname, 'rb') as f_in, gzip.open(cfname, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                fname = cfname
-            k = Key(new_bucket)
-            k.key = fname.split('/')[-1]
+        pool = ThreadPool(concurrency)
+        uploads = []
+        try:
+            for fname in filelist:
+                if compress:
+                    task = pool.apply_async(self._upload_compressed,
+                                            (bucket_name, fname, replace_key,
+                                             part_size))
+                    uploads.append((fname, None, [task]))
+                elif os.path.getsize(fname) > part_size:
+                    upload = self._start_multipart(pool, new_bucket, fname,
+                                                   replace_key, part_size)
+                    if upload:
+                        uploads.append(upload)
+                else:
+                    task = pool.apply_async(self._upload_file,
+                                            (bucket_name, fname, replace_key))
+                    uploads.append((fname, None, [task]))
+            while uploads:
+                fname, mp, tasks = uploads[0]
+                for task in tasks:
+                    task.get()
+                if mp is not None:
+                    mp.complete_upload()
+                    logging.info('{0} file uploaded to: {1}'.format(
+                                 fname, bucket_name))
+                uploads.pop(0)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            # don't leave the parts of unfinished uploads behind in S3
+            for fname, mp, tasks in uploads:
+                if mp is not None:
+                    mp.cancel_upload()
+
+    def _upload_file(self, bucket_name, fname, replace_key):
+        """ Upload a file with a single PUT.
+
+            :param str bucket_name: S3 bucket name
+            :param str fname: file to upload
+            :param bool replace_key: Replace existing data
+        """
+        k = self._key(bucket_name)
+        k.key = fname.split('/')[-1]
+        with METRICS.timer('s3_request_seconds'):
             t = k.set_contents_from_filename(fname, replace=replace_key)
-            if t:
-                logging.info('{0} file uploaded to: {1}'.format(fname,
-                             bucket_name))
-            if not t:
-                logging.info('{0} file already exists in {1}!'.format(fname,
-                             bucket_name))
+        if t:
+            METRICS.incr('bytes_sent', os.path.getsize(fname))
+            logging.info('{0} file uploaded to: {1}'.format(fname,
+                         bucket_name))
+        if not t:
+            logging.info('{0} file already exists in {1}!'.format(fname,
+                         bucket_name))
+
+    def _start_multipart(self, pool, bucket, fname, replace_key, part_size):
+        """ Start a multipart upload and queue its parts on the pool.
+            Returns the file name, the multipart upload and the part tasks,
+            or None when the key exists and may not be replaced.
+
+            :param pool: thread pool to upload the parts on
+            :param bucket: boto bucket
+            :param str fname: file to upload
+            :param bool replace_key: Replace existing data
+            :param int part_size: multipart part size
+        """
+        key_name = fname.split('/')[-1]
+        if not replace_key and bucket.get_key(key_name) is not None:
+            logging.info('{0} file already exists in {1}!'.format(fname,
+                         bucket.name))
+            return None
+        mp = bucket.initiate_multipart_upload(key_name)
+        size = os.path.getsize(fname)
+        tasks = []
+        for part_num, offset in enumerate(xrange(0, size, part_size), 1):
+            tasks.append(pool.apply_async(
+                self._upload_part,
+                (bucket.name, key_name, mp.id, fname, part_num, offset,
+                 min(part_size, size - offset))))
+        return fname, mp, tasks
+
+    def _upload_part(self, bucket_name, key_name, upload_id, fname, part_num,
+                     offset, size):
+        """ Upload one part of a file to a multipart upload.
+
+            :param str bucket_name: S3 bucket name
+            :param str key_name: S3 key of the multipart upload
+            :param str upload_id: id of the multipart upload
+            :param str fname: file being uploaded
+            :param int part_num: part number, starting at 1
+            :param int offset: byte offset of the part in the file
+            :param int size: bytes in the part
+        """
+        from boto.s3.multipart import MultiPartUpload
+        mp = MultiPartUpload(self._bucket(bucket_name))
+        mp.key_name = key_name
+        mp.id = upload_id
+        with open(fname, 'rb') as f:
+            f.seek(offset)
+            with METRICS.timer('s3_request_seconds'):
+                mp.upload_part_from_file(f, part_num, size=size)
+        METRICS.incr('bytes_sent', size)
+
+    def _upload_compressed(self, bucket_name, fname, replace_key, part_size):
+        """ Gzip a file straight into a multipart upload, so no compressed
+            copy is written to disk.
+
+            :param str bucket_name: S3 bucket name
+            :param str fname: file to upload
+            :param bool replace_key: Replace existing data
+            :param int part_size: multipart part size
+        """
+        bucket = self._bucket(bucket_name)
+        key_name = fname.split('/')[-1] + '.gz'
+        if not replace_key and bucket.get_key(key_name) is not None:
+            logging.info('{0} file already exists in {1}!'.format(key_name,
+                         bucket_name))
+            return
+        mp = bucket.initiate_multipart_upload(key_name)
+        try:
+            writer = MultipartWriter(mp, part_size)
+            with open(fname, 'rb') as f_in:
+                f_out = gzip.GzipFile(key_name[:-3], 'wb', fileobj=writer)
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+                f_out.close()
+            writer.close()
+        except:
+            mp.cancel_upload()
+            raise
+        logging.info('{0} file uploaded to: {1}'.format(key_name,
+                     bucket_name))
 
-    def download(self, bucket_name, folder):
-        """ Download all data in an S3 bucket.
+    def download(self, bucket_name, folder, part_size=8 * 1024 * 1024,
+                 concurrency=1):
+        """ Download all data in an S3 bucket.  Keys larger than
+            ``part_size`` are fetched as parallel ranged GETs.
 
             :param str bucket_name: Name of S3 bucket
             :param str folder: Folder to store S3 data
+            :param int part_size: bytes per ranged GET
+            :param int concurrency: number of keys or ranges in flight
         """
         a_bucket = self.conn.create_bucket(bucket_name)
-        for key in a_bucket.list():
-            path = '/'.join([folder, key.name])
-            key.get_contents_to_filename(path)
-            logging.info('{0} downloaded'.format(path))
+        pool = ThreadPool(concurrency)
+        try:
+            downloads = []
+            for key in a_bucket.list():
+                path = '/'.join([folder, key.name])
+                if key.size > part_size:
+                    with open(path, 'wb') as f:
+                        f.truncate(key.size)
+                    tasks = [pool.apply_async(
+                        self._download_range,
+                        (bucket_name, key.name, path, offset,
+                         min(offset + part_size, key.size) - 1))
+                        for offset in xrange(0, key.size, part_size)]
+                else:
+                    tasks = [pool.apply_async(self._download_file,
+                                              (bucket_name, key.name, path))]
+                downloads.append((path, tasks))
+            for path, tasks in downloads:
+                for task in tasks:
+                    task.get()
+                logging.info('{0} downloaded'.format(path))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _download_file(self, bucket_name, key_name, path):
+        """ Download a key with a single GET.
+
+            :param str bucket_name: Name of S3 bucket
+            :param str key_name: S3 key
+            :param str path: file to write to
+        """
+        with METRICS.timer('s3_request_seconds'):
+            self._key(bucket_name, key_name).get_contents_to_filename(path)
+        METRICS.incr('bytes_received', os.path.getsize(path))
+
+    def _download_range(self, bucket_name, key_name, path, start, end):
+        """ Download a byte range of a key into the same range of a file.
+
+            :param str bucket_name: Name of S3 bucket
+            :param str key_name: S3 key
+            :param str path: file to write to, already sized to the key
+            :param int start: first byte of the range
+            :param int end: last byte of the range, inclusive
+        """
+        key = self._key(bucket_name, key_name)
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            with METRICS.timer('s3_request_seconds'):
+                key.get_contents_to_file(
+                    f, headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+        METRICS.incr('bytes_received', end - start + 1)
+
+    def read(self, location, **options):
+        """ Parse the JSON lines of every key under a prefix, in key order.
+            Compressed keys are decompressed on the fly.
+
+            :param str location: ``bucket`` or ``bucket/prefix``
+            :param str errors: error policy for invalid lines, see
+                               :class:`JsonPort`
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        reader = LineReader(['s3://' + location], s3=self)
+        return JsonPort(reader, codec=self.codec, errors=options.get('errors'),
+                        dead_letter=options.get('dead_letter')).parse()
+
+    def objects(self, uri):
+        """ Returns ``(uri, size)`` for the objects an ``s3://`` input
+            stands for: the key itself when it exists, else every key under
+            the prefix, in key order.
+
+            :param str uri: ``s3://bucket/key`` or ``s3://bucket/prefix``
+        """
+        bucket_name, _, prefix = uri[len('s3://'):].partition('/')
+        keys = [key for key in self._bucket(bucket_name).list(prefix=prefix)
+                if not key.name.endswith('/')]
+        exact = [key for key in keys if key.name == prefix]
+        return [('s3://{0}/{1}'.format(bucket_name, key.name), key.size)
+                for key in exact or keys]
+
+    def stream(self, uri, size, start=0, part_size=8 * 1024 * 1024,
+               concurrency=2):
+        """ Returns an iterator of an object's data, fetched in order with
+            ranged GETs, up to ``concurrency`` of them in flight.
+
+            :param str uri: ``s3://bucket/key``
+            :param int size: object size
+            :param int start: byte to start at
+            :param int part_size: bytes per GET
+            :param int concurrency: number of GETs in flight
+        """
+        bucket_name, _, key_name = uri[len('s3://'):].partition('/')
+        ranges = ((pos, min(pos + part_size, size) - 1)
+                  for pos in xrange(start, size, part_size))
+
+        def fetch(byte_range):
+            return self._get_range(bucket_name, key_name, *byte_range)
+
+        pool = ThreadPool(concurrency)
+        try:
+            for data in _imap_bounded(pool, fetch, ranges, concurrency):
+                yield data
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _get_range(self, bucket_name, key_name, start, end):
+        """ Returns a byte range of a key.
+
+            :param str bucket_name: Name of S3 bucket
+            :param str key_name: S3 key
+            :param int start: first byte of the range
+            :param int end: last byte of the range, inclusive
+        """
+        key = self._key(bucket_name, key_name)
+        with METRICS.timer('s3_request_seconds'):
+            data = key.get_contents_as_string(
+                headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+        METRICS.incr('bytes_received', len(data))
+        return data
+
+    def write(self, docs, location, part_size=8 * 1024 * 1024, **options):
+        """ Write docs as JSON lines to a key with a multipart upload.  Keys
+            ending in ``.gz`` are gzipped.
+
+            :param docs: iterator of JSON documents
+            :param str location: ``bucket/key``
+            :param int part_size: multipart part size
+        """
+        bucket_name, _, key_name = location.partition('/')
+        dumps = self.codec.dumps
+        mp = self.conn.create_bucket(bucket_name).initiate_multipart_upload(
+            key_name)
+        try:
+            writer = out = MultipartWriter(mp, part_size)
+            if key_name.endswith('.gz'):
+                out = gzip.GzipFile(key_name[:-3], 'wb', fileobj=writer)
+            for batch in _batches(docs, 1000):
+                out.write(''.join(dumps(doc) + '\n' for doc in batch))
+            out.close()
+            if out is not writer:
+                writer.close()
+        except:
+            mp.cancel_upload()
+            raise
+        logging.info('{0} uploaded to: {1}'.format(key_name, bucket_name))
 
     def destroy(self, bucket_name):
         """ Destroy an S3 bucket and all data inside it.
@@ -244,16 +1752,131 @@ class S3Port(object):
             print b
 
 
-class MongoPort(object):
+def _open_output(path, compress=False):
+    """ Open a file to export to, or stdout if no path is given.
+
+        :param str path: file to write to
+        :param bool compress: gzip the output
+    """
+    if not path:
+        return sys.stdout
+    if compress:
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def _shard_path(f, idx, compress=False):
+    """ Returns the file name of a shard of an export to ``f``, eg
+        ``out-000.json``, ``out-001.json`` for ``out.json``.
+
+        :param str f: file the export was asked to write to
+        :param int idx: shard number
+        :param bool compress: the shard is gzipped
+    """
+    base, ext = os.path.splitext(f[:-3] if f.endswith('.gz') else f)
+    suffix = '.gz' if compress else ''
+    return '{0}-{1:03d}{2}{3}'.format(base, idx, ext, suffix)
+
+
+class RotatingWriter(object):
+    """ Writes lines to stdout or a file, optionally starting a new file
+        every ``rotate`` lines, named like the shards of a parallel export.
+
+        :param str f: File to write to, stdout if not given
+        :param bool compress: gzip the output
+        :param int rotate: lines per file, None to never rotate
+    """
+
+    def __init__(self, f=None, compress=False, rotate=None):
+        if rotate and not f:
+            raise ValueError('rotating output needs a file to write to')
+        self.f = f
+        self.compress = compress
+        self.rotate = rotate
+        self.written = 0
+        self.out = None
+
+    def writelines(self, lines):
+        while lines:
+            if self.out is None:
+                path = self.f
+                if self.rotate:
+                    path = _shard_path(self.f, self.written // self.rotate,
+                                       self.compress)
+                self.out = _open_output(path, self.compress)
+            room = len(lines)
+            if self.rotate:
+                room = self.rotate - self.written % self.rotate
+            self.out.writelines(lines[:room])
+            self.written += len(lines[:room])
+            METRICS.incr('docs_written', len(lines[:room]))
+            lines = lines[room:]
+            if self.rotate and self.written % self.rotate == 0:
+                self.close()
+
+    def close(self):
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+        self.out = None
+
+
+def _export_mongo(host, db, collection, query, projection, batch_size, path,
+                  compress=False, codec_name='json'):
+    """ Export the docs of a collection matching a query to a JSON lines
+        file, or stdout if no path is given.  Runs inside a worker process
+        for parallel exports.  Returns the number of docs written.
+
+        :param str host: Mongo hostname
+        :param str db: Mongo database
+        :param str collection: Name of Mongo collection or table
+        :param dict query: Mongo query filter
+        :param dict projection: fields to include or exclude
+        :param int batch_size: number of docs to fetch and write at one time
+        :param str path: file to write to
+        :param bool compress: gzip the output
+        :param str codec_name: JSON codec to encode with
+    """
+    dumps = get_codec(codec_name).dumps
+    from bson import json_util
+    cursor = _client('mongo').MongoClient(host)[db][collection].find(
+        query, projection, batch_size=batch_size)
+    out = _open_output(path, compress)
+    count = 0
+    try:
+        batch = []
+        for doc in cursor:
+            batch.append(dumps(doc, default=json_util.default) + '\n')
+            if len(batch) >= batch_size:
+                out.writelines(batch)
+                count += len(batch)
+                batch = []
+        out.writelines(batch)
+        count += len(batch)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+
+def _export_mongo_args(args):
+    """ Unpack :func:`_export_mongo` arguments for ``Pool.map``. """
+    return _export_mongo(*args)
+
+
+class MongoPort(Source, Sink):
     """ Class to handle interfacing with MongoDB.
 
         :param str host: Mongo hostname
         :param str db: Mongo database
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
     """
 
-    def __init__(self, host, db):
-        self.client = MongoClient(host)
+    def __init__(self, host, db, codec=None):
+        self.host = host
+        self.db_name = db
+        self.client = _client('mongo').MongoClient(host)
         self.db = self.client[db]
+        self.codec = codec or get_codec()
 
     def preview(self, collection):
         """ View a collection line by line.  Ctrl+d to stop.
@@ -268,31 +1891,179 @@ class MongoPort(object):
             except EOFError:
                 sys.exit(0)
 
-    def add(self, collection):
-        """ Add data to a MongoDB collection.
+    def read(self, location, **options):
+        """ Iterate over the docs of a collection as plain JSON, so any sink
+            can serialize them: an ObjectId ``_id`` is turned into a string,
+            and other BSON types, like dates, nested ObjectIds and decimals,
+            into MongoDB extended JSON, as :meth:`export` writes them.
+
+            :param str location: Name of Mongo collection or table
+            :param dict query: Mongo query filter
+        """
+        from bson import ObjectId, json_util
+        dumps, loads = self.codec.dumps, self.codec.loads
+        for doc in self.db[location].find(options.get('query')):
+            if isinstance(doc.get('_id'), ObjectId):
+                doc['_id'] = str(doc['_id'])
+            yield loads(dumps(doc, default=json_util.default))
+
+    def write(self, docs, location, **options):
+        """ Add docs to a collection.
+
+            :param docs: iterator of JSON documents
+            :param str location: Name of Mongo collection or table
+        """
+        self.add(location, docs)
+
+    def add(self, collection, jsonit, batch_size=1000, upsert_key=None,
+            threads=1, checkpoint=None):
+        """ Add data to a MongoDB collection.  Documents are written in
+            unordered batches, so one bad document doesn't stop the rest of
+            its batch.
 
             :param str collection: Name of Mongo collection or table
+            :param list jsonit: JSON list or iterator
+            :param int batch_size: number of docs to write at one time
+            :param str upsert_key: replace docs with the same value for this
+                                   field instead of inserting duplicates
+            :param int threads: number of batches in flight; when upserting
+                                with more than one, the upsert key should
+                                have a unique index
+            :param checkpoint: :class:`transporter.checkpoint.Checkpoint` to
+                               acknowledge written docs in
         """
-        self.collection = self.db.collection
+        self.collection = self.db[collection]
+
+        def batches():
+            batch = []
+            for doc in jsonit:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def write(batch):
+            with METRICS.timer('mongo_batch_seconds'):
+                return self._write_batch(batch, upsert_key)
+
+        r = [0, 0]
+        pool = ThreadPool(threads)
+        try:
+            for success, failed in _imap_bounded(pool, write, batches(),
+                                                 threads * 2):
+                r[0] += success
+                r[1] += failed
+                METRICS.incr('docs_written', success)
+                METRICS.incr('write_errors', failed)
+                if checkpoint:
+                    checkpoint.ack(success + failed)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        if checkpoint:
+            checkpoint.save()
+        print 'ADD: successful: %s; failed: %s' % (r[0], r[1])
+
+    def _write_batch(self, batch, upsert_key=None):
+        """ Write one batch of docs.  Returns the number of successful and
+            failed docs.
 
-    def export(self, collection, f=''):
-        """ Export serailized JSON data from a MongoDB colllection.
-            Not working yet.
+            :param list batch: docs to write
+            :param str upsert_key: field to upsert docs by
+        """
+        from pymongo import InsertOne, ReplaceOne
+        from pymongo.errors import BulkWriteError
+        try:
+            if upsert_key:
+                requests = [ReplaceOne({upsert_key: doc[upsert_key]}, doc,
+                                       upsert=True)
+                            if upsert_key in doc else InsertOne(doc)
+                            for doc in batch]
+                self.collection.bulk_write(requests, ordered=False)
+            else:
+                self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as bwe:
+            errors = bwe.details['writeErrors']
+            for error in errors:
+                logging.debug('write failed: {0}'.format(error['errmsg']))
+            return len(batch) - len(errors), len(errors)
+        return len(batch), 0
+
+    def export(self, collection, f=None, query=None, projection=None,
+               batch_size=1000, compress=False, workers=1):
+        """ Export serialized JSON data from a MongoDB collection, one doc
+            per line.  With several workers the collection is split into
+            ``_id`` ranges of about equal size, each exported by its own
+            process to its own shard file.
 
             :param str collection: Name of Mongo collection or table
-            :param str f: File to write to
+            :param str f: File to write to, stdout if not given
+            :param dict query: Mongo query filter
+            :param dict projection: fields to include or exclude
+            :param int batch_size: number of docs to fetch at one time
+            :param bool compress: gzip the output
+            :param int workers: number of export processes
         """
         self.collection = self.db[collection]
-        for doc in self.collection.find():
-            if f:
-                with open(f, 'w') as newfile:
-                    newfile.write()
+        query = query or {}
+        if compress and f and not f.endswith('.gz'):
+            f += '.gz'
+        if workers <= 1:
+            count = _export_mongo(self.host, self.db_name, collection, query,
+                                  projection, batch_size, f, compress,
+                                  self.codec.name)
+            logging.info('{0} docs exported from {1}'.format(count,
+                         collection))
+            return
+        if not f:
+            raise ValueError('a parallel export needs a file to write to')
+        tasks = []
+        id_ranges = self._id_ranges(query, workers)
+        paths = [_shard_path(f, idx, compress)
+                 for idx in xrange(len(id_ranges))]
+        for path, id_range in zip(paths, id_ranges):
+            range_query = {'$and': [query, {'_id': id_range}]} if id_range \
+                else query
+            tasks.append((self.host, self.db_name, collection, range_query,
+                          projection, batch_size, path, compress,
+                          self.codec.name))
+        pool = multiprocessing.Pool(workers)
+        try:
+            counts = pool.map(_export_mongo_args, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for task, count in zip(tasks, counts):
+            logging.info('{0} docs exported to {1}'.format(count, task[6]))
 
-        # d = JsonPort(self.collection.find())
-        # for item in d.parse():
-        #     print item
-        #     raw_input('\Continue?\n')
-        # for doc in self.collection.find():
+    def _id_ranges(self, query, parts):
+        """ Split the docs matching a query into ``_id`` ranges holding
+            about the same number of docs.  Returns ``_id`` range filters.
+
+            :param dict query: Mongo query filter
+            :param int parts: number of ranges
+        """
+        total = self.collection.count_documents(query)
+        bounds = [None]
+        for part in xrange(1, parts):
+            docs = list(self.collection.find(query, {'_id': 1})
+                        .sort('_id', 1).skip(total * part // parts).limit(1))
+            if docs and docs[0]['_id'] != bounds[-1]:
+                bounds.append(docs[0]['_id'])
+        bounds.append(None)
+        ranges = []
+        for lower, upper in zip(bounds, bounds[1:]):
+            id_range = {}
+            if lower is not None:
+                id_range['$gte'] = lower
+            if upper is not None:
+                id_range['$lt'] = upper
+            ranges.append(id_range)
+        return ranges
 
     def list(self):
         """ List all collections in the Mongo database. """
@@ -300,14 +2071,99 @@ class MongoPort(object):
             print c
 
 
-class HbasePort(object):
+# how HBase row keys, column names and values are written as JSON strings
+HBASE_ENCODINGS = ('utf-8', 'base64')
+
+
+def _hbase_doc(key, data, encoding='utf-8'):
+    """ Returns a row as :meth:`HbasePort.export` writes it.  HBase keys
+        and cells are arbitrary bytes, so with the ``base64`` encoding, or
+        for rows that aren't all UTF-8, they are base64 encoded and the row
+        is marked ``"encoding": "base64"``.
+
+        :param str key: row key
+        :param dict data: column names and values
+        :param str encoding: ``utf-8`` or ``base64``
+    """
+    if encoding == 'utf-8':
+        try:
+            return {'row': key.decode('utf-8'),
+                    'columns': dict((k.decode('utf-8'), v.decode('utf-8'))
+                                    for k, v in data.iteritems())}
+        except UnicodeDecodeError:
+            pass
+    b64 = base64.b64encode
+    return {'row': b64(key), 'encoding': 'base64',
+            'columns': dict((b64(k), b64(v)) for k, v in data.iteritems())}
+
+
+def _hbase_row(doc):
+    """ Returns the row key and columns of a row written by
+        :func:`_hbase_doc`, as bytes for Thrift.
+
+        :param dict doc: row
+    """
+    if doc.get('encoding') == 'base64':
+        b64 = base64.b64decode
+        return b64(doc['row']), dict((b64(k), b64(v))
+                                     for k, v in doc['columns'].iteritems())
+    return doc['row'].encode('utf-8'), dict(
+        (k.encode('utf-8'), v.encode('utf-8'))
+        for k, v in doc['columns'].iteritems())
+
+
+def _export_hbase(host, tablename, path, scan_args, compress=False,
+                  codec_name='json', encoding='utf-8'):
+    """ Export the rows of an HBase scan to a JSON lines file, or stdout if
+        no path is given.  Each line is ``{"row": key, "columns": {...}}``,
+        see :func:`_hbase_doc`.  Runs inside a worker process for parallel
+        exports.  Returns the number of rows written.
+
+        :param str host: Hbase hostname
+        :param str tablename: Hbase table name
+        :param str path: file to write to
+        :param dict scan_args: keyword arguments for ``Table.scan``
+        :param bool compress: gzip the output
+        :param str codec_name: JSON codec to encode with
+        :param str encoding: ``utf-8`` or ``base64``
+    """
+    dumps = get_codec(codec_name).dumps
+    table = _client('hbase').Connection(host).table(tablename)
+    batch_size = scan_args.get('batch_size', 1000)
+    out = _open_output(path, compress)
+    count = 0
+    try:
+        batch = []
+        for key, data in table.scan(**scan_args):
+            batch.append(dumps(_hbase_doc(key, data, encoding)) + '\n')
+            if len(batch) >= batch_size:
+                out.writelines(batch)
+                count += len(batch)
+                batch = []
+        out.writelines(batch)
+        count += len(batch)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+
+def _export_hbase_args(args):
+    """ Unpack :func:`_export_hbase` arguments for ``Pool.map``. """
+    return _export_hbase(*args)
+
+
+class HbasePort(Source, Sink):
     """ Class to interface with HBase.
 
         :param str hostname: Hbase hostname
+        :param codec: JSON codec, see :func:`transporter.codec.get_codec`
     """
 
-    def __init__(self, hostname):
-        self.connection = happybase.Connection(hostname)
+    def __init__(self, hostname, codec=None):
+        self.hostname = hostname
+        self.connection = _client('hbase').Connection(hostname)
+        self.codec = codec or get_codec()
 
     def scan(self, tablename):
         """ Print HBase rows one row at a time.  Ctrl+d to stop.
@@ -321,3 +2177,200 @@ class HbasePort(object):
                 raw_input('\n--Press any key to continue--\n')
             except EOFError:
                 sys.exit(0)
+
+    def export(self, tablename, f=None, columns=None, row_prefix=None,
+               row_start=None, row_stop=None, batch_size=1000,
+               compress=False, workers=1, encoding='utf-8'):
+        """ Export HBase rows as JSON lines, ``{"row": key, "columns":
+            {"family:qualifier": value}}``.  With several workers the key
+            range is split along region boundaries, and each region is
+            scanned by its own process into its own shard file.  Rows that
+            aren't UTF-8 are base64 encoded, see :func:`_hbase_doc`, and
+            :meth:`add` decodes them again.
+
+            :param str tablename: Hbase table name
+            :param str f: File to write to, stdout if not given
+            :param list columns: columns or column families to export
+            :param str row_prefix: only export rows starting with this
+            :param str row_start: first row key to export
+            :param str row_stop: row key to stop before
+            :param int batch_size: number of rows to fetch at one time
+            :param bool compress: gzip the output
+            :param int workers: number of export processes
+            :param str encoding: ``utf-8``, or ``base64`` to encode every
+                                 row
+        """
+        if encoding not in HBASE_ENCODINGS:
+            raise ValueError('encoding must be one of {0}, not {1}'.format(
+                             ', '.join(HBASE_ENCODINGS), encoding))
+        if row_prefix:
+            from happybase.util import bytes_increment
+            row_start, row_stop = row_prefix, bytes_increment(row_prefix)
+        if compress and f and not f.endswith('.gz'):
+            f += '.gz'
+        scan_args = {'columns': columns, 'batch_size': batch_size}
+        if workers <= 1:
+            scan_args.update(row_start=row_start, row_stop=row_stop)
+            count = _export_hbase(self.hostname, tablename, f, scan_args,
+                                  compress, self.codec.name, encoding)
+            logging.info('{0} rows exported from {1}'.format(count,
+                         tablename))
+            return
+        if not f:
+            raise ValueError('a parallel export needs a file to write to')
+        key_ranges = self._key_ranges(tablename, row_start, row_stop)
+        paths = [_shard_path(f, idx, compress)
+                 for idx in xrange(len(key_ranges))]
+        tasks = []
+        for path, (start, stop) in zip(paths, key_ranges):
+            range_args = dict(scan_args, row_start=start, row_stop=stop)
+            tasks.append((self.hostname, tablename, path, range_args,
+                          compress, self.codec.name, encoding))
+        pool = multiprocessing.Pool(workers)
+        try:
+            counts = pool.map(_export_hbase_args, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for task, count in zip(tasks, counts):
+            logging.info('{0} rows exported to {1}'.format(count, task[2]))
+
+    def read(self, location, **options):
+        """ Scan a table, yielding rows like :meth:`export` writes them.
+
+            :param str location: Hbase table name
+        """
+        for key, data in self.connection.table(location).scan():
+            yield _hbase_doc(key, data)
+
+    def write(self, docs, location, **options):
+        """ Write rows like :meth:`export` writes them to a table.
+
+            :param docs: iterator of rows
+            :param str location: Hbase table name
+            :param str errors: what to do with docs that aren't rows, see
+                               :meth:`add`
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        self.add(location, docs, errors=options.get('errors') or 'skip',
+                 dead_letter=options.get('dead_letter'))
+
+    def _key_ranges(self, tablename, row_start=None, row_stop=None):
+        """ Split a row key range along the table's region boundaries.
+            Returns ``(start, stop)`` pairs, None meaning unbounded.
+
+            :param str tablename: Hbase table name
+            :param str row_start: first row key
+            :param str row_stop: row key to stop before
+        """
+        ranges = []
+        for region in self.connection.table(tablename).regions():
+            start = max(row_start or '', region['start_key'])
+            stops = [k for k in (row_stop, region['end_key']) if k]
+            stop = min(stops) if stops else None
+            if stop is not None and start >= stop:
+                continue
+            ranges.append((start or None, stop))
+        return ranges
+
+    def add(self, tablename, jsonit, batch_size=1000, row_key=None,
+            family=None, checkpoint=None, errors='skip', dead_letter=None):
+        """ Write JSON docs to an HBase table in batches of puts.  Docs are
+            either rows as written by :meth:`export`, base64 encoded or not,
+            or plain docs when a ``row_key`` field and column ``family`` are
+            given, in which case every other field becomes a column holding
+            its JSON value.  Docs that can't be made into a row, like plain
+            docs without the row key, are handled by the error policy.
+
+            :param str tablename: Hbase table name
+            :param list jsonit: JSON list or iterator
+            :param int batch_size: number of puts to send at one time
+            :param str row_key: field holding the row key of plain docs
+            :param str family: column family to store plain docs in
+            :param checkpoint: :class:`transporter.checkpoint.Checkpoint` to
+                               acknowledge written docs in
+            :param str errors: ``skip``, ``fail`` or ``dead-letter`` docs
+                               that can't be made into a row
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        check_policy(errors, dead_letter)
+        table = self.connection.table(tablename)
+        count = 0
+        batch = table.batch()
+        pending = skipped = 0
+        for doc in jsonit:
+            try:
+                row = self._row(doc, row_key, family)
+            except (KeyError, TypeError, AttributeError, ValueError) as e:
+                self._unmapped(doc, e, errors, dead_letter)
+                skipped += 1
+                continue
+            batch.put(*row)
+            pending += 1
+            if pending >= batch_size:
+                with METRICS.timer('hbase_batch_seconds'):
+                    batch.send()
+                METRICS.incr('docs_written', pending)
+                count += pending
+                if checkpoint:
+                    checkpoint.ack(pending + skipped)
+                pending = skipped = 0
+        with METRICS.timer('hbase_batch_seconds'):
+            batch.send()
+        METRICS.incr('docs_written', pending)
+        count += pending
+        if dead_letter:
+            dead_letter.flush()
+        if checkpoint:
+            checkpoint.ack(pending + skipped)
+            checkpoint.save()
+        logging.info('{0} rows written to {1}'.format(count, tablename))
+
+    def _row(self, doc, row_key=None, family=None):
+        """ Returns the row key and columns to put for a doc, see
+            :meth:`add`.
+
+            :param dict doc: row, or plain doc
+            :param str row_key: field holding the row key of plain docs
+            :param str family: column family to store plain docs in
+        """
+        if not row_key:
+            return _hbase_row(doc)
+        key = doc.get(row_key)
+        if key is None:
+            raise KeyError('no row key field {0}'.format(row_key))
+        dumps = self.codec.dumps
+        data = dict((u'{0}:{1}'.format(family, k),
+                     v if isinstance(v, basestring) else dumps(v))
+                    for k, v in doc.iteritems() if k != row_key)
+        return unicode(key).encode('utf-8'), self._encode(data)
+
+    def _unmapped(self, doc, error, errors, dead_letter=None):
+        """ Skip, fail on, or dead-letter a doc that can't be made into a
+            row.
+
+            :param dict doc: the doc
+            :param error: why
+            :param str errors: ``skip``, ``fail`` or ``dead-letter``
+            :param dead_letter: :class:`transporter.deadletter.DeadLetter`
+                                file
+        """
+        METRICS.incr('write_errors')
+        logging.warning('cannot make a row of a doc: {0!r}'.format(error))
+        if errors == 'fail':
+            raise ValueError('cannot make a row of a doc: {0!r}'.format(
+                             error))
+        if errors == 'dead-letter':
+            dead_letter.add({'error': repr(error), 'doc': doc})
+
+    def _encode(self, data):
+        """ Encode column names and values as UTF-8 for Thrift.
+
+            :param dict data: column names and values
+        """
+        return dict((k.encode('utf-8') if isinstance(k, unicode) else k,
+                     v.encode('utf-8') if isinstance(v, unicode) else v)
+                    for k, v in data.iteritems())
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import fileinput
 import sys
 import os
 from docopt import docopt
@@ -9,9 +8,17 @@ import logging
 import json
 
 from tools import JsonPort, S3Port, ElasticPort, MongoPort, HbasePort, KafkaPort
+from codec import get_codec
+from readers import LineReader, compression
+from checkpoint import Checkpoint, OffsetCheckpoint
+from deadletter import DeadLetter
+from docid import IdSpec, GNIP_ID
+from transform import Transform
+from metrics import METRICS, Progress
+from pipeline import parse_uri, copy, Prefetcher
 
-from settings import (ES_SETTINGS, S3_SETTINGS,
-                      MONGO_SETTINGS, HBASE_SETTINGS, KAFKA_SETTINGS)
+from settings import (ES_SETTINGS, S3_SETTINGS, MONGO_SETTINGS,
+                      HBASE_SETTINGS, KAFKA_SETTINGS, JSON_SETTINGS)
 
 # Local Overrides
 # ~~~~~~~~~~~~~~~
@@ -20,6 +27,9 @@ from ConfigParser import SafeConfigParser
 parser = SafeConfigParser()
 parser.read(os.path.expanduser('~/.tport'))
 
+if parser.has_section('json'):
+    JSON_SETTINGS['codec'] = parser.get('json', 'codec')
+
 if parser.has_section('elasticsearch'):
     ES_SETTINGS['host'] = parser.get('elasticsearch', 'host')
     ES_SETTINGS['ssl'] = bool(parser.get('elasticsearch', 'ssl'))
@@ -48,30 +58,70 @@ if parser.has_section('hbase'):
 logging.basicConfig(level=logging.INFO)
 
 
+def copy_port(uri, codec=None):
+    """ Build the port for a ``tport copy`` endpoint from its URI, with the
+        settings filling in what the URI leaves out.  Returns the port and
+        the location to read or write.
+
+        :param str uri: endpoint, see :func:`transporter.pipeline.parse_uri`
+        :param codec: JSON codec for the port
+    """
+    scheme, host, location = parse_uri(uri)
+    if scheme == 'file':
+        return JsonPort(None, codec=codec), location
+    if scheme == 'es':
+        return ElasticPort(host or ES_SETTINGS['host'], ES_SETTINGS['ssl'],
+                           codec=codec), location
+    if scheme == 'kafka':
+        return KafkaPort(host or KAFKA_SETTINGS['broker'],
+                         codec=codec), location
+    if scheme == 's3':
+        return S3Port(S3_SETTINGS['access_key'], S3_SETTINGS['secret_key'],
+                      codec=codec), location
+    if scheme == 'mongo':
+        db, _, collection = location.rpartition('/')
+        return MongoPort(host or MONGO_SETTINGS['host'],
+                         db or MONGO_SETTINGS['db'], codec=codec), collection
+    return HbasePort(host or HBASE_SETTINGS['host'], codec=codec), location
+
+
 def main():
     """ transporter: Transport JSON data to different outputs.
 
     Usage:
-        tport inspect FILE ...
+        tport inspect [--codec=<codec>] FILE ...
         tport es create --indexname=<indexname>
         tport es map --indexname=<indexname> --doctype=<doctype> --mapping=<mapping>
-        tport es index --indexname=<indexname> --doctype=<doctype> [--chunksize=<chunksize>] [--mapping=<mapping>] [--ignore-errors=<ignore-errors>] FILE ...
+        tport es index --indexname=<indexname> --doctype=<doctype> [--chunksize=<chunksize>] [--threads=<threads>] [--adaptive [--chunkbytes=<chunkbytes>]] [--id-field=<field> [--id-regex=<regex>] | --id-hash=<hash>] [--routing=<field>] [--op-type=<op-type>] [--bulk-load-mode [--bulk-state=<bulk-state>] [--force-merge=<segments>]] [--mapping=<mapping>] [--ignore-errors=<ignore-errors>] [--errors=<errors>] [--dead-letter=<dead-letter>] [--where=<where>] [--include=<fields>] [--exclude=<fields>] [--rename=<renames>] [--coerce=<types>] [--flatten=<sep>] [--workers=<workers> [--unordered]] [--codec=<codec>] [--prefetch=<prefetch>] [--checkpoint=<checkpoint> [--resume]] [--progress] [--metrics=<metrics>] (--topic=<topic> [--broker=<broker>] [--group=<group>] [--count=<count>] [--timeout=<timeout>] | FILE ...)
+        tport es restore --indexname=<indexname> [--bulk-state=<bulk-state>]
+        tport es export --indexname=<indexname> [--doctype=<doctype>] [--query=<query>] [--fields=<fields>] [--size=<size>] [--scroll=<scroll>] [--meta] [--compress] [--workers=<workers>] [--codec=<codec>] [--progress] [--metrics=<metrics>] [FILE ...]
         tport kafka topics [--broker=<broker>]
-        tport kafka produce --topic=<topic> [--broker=<broker>] FILE ...
-        tport kafka consume --topic=<topic> [--broker=<broker>]
+        tport kafka produce --topic=<topic> [--broker=<broker>] [--key=<field>] [--batchsize=<batchsize>] [--linger=<linger>] [--compression=<compression>] [--max-queued=<max-queued>] [--sync] [--errors=<errors>] [--dead-letter=<dead-letter>] [--where=<where>] [--include=<fields>] [--exclude=<fields>] [--rename=<renames>] [--coerce=<types>] [--flatten=<sep>] [--workers=<workers> [--unordered]] [--codec=<codec>] [--prefetch=<prefetch>] [--passthrough [--validate=<validate>] [--sample=<sample>]] [--checkpoint=<checkpoint> [--resume]] [--progress] [--metrics=<metrics>] FILE ...
+        tport kafka consume --topic=<topic> [--broker=<broker>] [--group=<group>] [--count=<count>] [--timeout=<timeout>] [--batchsize=<batchsize>] [--compress] [--rotate=<rotate>] [--progress] [--metrics=<metrics>] [FILE ...]
         tport s3 list
-        tport s3 upload <bucket> [--replace=<replace>] [--compress] FILE ...
-        tport s3 download <bucket> FOLDER
+        tport s3 upload <bucket> [--replace=<replace>] [--compress] [--concurrency=<concurrency>] [--partsize=<partsize>] [--progress] [--metrics=<metrics>] FILE ...
+        tport s3 download <bucket> [--concurrency=<concurrency>] [--partsize=<partsize>] [--progress] [--metrics=<metrics>] FOLDER
         tport s3 destroy <bucket>
         tport mongo list [--host=<host>] [--db=<db>]
         tport mongo preview [--host=<host>] [--db=<db>] --collection=<collection>
-        tport mongo export [--host=<host>] [--db=<db>] --collection=<collection> [FILE ...]
-        tport mongo add [--host=<host>] [--db=<db>] --collection=<collection> FILE ...
+        tport mongo export [--host=<host>] [--db=<db>] --collection=<collection> [--query=<query>] [--fields=<fields>] [--batchsize=<batchsize>] [--compress] [--workers=<workers>] [--codec=<codec>] [FILE ...]
+        tport mongo add [--host=<host>] [--db=<db>] --collection=<collection> [--batchsize=<batchsize>] [--upsert-key=<key>] [--threads=<threads>] [--ignore-errors=<ignore-errors>] [--errors=<errors>] [--dead-letter=<dead-letter>] [--where=<where>] [--include=<fields>] [--exclude=<fields>] [--rename=<renames>] [--coerce=<types>] [--flatten=<sep>] [--workers=<workers> [--unordered]] [--codec=<codec>] [--prefetch=<prefetch>] [--checkpoint=<checkpoint> [--resume]] [--progress] [--metrics=<metrics>] (--topic=<topic> [--broker=<broker>] [--group=<group>] [--count=<count>] [--timeout=<timeout>] | FILE ...)
         tport hbase scan [--host=<host>] --table=<table>
+        tport hbase export [--host=<host>] --table=<table> [--columns=<columns>] [--prefix=<prefix> | [--start=<start>] [--stop=<stop>]] [--batchsize=<batchsize>] [--compress] [--workers=<workers>] [--encoding=<encoding>] [--codec=<codec>] [FILE ...]
+        tport hbase import [--host=<host>] --table=<table> [--row-key=<field> --family=<family>] [--batchsize=<batchsize>] [--ignore-errors=<ignore-errors>] [--errors=<errors>] [--dead-letter=<dead-letter>] [--where=<where>] [--include=<fields>] [--exclude=<fields>] [--rename=<renames>] [--coerce=<types>] [--flatten=<sep>] [--workers=<workers> [--unordered]] [--codec=<codec>] [--prefetch=<prefetch>] [--checkpoint=<checkpoint> [--resume]] [--progress] [--metrics=<metrics>] FILE ...
+        tport copy <source> <sink> [--queue=<queue>] [--query=<query>] [--group=<group>] [--count=<count>] [--timeout=<timeout>] [--errors=<errors>] [--dead-letter=<dead-letter>] [--codec=<codec>] [--progress] [--metrics=<metrics>]
 
     Options:
         -h --help
         -e --ignore-errors <ignore-errors>
+        --errors <errors>
+        --dead-letter <dead-letter>
+        --where <where>
+        --include <fields>
+        --exclude <fields>
+        --rename <renames>
+        --coerce <types>
+        --flatten <sep>
         -i --indexname <indexname>
         -d --doctype <doctype>
         -m --mapping <mapping>
@@ -79,21 +129,151 @@ def main():
         -r --replace <replace>
         -t --topic <topic>
         -b --broker <broker>
+        -w --workers <workers>
+        --unordered
+        --codec <codec>
+        --threads <threads>
+        --adaptive
+        --chunkbytes <chunkbytes>
+        --id-field <field>
+        --id-regex <regex>
+        --id-hash <hash>
+        --routing <field>
+        --op-type <op-type>
+        --bulk-load-mode
+        --bulk-state <bulk-state>
+        --force-merge <segments>
+        --concurrency <concurrency>
+        --partsize <partsize>
+        --passthrough
+        --validate <validate>
+        --sample <sample>
+        --checkpoint <checkpoint>
+        --resume
+        --batchsize <batchsize>
+        --upsert-key <key>
+        --query <query>
+        --fields <fields>
+        --columns <columns>
+        --prefix <prefix>
+        --start <start>
+        --stop <stop>
+        --row-key <field>
+        --family <family>
+        --encoding <encoding>
+        --group <group>
+        --count <count>
+        --timeout <timeout>
+        --rotate <rotate>
+        --key <field>
+        --linger <linger>
+        --compression <compression>
+        --max-queued <max-queued>
+        --sync
+        --queue <queue>
+        --prefetch <prefetch>
+        --progress
+        --metrics <metrics>
+        --size <size>
+        --scroll <scroll>
+        --meta
     """
 
     args = docopt(main.__doc__)
     # logging.info(args)
     f = args['FILE']
     cli_ignore = True if args['--ignore-errors'] else False
+    cli_codec = get_codec(args['--codec'] or JSON_SETTINGS['codec'])
+
+    # bad lines fail the job unless skipped or sent to a dead-letter file
+    cli_dead_letter = None
+    if args['--dead-letter']:
+        cli_dead_letter = DeadLetter(args['--dead-letter'], codec=cli_codec)
+    cli_errors = args['--errors']
+    if not cli_errors:
+        if cli_dead_letter:
+            cli_errors = 'dead-letter'
+        elif cli_ignore:
+            cli_errors = 'skip'
+    cli_workers = int(args['--workers'] or 1)
+    cli_ordered = not args['--unordered']
+
+    def cli_list(option):
+        """ Split a comma separated option. """
+        return args[option].split(',') if args[option] else None
+
+    def cli_pairs(option):
+        """ Split a comma separated option of ``key:value`` pairs. """
+        return dict(pair.split(':', 1) for pair in cli_list(option)) \
+            if args[option] else None
+
+    # filter and reshape docs as they are decoded
+    cli_transform = Transform(args['--where'], cli_pairs('--coerce'),
+                              cli_list('--include'), cli_list('--exclude'),
+                              cli_pairs('--rename'), args['--flatten'])
+
+    cli_prefetch = int(args['--prefetch'] or 0)
+    cli_count = int(args['--count']) if args['--count'] else None
+    cli_timeout = float(args['--timeout']) if args['--timeout'] else None
+
+    cli_checkpoint = None
+    cli_start = None
+    if args['--checkpoint'] and f:
+        cli_checkpoint = Checkpoint(args['--checkpoint'])
+        if args['--resume']:
+            cli_start = cli_checkpoint.load()
+            if cli_start:
+                logging.info('resuming after line {0} of {1}'.format(
+                             cli_start['line'], cli_start['file']))
+            else:
+                logging.info('no checkpoint found, starting from the top')
 
-    cli_jsonit = JsonPort(fileinput.input(f), cli_ignore) if f else None
+    # s3://bucket/prefix inputs are streamed straight from S3
+    cli_s3 = None
+    if f and any(fname.startswith('s3://') for fname in f):
+        cli_s3 = S3Port(S3_SETTINGS['access_key'], S3_SETTINGS['secret_key'],
+                        codec=cli_codec)
+    cli_jsonit = JsonPort(LineReader(f, cli_start, cli_s3), cli_ignore,
+                          cli_workers, cli_ordered, codec=cli_codec,
+                          checkpoint=cli_checkpoint, errors=cli_errors,
+                          dead_letter=cli_dead_letter,
+                          transform=cli_transform) if f else None
+
+    # es index and mongo add can read straight from a Kafka topic
+    cli_consumer = None
+    if args['--topic'] and (args['es'] or args['mongo']):
+        cli_consumer = KafkaPort(args['--broker'] or KAFKA_SETTINGS['broker'],
+                                 codec=cli_codec)
+        cli_messages = cli_consumer.reader(args['--topic'], args['--group'],
+                                           cli_count, cli_timeout)
+        # offsets are committed as the sink acknowledges the docs
+        if args['--group']:
+            cli_checkpoint = OffsetCheckpoint(cli_consumer.commit)
+        cli_jsonit = JsonPort(cli_messages, cli_ignore, cli_workers,
+                              cli_ordered, codec=cli_codec,
+                              checkpoint=cli_checkpoint, errors=cli_errors,
+                              dead_letter=cli_dead_letter,
+                              transform=cli_transform)
+
+    # input size, for the progress ETA; bytes read of compressed files are
+    # counted decompressed, so there is no telling how far along they are
+    if cli_jsonit and not (args['consume'] or args['export']) and \
+            all(os.path.isfile(fname) and compression(fname) is None
+                for fname in f):
+        METRICS.total_bytes = sum(os.path.getsize(fname) for fname in f)
+    cli_progress = Progress(METRICS).start() if args['--progress'] else None
+
+    def cli_docs(docs):
+        """ Read and decode ahead of the sink when --prefetch is given. """
+        return iter(Prefetcher(docs, cli_prefetch)) if cli_prefetch else docs
 
     if args['inspect']:
         cli_jsonit.inspect()
 
     if args['es']:
         # Connect to elastic search
-        esi = ElasticPort(ES_SETTINGS['host'], ES_SETTINGS['ssl'])
+        esi = ElasticPort(ES_SETTINGS['host'], ES_SETTINGS['ssl'],
+                          codec=cli_codec)
         cli_iname = args['--indexname']
         cli_dtype = args['--doctype']
         if args['create']:
@@ -105,6 +285,13 @@ def main():
         if args['index']:
             cli_chunksize = args['--chunksize'] or 500
             cli_chunksize = int(cli_chunksize)
+            cli_threads = int(args['--threads'] or 1)
+            cli_chunkbytes = int(args['--chunkbytes'] or 5 * 1024 * 1024)
+            # Gnip tweet ids unless told where else the ids come from
+            cli_ids = IdSpec('id', GNIP_ID, routing=args['--routing'])
+            if args['--id-field'] or args['--id-hash']:
+                cli_ids = IdSpec(args['--id-field'], args['--id-regex'],
+                                 args['--id-hash'], args['--routing'])
             # Create index if not created
             esi.create(cli_iname)
             if args['--mapping']:
@@ -112,22 +299,83 @@ def main():
                     cli_mapping = json.load(fm)
                 esi.map(cli_iname, cli_dtype, cli_mapping)
 
-            esi.index(cli_jsonit.parse(), cli_iname, cli_dtype, cli_chunksize)
+            def cli_index():
+                esi.index(cli_docs(cli_jsonit.parse()), cli_iname, cli_dtype,
+                          cli_chunksize, cli_threads, args['--adaptive'],
+                          cli_chunkbytes, checkpoint=cli_checkpoint,
+                          errors=cli_errors or 'skip',
+                          dead_letter=cli_dead_letter, ids=cli_ids,
+                          op_type=args['--op-type'] or 'index')
+
+            # no refreshes or replicas until the load is done
+            if args['--bulk-load-mode']:
+                cli_segments = int(args['--force-merge'] or 0)
+                with esi.bulk_load(cli_iname, args['--bulk-state'],
+                                   cli_segments):
+                    cli_index()
+            else:
+                cli_index()
+            if cli_consumer:
+                cli_consumer.close()
+        if args['restore']:
+            esi.restore(cli_iname, args['--bulk-state'])
+        if args['export']:
+            cli_body = {}
+            if args['--query']:
+                with open(args['--query']) as fq:
+                    cli_body = json.load(fq)
+            if args['--fields']:
+                cli_fields = args['--fields'].split(',')
+                cli_body['_source'] = {
+                    'includes': [fld for fld in cli_fields
+                                 if not fld.startswith('-')],
+                    'excludes': [fld[1:] for fld in cli_fields
+                                 if fld.startswith('-')]
+                }
+            esi.export(cli_iname, f[0] if f else None, cli_body, cli_dtype,
+                       int(args['--size'] or 1000), args['--scroll'] or '5m',
+                       args['--compress'], args['--meta'], cli_workers)
 
     if args['kafka']:
         ka_broker = args['--broker'] or KAFKA_SETTINGS['broker']
-        kai = KafkaPort(ka_broker)
+        kai = KafkaPort(ka_broker, codec=cli_codec)
         if args['topics']:
             kai.topics()
         if args['produce']:
             cli_topic = args['--topic']
-            kai.produce(cli_topic, cli_jsonit.parse())
+            cli_producer = {
+                'key': args['--key'],
+                'batch_size': int(args['--batchsize'] or 0),
+                'linger_ms': int(args['--linger']) if args['--linger']
+                else None,
+                'compression': args['--compression'],
+                'max_queued': int(args['--max-queued'] or 0),
+                'sync': args['--sync']
+            }
+            if args['--passthrough']:
+                cli_validate = args['--validate'] or 'light'
+                cli_sample = int(args['--sample'] or 0)
+                kai.produce(cli_topic,
+                            cli_docs(cli_jsonit.raw(cli_validate,
+                                                    cli_sample)),
+                            raw=True, checkpoint=cli_checkpoint,
+                            **cli_producer)
+            else:
+                kai.produce(cli_topic, cli_docs(cli_jsonit.parse()),
+                            checkpoint=cli_checkpoint, **cli_producer)
         if args['consume']:
             cli_topic = args['--topic']
-            kai.consume(cli_topic)
+            cli_batchsize = int(args['--batchsize'] or 1000)
+            cli_rotate = int(args['--rotate']) if args['--rotate'] else None
+            kai.consume(cli_topic, f[0] if f else None, args['--group'],
+                        cli_count, cli_timeout, cli_batchsize,
+                        args['--compress'], cli_rotate)
 
     if args['s3']:
-        s3u = S3Port(S3_SETTINGS['access_key'], S3_SETTINGS['secret_key'])
+        s3u = S3Port(S3_SETTINGS['access_key'], S3_SETTINGS['secret_key'],
+                     codec=cli_codec)
+        cli_concurrency = int(args['--concurrency'] or 1)
+        cli_partsize = int(args['--partsize'] or 8 * 1024 * 1024)
         if args['list']:
             s3u.list()
         if args['upload']:
@@ -135,12 +383,14 @@ def main():
             cli_bucket = args['<bucket>']
             cli_compress = True if args['--compress'] else False
 #            logging.info('upload starting...')
-            s3u.upload(cli_bucket, f, cli_compress, cli_replace)
+            s3u.upload(cli_bucket, f, cli_compress, cli_replace, cli_partsize,
+                       cli_concurrency)
 #            logging.info('upload complete')
         if args['download']:
             cli_folder = args['FOLDER']
             cli_bucket = args['<bucket>']
-            s3u.download(cli_bucket, cli_folder)
+            s3u.download(cli_bucket, cli_folder, cli_partsize,
+                         cli_concurrency)
         if args['destroy']:
             print 'You are about to DESTROY the entire {0} bucket!!!\n'.format(
                                                             args['<bucket>'])
@@ -158,22 +408,86 @@ def main():
         # Connect to mongo database
         mg_host = MONGO_SETTINGS['host'] or args['--host']
         mg_db = MONGO_SETTINGS['db'] or args['--db']
-        mgi = MongoPort(mg_host, mg_db)
+        mgi = MongoPort(mg_host, mg_db, codec=cli_codec)
         if args['list']:
             mgi.list()
         if args['preview']:
             mg_collection = args['--collection']
             mgi.preview(mg_collection)
         if args['export']:
+            from bson import json_util
+            mg_collection = args['--collection']
+            mg_query = json_util.loads(args['--query'] or '{}')
+            mg_projection = None
+            if args['--fields']:
+                mg_projection = dict(
+                    (fld.lstrip('-'), 0 if fld.startswith('-') else 1)
+                    for fld in args['--fields'].split(','))
+            mg_batchsize = int(args['--batchsize'] or 1000)
+            mgi.export(mg_collection, f[0] if f else None, mg_query,
+                       mg_projection, mg_batchsize, args['--compress'],
+                       cli_workers)
+        if args['add']:
             mg_collection = args['--collection']
-            mgi.export(mg_collection, f)   # generator object
+            mg_batchsize = int(args['--batchsize'] or 1000)
+            mg_threads = int(args['--threads'] or 1)
+            mgi.add(mg_collection, cli_docs(cli_jsonit.parse()),
+                    mg_batchsize, args['--upsert-key'], mg_threads,
+                    cli_checkpoint)
+            if cli_consumer:
+                cli_consumer.close()
 
     if args['hbase']:
         hb_host = HBASE_SETTINGS['host'] or args['--host']
-        hbi = HbasePort(hb_host)
+        hbi = HbasePort(hb_host, codec=cli_codec)
+        hbi_table = args['--table']
+        hbi_batchsize = int(args['--batchsize'] or 1000)
         if args['scan']:
-            hbi_table = args['--table']
             hbi.scan(hbi_table)
+        if args['export']:
+            hbi_columns = args['--columns'].split(',') \
+                if args['--columns'] else None
+            hbi.export(hbi_table, f[0] if f else None, hbi_columns,
+                       args['--prefix'], args['--start'], args['--stop'],
+                       hbi_batchsize, args['--compress'], cli_workers,
+                       args['--encoding'] or 'utf-8')
+        if args['import']:
+            hbi.add(hbi_table, cli_docs(cli_jsonit.parse()),
+                    hbi_batchsize, args['--row-key'], args['--family'],
+                    cli_checkpoint, cli_errors or 'skip', cli_dead_letter)
+
+    if args['copy']:
+        cp_source, cp_from = copy_port(args['<source>'], cli_codec)
+        cp_sink, cp_to = copy_port(args['<sink>'], cli_codec)
+        cp_query = None
+        if args['--query']:
+            # Mongo queries may use extended JSON, like {"$oid": ...}
+            if isinstance(cp_source, MongoPort):
+                from bson import json_util
+                cp_query = json_util.loads(args['--query'])
+            else:
+                cp_query = json.loads(args['--query'])
+        # the same error policy for bad lines in file, Kafka and S3 sources
+        # and for docs ES or HBase sinks reject
+        cp_docs = cp_source.read(cp_from, query=cp_query,
+                                 group=args['--group'], count=cli_count,
+                                 timeout=cli_timeout, errors=cli_errors,
+                                 dead_letter=cli_dead_letter)
+        copy(cp_docs, lambda docs: cp_sink.write(
+             docs, cp_to, errors=cli_errors, dead_letter=cli_dead_letter),
+             int(args['--queue'] or 8))
+        # commit the messages copied now the sink has written them
+        if isinstance(cp_source, KafkaPort):
+            cp_source.close()
+
+    if cli_progress:
+        cli_progress.stop()
+    if cli_dead_letter and cli_dead_letter.count:
+        cli_dead_letter.flush()
+        logging.warning('{0} records written to dead-letter file {1}'.format(
+                        cli_dead_letter.count, cli_dead_letter.path))
+    if args['--metrics']:
+        METRICS.dump(args['--metrics'])
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,266 @@
+""" Field projection and transformation between parsing and a sink.
+
+    A :class:`Transform` is compiled once into a list of small functions,
+    one per step, and applied to every doc as it is decoded, inside the
+    decoding worker processes when there are any, so fields that are
+    dropped never reach the sink.  The steps run in this order, and every
+    field path names a field of the input doc:
+
+    ``coerce``
+        convert field values to ``int``, ``float``, ``str`` or ``bool``
+    ``where``
+        keep only the docs matching every condition
+    ``include`` and ``exclude``
+        keep only the given fields, or drop them
+    ``rename``
+        move fields to new paths
+    ``flatten``
+        turn nested objects into dotted keys, eg ``actor.id``
+
+    Field paths are dotted, eg ``actor.languages``.  Those of ``include``
+    and ``exclude`` reach into the objects of lists along the way; the
+    others stop at lists.
+"""
+
+import re
+import json
+
+from docid import getter
+
+_transforms = {}
+
+_MISSING = object()
+
+_CONDITION = re.compile(r'^\s*([^\s=!<>]+)\s*(==|!=|>=|<=|>|<|\bin\b|'
+                        r'\bexists\b)\s*(.*?)\s*$')
+
+# `` and `` between conditions, but not inside a quoted value
+_AND = re.compile(r'\s+and\s+(?=(?:[^"]*"[^"]*")*[^"]*$)')
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>=': lambda a, b: a is not None and a >= b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '<': lambda a, b: a is not None and a < b,
+    'in': lambda a, b: a in b
+}
+
+
+def _bool(value):
+    if isinstance(value, basestring):
+        if value.lower() in ('true', 'yes', 'y', '1'):
+            return True
+        if value.lower() in ('false', 'no', 'n', '0', ''):
+            return False
+        raise ValueError('not a boolean: {0}'.format(value))
+    return bool(value)
+
+
+def _str(value):
+    return value if isinstance(value, basestring) else unicode(value)
+
+TYPES = {'int': int, 'float': float, 'str': _str, 'bool': _bool}
+
+
+def get_transform(spec):
+    """ Returns the transform for a spec, compiled once per process, for
+        the decoding workers.
+
+        :param str spec: :attr:`Transform.spec`
+    """
+    if spec not in _transforms:
+        _transforms[spec] = Transform(**json.loads(spec))
+    return _transforms[spec]
+
+
+def _tree(paths):
+    """ Turn dotted paths into a tree of nested dicts, with True leaves. """
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split('.')
+        for key in keys[:-1]:
+            child = node.setdefault(key, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[keys[-1]] = True
+    return tree
+
+
+def _project(doc, tree):
+    """ Returns a copy of doc with only the fields in the tree. """
+    if isinstance(doc, list):
+        return [_project(item, tree) for item in doc
+                if isinstance(item, (dict, list))]
+    out = {}
+    for key, sub in tree.iteritems():
+        if key in doc:
+            value = doc[key]
+            if sub is True:
+                out[key] = value
+            elif isinstance(value, (dict, list)):
+                out[key] = _project(value, sub)
+    return out
+
+
+def _prune(doc, tree):
+    """ Remove the fields in the tree from doc, in place. """
+    if isinstance(doc, list):
+        for item in doc:
+            if isinstance(item, (dict, list)):
+                _prune(item, tree)
+        return
+    for key, sub in tree.iteritems():
+        if sub is True:
+            doc.pop(key, None)
+        elif isinstance(doc.get(key), (dict, list)):
+            _prune(doc[key], sub)
+
+
+def _pop(doc, keys):
+    """ Remove and return the value at a path, ``_MISSING`` if there is
+        none.
+    """
+    for key in keys[:-1]:
+        doc = doc.get(key)
+        if not isinstance(doc, dict):
+            return _MISSING
+    return doc.pop(keys[-1], _MISSING)
+
+
+def _put(doc, keys, value):
+    """ Set the value at a path, making objects along the way. """
+    for key in keys[:-1]:
+        child = doc.get(key)
+        if not isinstance(child, dict):
+            child = doc[key] = {}
+        doc = child
+    doc[keys[-1]] = value
+
+
+def _flatten(doc, sep, prefix='', out=None):
+    """ Returns doc with nested objects turned into joined keys. """
+    if out is None:
+        out = {}
+    for key, value in doc.iteritems():
+        if isinstance(value, dict) and value:
+            _flatten(value, sep, prefix + key + sep, out)
+        else:
+            out[prefix + key] = value
+    return out
+
+
+def _condition(text):
+    """ Compile a condition like ``lang == "en"`` into a predicate.  Values
+        are JSON, or else taken as a plain string.
+    """
+    match = _CONDITION.match(text)
+    if not match:
+        raise ValueError('cannot parse condition {0!r}, expected '
+                         '<field> <op> <value>'.format(text))
+    path, op, value = match.groups()
+    get = getter(path)
+    if op == 'exists':
+        if value:
+            raise ValueError('exists takes no value: {0!r}'.format(text))
+        return lambda doc: get(doc) is not None
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    if op == 'in' and not isinstance(value, list):
+        raise ValueError('in needs a JSON list: {0!r}'.format(text))
+    compare = _OPERATORS[op]
+    return lambda doc: compare(get(doc), value)
+
+
+class Transform(object):
+    """ Filters and reshapes decoded docs.  Calling it with a doc returns
+        the transformed doc, or None if the doc is filtered out.  Docs that
+        can't be transformed, like values that can't be coerced, raise a
+        ValueError and are handled like lines that aren't JSON.
+
+        :param str where: conditions joined by `` and ``, eg
+                          ``lang == "en" and retweets >= 10``; operators are
+                          ``==``, ``!=``, ``>``, ``>=``, ``<``, ``<=``,
+                          ``in`` with a JSON list, and ``exists``
+        :param dict coerce: field paths to type names
+        :param list include: field paths to keep
+        :param list exclude: field paths to drop
+        :param dict rename: field paths to new paths
+        :param str flatten: join nested keys with this separator
+    """
+
+    def __init__(self, where=None, coerce=None, include=None, exclude=None,
+                 rename=None, flatten=None):
+        self.spec = json.dumps({'where': where, 'coerce': coerce,
+                                'include': include, 'exclude': exclude,
+                                'rename': rename, 'flatten': flatten},
+                               sort_keys=True)
+        steps = []
+        if coerce:
+            for path, type_name in coerce.iteritems():
+                if type_name not in TYPES:
+                    raise ValueError('cannot coerce to {0}, use one of: {1}'
+                                     .format(type_name, ', '.join(TYPES)))
+                steps.append(self._coercion(path, TYPES[type_name]))
+        if where:
+            conditions = [_condition(text) for text in _AND.split(where)]
+            steps.append(lambda doc: doc if all(
+                condition(doc) for condition in conditions) else None)
+        if include:
+            kept = _tree(include)
+            steps.append(lambda doc: _project(doc, kept))
+        if exclude:
+            dropped = _tree(exclude)
+            steps.append(lambda doc: _prune(doc, dropped) or doc)
+        if rename:
+            moves = [(old.split('.'), new.split('.'))
+                     for old, new in sorted(rename.iteritems())]
+            steps.append(lambda doc: self._rename(doc, moves))
+        if flatten:
+            steps.append(lambda doc: _flatten(doc, flatten))
+        self.steps = steps
+
+    def __nonzero__(self):
+        return bool(self.steps)
+
+    def __call__(self, doc):
+        if not isinstance(doc, dict):
+            raise ValueError('only JSON objects can be transformed')
+        for step in self.steps:
+            doc = step(doc)
+            if doc is None:
+                return None
+        return doc
+
+    @staticmethod
+    def _coercion(path, convert):
+        keys = path.split('.')
+
+        def coerce(doc):
+            node = doc
+            for key in keys[:-1]:
+                node = node.get(key)
+                if not isinstance(node, dict):
+                    return doc
+            value = node.get(keys[-1])
+            if value is not None:
+                try:
+                    node[keys[-1]] = convert(value)
+                except (ValueError, TypeError) as e:
+                    raise ValueError('cannot coerce {0}: {1}'.format(path, e))
+            return doc
+        return coerce
+
+    @staticmethod
+    def _rename(doc, moves):
+        for old, new in moves:
+            value = _pop(doc, old)
+            if value is not _MISSING:
+                _put(doc, new, value)
+        return doc